@@ -0,0 +1,58 @@
+""" Throughput of DataStore.put() in data_dict as the number of threads putting goes up.
+    eg. from backend/
+        python benchmarks/data_dict_puts.py              # 200000 Containers for 1, 2, 4 and 8 threads.
+        python benchmarks/data_dict_puts.py 50000 1 4    # 50000 Containers for 1 and 4 threads.
+
+    Each run starts from an empty store and splits the puts evenly across the threads. It checks every put was
+    stored under a key of its own, so it also shows up writes lost to a race.
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_dict
+
+PUTS = 200000
+THREADS = (1, 2, 4, 8)
+
+
+def putContainers(count, keys):
+    for number in xrange(count):
+        container = data_dict.Container(active=bool(number % 2), contType=data_dict.ContentType.CLIMB)
+        keys.append(container.put())
+
+
+def run(puts, threads):
+    """ Seconds taken for threads to .put() puts Containers between them."""
+    data_dict.clear()
+    keys = [[] for unused in range(threads)]
+    workers = [threading.Thread(target=putContainers, args=(puts // threads, keys[thread]))
+               for thread in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    seconds = time.time() - start
+    stored = [key for threadKeys in keys for key in threadKeys]
+    expected = puts // threads * threads
+    if len(set(stored)) != expected or len(data_dict.gContainer) != expected:
+        raise AssertionError('%s threads stored %s of %s puts under %s keys.'
+                             % (threads, len(data_dict.gContainer), expected, len(set(stored))))
+    return seconds
+
+
+def main(args):
+    puts = int(args[0]) if args else PUTS
+    threads = map(int, args[1:]) or THREADS
+    print 'threads  puts/s'
+    for count in threads:
+        seconds = run(puts, count)
+        print '%7d  %6d' % (count, puts // count * count / seconds)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
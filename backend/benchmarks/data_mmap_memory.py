@@ -0,0 +1,112 @@
+""" Memory each worker needs to serve a tree from a data_mmap snapshot, against loading it into a plain dict.
+    eg. from backend/
+        python benchmarks/data_mmap_memory.py            # A tree of 200000 Containers.
+        python benchmarks/data_mmap_memory.py 50000
+
+    Each measurement is taken in a fresh process. Private memory is what every worker pays for itself, mostly the
+    indexes. The mapped file is kept once for all of the workers in the operating system's page cache.
+    Linux only, as it reads /proc/self/smaps.
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_dict
+import data_mmap
+
+CONTAINERS = 200000
+CHILDREN = 20    # Of each Container until the tree is big enough.
+
+
+def buildTree(count):
+    """ count Containers, each with a name, CHILDREN to a parent."""
+    root = data_dict.Container(key=data_dict.root_key, active=True, contType=data_dict.ContentType.ROOT,
+                               menuChildren=[])
+    parents = [root]
+    made = 1
+    while made < count:
+        parent = parents.pop(0)
+        for unused in range(min(CHILDREN, count - made)):
+            child = data_dict.Container(key=data_dict.DataStore.allocate_key(), active=bool(made % 2),
+                                        contType=data_dict.ContentType.CLIMB, menuParent=parent.key,
+                                        menuChildren=[], ancestors=list(parent.ancestors) + [parent.key])
+            name = data_dict.AttribName(key=data_dict.DataStore.allocate_key(), parent=child.key,
+                                        text='Container %s' % made)
+            child.attributes = [name.key]
+            parent.menuChildren.append(child.key)
+            data_dict.DataStore.put_multi([child, name])
+            parents.append(child)
+            made += 1
+        parent.put()
+
+
+def memory(path):
+    """ (kB resident in the calling process other than path, kB of path resident)."""
+    own = mapped = 0
+    inPath = False
+    with open('/proc/self/smaps') as smaps:
+        for line in smaps:
+            fields = line.split()
+            if not line[0].isupper():
+                # The start of a mapping: address range, permissions, offset, device, inode and maybe a path.
+                inPath = fields[-1] == path
+            elif fields[0] == 'Rss:':
+                if inPath:
+                    mapped += int(fields[1])
+                else:
+                    own += int(fields[1])
+    return own, mapped
+
+
+def measure(how, path):
+    """ Run in a fresh process: load the store at path how ('mmap' or 'dict') and print the memory it took."""
+    import cPickle as pickle
+    if how == 'dict':
+        with open(path + '.state', 'rb') as stateFile:
+            state = pickle.load(stateFile)
+    before, unused = memory(path)
+    start = time.time()
+    if how == 'mmap':
+        data_mmap.attach(path)
+    else:
+        data_dict.loadState(state)
+        del state
+    seconds = time.time() - start
+    own, mapped = memory(path)
+    indexes = 0
+    if how == 'mmap':
+        # What is left once the indexes are gone is the cost of the mapping itself.
+        for index in (data_dict.gChildren, data_dict.gParents, data_dict.gKinds, data_dict.gIndex,
+                      data_dict.gIndexed):
+            index.clear()
+        indexes = own - memory(path)[0]
+    print '%-5s %7.1f MB private (%.1f MB of it indexes) %6.1f MB of the mapped file %6.2fs to load' % (
+        how, (own - before) / 1024.0, indexes / 1024.0, mapped / 1024.0, seconds)
+
+
+def main(args):
+    if args and args[0] == 'measure':
+        return measure(args[1], args[2])
+    import cPickle as pickle
+    count = int(args[0]) if args else CONTAINERS
+    buildTree(count)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'tree.mmap')
+    data_mmap.writeSnapshot(path)
+    with open(path + '.state', 'wb') as stateFile:
+        pickle.dump(data_dict.dumpState(), stateFile, pickle.HIGHEST_PROTOCOL)
+    print '%s Containers, %s entities, snapshot file %.1f MB' % (
+        count, len(data_dict.gContainer), os.path.getsize(path) / 1024.0 / 1024.0)
+    for how in ('dict', 'mmap'):
+        subprocess.check_call([sys.executable, os.path.abspath(__file__), 'measure', how, path])
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
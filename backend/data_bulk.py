@@ -0,0 +1,203 @@
+""" Create a whole subtree of Containers and their names and descriptions at once.
+    eg.
+        loadTree([{'contType': ContentType.AREA, 'name': "Stanage", 'children': [
+                      {'contType': ContentType.CRAG, 'name': "Popular End", 'description': "Busy.", 'children': [
+                          {'contType': ContentType.CLIMB, 'name': "Flying Buttress"}]}]}],
+                 parentKey)
+
+    Element(menuParent=...) rewrites the parent for every child it creates. loadTree() allocates all the keys up
+    front, writes each new Container once with its final menuChildren and attributes, and writes everything in batches.
+    The existing parent is updated last, so a load that fails part way leaves nothing reachable from the tree.
+    Each Container's subtreeCounts are worked out from the nodes so they are also written once.
+
+    Each node is a dict of:
+        contType     Required.
+        name         Text of an AttribName. Optional.
+        description  Text of an AttribDescription. Optional.
+        active       Default False, as for Element.
+        children     List of nodes. Optional.
+"""
+import logging
+
+from google.appengine.api import users
+
+import data_dict
+
+BATCH = 500    # Entities written at a time.
+
+
+class DictLoader(object):
+    """ Creates the tree in data_dict."""
+    def allocateKeys(self, count):
+        return [data_dict.DataStore.allocate_key() for unused in xrange(count)]
+
+    def countSlot(self, node):
+        contType = node['contType']
+        if contType not in (data_dict.ContentType.ROOT, data_dict.ContentType.AREA, data_dict.ContentType.CRAG,
+                            data_dict.ContentType.CLIMB):
+            logging.error('Not a contType: %s' % contType)
+            raise TypeError
+        return data_dict.countSlot(contType, node.get('active', False))
+
+    def newContainer(self, key, node, menuParent, menuChildren, ancestors, subtreeCounts):
+        return data_dict.Container(key=key, active=node.get('active', False), contType=node['contType'],
+                                   menuParent=menuParent, menuChildren=menuChildren, ancestors=ancestors,
+                                   subtreeCounts=subtreeCounts)
+
+    def newAttrib(self, kind, parent, text, user):
+        return getattr(data_dict, kind)(key=data_dict.DataStore.allocate_key(), parent=parent, text=text,
+                                        authur=user)
+
+    def put_multi(self, entities):
+        return data_dict.DataStore.put_multi(entities)
+
+    def getParent(self, parentKey):
+        return checkParent(data_dict.DataStore(key=parentKey).get(), parentKey, data_dict.Container)
+
+    def addChildren(self, parentKey, childKeys, counts):
+        data_dict.transaction(lambda: self._addChildren(parentKey, childKeys, counts))
+
+    def _addChildren(self, parentKey, childKeys, counts):
+        parent = self.getParent(parentKey)
+        existing = set(parent.menuChildren)
+        parent.menuChildren.extend(key for key in childKeys if key not in existing)
+        delta = [count + change for count, change in zip(counts, data_dict.changeActive(parent, True))]
+        data_dict.addCounts(parent, counts)
+        data_dict.addSubtreeCountsOnCommit(parent.ancestors, delta)
+        parent.put()
+
+
+class NdbLoader(object):
+    """ Creates the tree in data_ndb."""
+    def __init__(self):
+        from google.appengine.ext import ndb
+        import data_ndb
+        self.ndb = ndb
+        self.models = data_ndb
+
+    def allocateKeys(self, count):
+        if not count:
+            return []
+        first, last = self.models.Container.allocate_ids(size=count)
+        return [self.ndb.Key(self.models.Container, number) for number in xrange(first, last + 1)]
+
+    def contType(self, node):
+        contType = node['contType']
+        if type(contType) in (int, long):
+            contType = self.models.Type(contType)
+        return contType
+
+    def countSlot(self, node):
+        return self.models.countSlot(self.contType(node), node.get('active', False))
+
+    def newContainer(self, key, node, menuParent, menuChildren, ancestors, subtreeCounts):
+        return self.models.Container(key=key, active=node.get('active', False), contType=self.contType(node),
+                                     menuParent=menuParent, menuChildren=menuChildren, ancestors=ancestors,
+                                     subtreeCounts=subtreeCounts)
+
+    def newAttrib(self, kind, parent, text, user):
+        # The datastore picks the id when it is written.
+        return getattr(self.models, kind)(parent=parent, text=text, authur=user)
+
+    def put_multi(self, entities):
+        return self.ndb.put_multi(entities)
+
+    def getParent(self, parentKey):
+        return checkParent(parentKey.get(), parentKey, self.models.Container)
+
+    def addChildren(self, parentKey, childKeys, counts):
+        self.ndb.transaction(lambda: self._addChildren(parentKey, childKeys, counts))
+
+    def _addChildren(self, parentKey, childKeys, counts):
+        parent = self.getParent(parentKey)
+        existing = set(parent.menuChildren)
+        parent.menuChildren.extend(key for key in childKeys if key not in existing)
+        self.models.addCounts(parent, counts)
+        self.models.addSubtreeCountsOnCommit(parent.ancestors, counts)
+        self.models.putMulti([parent])
+
+
+def checkParent(parent, parentKey, containerClass):
+    if type(parent) is not containerClass:
+        logging.error('Not a key: %s' % parentKey)
+        raise TypeError
+    return parent
+
+
+def loadTree(nodes, parentKey, loader=None, user=None, batchSize=BATCH):
+    """ Create nodes, and everything below them, as children of the existing Container parentKey.
+        loader is a DictLoader (the default) or NdbLoader. Attributes are by user, default the current user.
+        Returns the keys of nodes."""
+    if loader is None:
+        loader = DictLoader()
+    if user is None:
+        user = users.get_current_user()
+    # Fail before writing anything. The parent is read again when it is updated.
+    parent = loader.getParent(parentKey)
+
+    # Number the nodes depth first. parents[n] is the number of node n's parent, or None for one of nodes.
+    flat = []
+    parents = []
+    stack = [(node, None) for node in reversed(nodes)]
+    while stack:
+        node, parentNumber = stack.pop()
+        number = len(flat)
+        flat.append(node)
+        parents.append(parentNumber)
+        stack.extend((child, number) for child in reversed(node.get('children', ())))
+
+    keys = loader.allocateKeys(len(flat))
+    childKeys = [[] for unused in flat]
+    ancestors = []
+    for number, parentNumber in enumerate(parents):
+        if parentNumber is None:
+            ancestors.append(list(parent.ancestors) + [parentKey])
+        else:
+            childKeys[parentNumber].append(keys[number])
+            # Parents are numbered before their children.
+            ancestors.append(ancestors[parentNumber] + [keys[parentNumber]])
+
+    # subtreeCounts of each node, and topCounts for the parent's. Children are numbered after their parents so
+    # going backwards counts every child before its parent.
+    below = [[0] * data_dict.COUNT_SLOTS for unused in flat]
+    topCounts = [0] * data_dict.COUNT_SLOTS
+    for number in xrange(len(flat) - 1, -1, -1):
+        parentNumber = parents[number]
+        counts = topCounts if parentNumber is None else below[parentNumber]
+        for slot, count in enumerate(below[number]):
+            counts[slot] += count
+        counts[loader.countSlot(flat[number])] += 1
+
+    # Attributes first as the Containers need their keys.
+    attributes = []
+    owners = []
+    attributeKinds = [[] for unused in flat]
+    for number, node in enumerate(flat):
+        for kind, label in (('AttribName', 'name'), ('AttribDescription', 'description')):
+            if node.get(label) is not None:
+                attributes.append(loader.newAttrib(kind, keys[number], node[label], user))
+                owners.append(number)
+                attributeKinds[number].append(kind)
+    attributeKeys = [[] for unused in flat]
+    for start in xrange(0, len(attributes), batchSize):
+        written = loader.put_multi(attributes[start:start + batchSize])
+        for number, key in zip(owners[start:start + batchSize], written):
+            attributeKeys[number].append(key)
+
+    for start in xrange(0, len(flat), batchSize):
+        containers = []
+        for number in xrange(start, min(start + batchSize, len(flat))):
+            parentNumber = parents[number]
+            container = loader.newContainer(keys[number], flat[number],
+                                            parentKey if parentNumber is None else keys[parentNumber],
+                                            childKeys[number], ancestors[number], below[number])
+            container.attributes = attributeKeys[number]
+            # One of each kind at most and none of them active.
+            container.attribKinds = attributeKinds[number]
+            container.attribCounts = [1] * len(attributeKinds[number])
+            containers.append(container)
+        loader.put_multi(containers)
+
+    topKeys = [key for key, parentNumber in zip(keys, parents) if parentNumber is None]
+    loader.addChildren(parentKey, topKeys, topCounts)
+    return topKeys
@@ -0,0 +1,194 @@
+""" Read-through cache of encoded entities in two tiers: an LRU in this process and a shared tier, memcache on
+    App Engine. Off until enable() is called.
+    eg.
+        cache = enable(capacity=1000, ttl=30)    # or enable(shared=MemcacheTier())
+        ...
+        values = cache.get_multi(['a', 'b'], fetch)    # fetch(missing keys) -> {key: value}
+        cache.invalidate(['a'])
+        print cache.stats.hitRate()
+
+    Keys are strings and values are whatever the caller encoded, normally bytes, so a value is copied every time it
+    is read and no caller can change another's entity.
+    invalidate() only reaches this process and the shared tier. Other processes' LRUs may keep a value for up to
+    ttl seconds after it was written, so only cache reads that can be that stale, eg. eventually consistent ones.
+    Values fetched are only added to the shared tier if nothing is there, and invalidate() locks keys against adds
+    for lockSeconds, so a value another process fetched before a write can't be put back after it.
+"""
+import collections
+import threading
+import time
+
+gCache = None    # The enabled TieredCache, or None.
+
+
+LOCK_SECONDS = 10    # Longest a fetch is expected to take. See TieredCache.invalidate()
+
+
+def enable(capacity=1000, ttl=30, shared=None, lockSeconds=LOCK_SECONDS):
+    """ Start caching. shared is a MemcacheTier, a DictTier or None for the LRU alone. Returns the new TieredCache."""
+    global gCache
+    gCache = TieredCache(LruTier(capacity, ttl), shared, ttl, lockSeconds)
+    return gCache
+
+
+def disable():
+    """ Stop caching. The TieredCache that was enabled keeps its statistics."""
+    global gCache
+    gCache = None
+
+
+class Stats(object):
+    """ How reads were answered."""
+    def __init__(self):
+        self.localHits = 0
+        self.sharedHits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def hitRate(self):
+        reads = self.localHits + self.sharedHits + self.misses
+        return float(self.localHits + self.sharedHits) / reads if reads else 0.0
+
+    def to_dict(self):
+        return {'localHits': self.localHits, 'sharedHits': self.sharedHits, 'misses': self.misses,
+                'invalidations': self.invalidations, 'hitRate': self.hitRate()}
+
+
+class LruTier(object):
+    """ The capacity most recently used values in this process, each kept for at most ttl seconds."""
+    def __init__(self, capacity=1000, ttl=30, clock=time.time):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = collections.OrderedDict()    # {key: (expires, value)}, least recently used first.
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get_multi(self, keys):
+        found = {}
+        now = self.clock()
+        with self.lock:
+            for key in keys:
+                entry = self.entries.pop(key, None)
+                if entry is not None and entry[0] > now:
+                    # Put back as the most recently used.
+                    self.entries[key] = entry
+                    found[key] = entry[1]
+        return found
+
+    def set_multi(self, mapping):
+        expires = self.clock() + self.ttl
+        with self.lock:
+            for key, value in mapping.iteritems():
+                self.entries.pop(key, None)
+                self.entries[key] = (expires, value)
+            while len(self.entries) > self.capacity:
+                self.entries.popitem(last=False)
+
+    def delete_multi(self, keys):
+        with self.lock:
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class DictTier(object):
+    """ Stand in for MemcacheTier with the same methods, shared by everything in this process.
+        Values don't expire."""
+    def __init__(self, clock=time.time):
+        self.entries = {}
+        self.locked = {}    # {key: time adds are refused until}
+        self.clock = clock
+
+    def get_multi(self, keys):
+        return dict((key, self.entries[key]) for key in keys if key in self.entries)
+
+    def set_multi(self, mapping, ttl=0):
+        self.entries.update(mapping)
+
+    def add_multi(self, mapping, ttl=0):
+        """ set_multi() of the keys that aren't there or locked."""
+        now = self.clock()
+        for key, value in mapping.iteritems():
+            if key not in self.entries and self.locked.get(key, 0) <= now:
+                self.entries[key] = value
+
+    def delete_multi(self, keys, seconds=0):
+        """ Delete keys and refuse to add them for seconds."""
+        until = self.clock() + seconds
+        for key in keys:
+            self.entries.pop(key, None)
+            if seconds:
+                self.locked[key] = until
+
+
+class MemcacheTier(object):
+    """ App Engine memcache, shared by every instance."""
+    def __init__(self, namespace='data_cache'):
+        from google.appengine.api import memcache
+        self.memcache = memcache
+        self.namespace = namespace
+
+    def get_multi(self, keys):
+        return self.memcache.get_multi(keys, namespace=self.namespace)
+
+    def set_multi(self, mapping, ttl=0):
+        self.memcache.set_multi(mapping, time=ttl, namespace=self.namespace)
+
+    def add_multi(self, mapping, ttl=0):
+        self.memcache.add_multi(mapping, time=ttl, namespace=self.namespace)
+
+    def delete_multi(self, keys, seconds=0):
+        self.memcache.delete_multi(keys, seconds=seconds, namespace=self.namespace)
+
+
+class TieredCache(object):
+    """ Reads through local, then shared, then the caller's fetch()."""
+    def __init__(self, local, shared=None, ttl=30, lockSeconds=LOCK_SECONDS):
+        self.local = local
+        self.shared = shared
+        self.ttl = ttl
+        self.lockSeconds = lockSeconds
+        self.stats = Stats()
+        self.generation = 0    # Number of invalidate() calls.
+
+    def get_multi(self, keys, fetch):
+        """ {key: value} for keys. Ones in neither tier come from fetch(missing keys), which returns {key: value}
+            and leaves out keys that don't exist. Those aren't cached."""
+        found = self.local.get_multi(keys)
+        self.stats.localHits += len(found)
+        missing = [key for key in keys if key not in found]
+        if missing and self.shared is not None:
+            shared = self.shared.get_multi(missing)
+            self.stats.sharedHits += len(shared)
+            self.local.set_multi(shared)
+            found.update(shared)
+            missing = [key for key in missing if key not in shared]
+        if missing:
+            self.stats.misses += len(missing)
+            generation = self.generation
+            fetched = fetch(missing)
+            # Something written while fetching might have been read before the write. Don't keep it.
+            # The shared tier refuses it too when the write was in another process. See invalidate()
+            if self.generation == generation:
+                self.local.set_multi(fetched)
+                if self.shared is not None:
+                    self.shared.add_multi(fetched, self.ttl)
+            found.update(fetched)
+        return found
+
+    def invalidate(self, keys):
+        """ Drop keys from both tiers, eg. after they were written.
+            The shared tier won't take them back for lockSeconds, so a fetch from before the write that finishes
+            after it can't leave the old value there for every process to read."""
+        keys = list(keys)
+        self.generation += 1
+        self.stats.invalidations += len(keys)
+        self.local.delete_multi(keys)
+        if self.shared is not None:
+            self.shared.delete_multi(keys, self.lockSeconds)
@@ -0,0 +1,399 @@
+""" Compact binary encoding of data_dict entities, for snapshots, logs and passing entities between processes.
+    eg.
+        data = encode(entity)
+        copied = decode(data)
+
+        data = encodeMulti(entities)
+        copied = decodeMulti(data)
+
+    The layout of each class is worked out once from its descriptors (see Schema) so encoding is mostly struct calls.
+    Entities are decoded without being validated so only decode data that was made by encode().
+    Data from an older VERSION still decodes, with the changes since then undone as CHANGES describes.
+
+    All little endian:
+        encode():      VERSION (unsigned 8 bit), class name, body
+        encodeMulti(): VERSION, number of classes (unsigned 32 bit), class names, number of entities (unsigned 32 bit),
+                       then for each: class number (unsigned 32 bit), body
+        body:          key, parent, the fixed width descriptors packed together, the others one at a time,
+                       ad hoc attributes pickled.
+    Descriptors are in label order within each group.
+    A string is an unsigned 32 bit length followed by the bytes; a length of NONE_LENGTH is None.
+    Repeated values are their number (unsigned 32 bit) followed by the items, except:
+        StringProperty: STRINGS or KEYS (unsigned 8 bit). KEYS is followed by the key numbers as signed 64 bit,
+                        data_dict.ROOT_NUMBER for the root key.
+        BooleanProperty: number of items then the bits, first item lowest, as big endian bytes.
+"""
+import array
+import binascii
+import cPickle as pickle
+import datetime
+import operator
+import struct
+
+from google.appengine.api import users
+
+import data_dict
+
+VERSION = 3
+BYTE = struct.Struct('<B')
+LENGTH = struct.Struct('<I')
+NONE_LENGTH = 0xffffffff
+BOOL_NONE = 2
+ENUM_NONE = -2 ** 31
+DATETIME_NONE = -2 ** 63    # Otherwise microseconds since EPOCH.
+INTEGER_NONE = -2 ** 63    # So IntegerProperty can't hold this.
+STRINGS = 0
+KEYS = 1
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def encodeString(value):
+    if value is None:
+        return LENGTH.pack(NONE_LENGTH)
+    return LENGTH.pack(len(value)) + value
+
+
+def decodeString(buf, offset):
+    length, = LENGTH.unpack_from(buf, offset)
+    offset += LENGTH.size
+    if length == NONE_LENGTH:
+        return None, offset
+    return buf[offset:offset + length], offset + length
+
+
+def encodeUser(value):
+    if value is None:
+        return encodeString(None)
+    return encodeString(value.email()) + encodeString(value.auth_domain()) + encodeString(value.user_id())
+
+
+def decodeUser(buf, offset):
+    email, offset = decodeString(buf, offset)
+    if email is None:
+        return None, offset
+    authDomain, offset = decodeString(buf, offset)
+    userId, offset = decodeString(buf, offset)
+    return users.User(email=email, _auth_domain=authDomain, _user_id=userId), offset
+
+
+def decodeUserV1(buf, offset):
+    """ Version 1 had no auth domain. users.User() fills in the current one."""
+    email, offset = decodeString(buf, offset)
+    if email is None:
+        return None, offset
+    userId, offset = decodeString(buf, offset)
+    return users.User(email=email, _user_id=userId), offset
+
+
+def boolToRaw(value):
+    return BOOL_NONE if value is None else int(value)
+
+
+def boolFromRaw(value):
+    return None if value == BOOL_NONE else bool(value)
+
+
+def integerToRaw(value):
+    return INTEGER_NONE if value is None else value
+
+
+def integerFromRaw(value):
+    return None if value == INTEGER_NONE else value
+
+
+def enumToRaw(value):
+    return ENUM_NONE if value is None else value
+
+
+def enumFromRaw(value):
+    return None if value == ENUM_NONE else value
+
+
+def dateTimeToRaw(value):
+    if value is None:
+        return DATETIME_NONE
+    delta = value - EPOCH
+    return (delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds
+
+
+def dateTimeFromRaw(value):
+    if value == DATETIME_NONE:
+        return None
+    return EPOCH + datetime.timedelta(microseconds=value)
+
+
+def encodeStrings(values):
+    items = values.items if type(values) is data_dict.AllProperties.ListValue else values
+    if type(items) is array.array:
+        return BYTE.pack(KEYS) + LENGTH.pack(len(items)) + struct.pack('<%sq' % len(items), *items)
+    return BYTE.pack(STRINGS) + LENGTH.pack(len(items)) + ''.join(map(encodeString, items))
+
+
+def decodeStrings(buf, offset):
+    """ (storage for a ListValue, offset)"""
+    kind, = BYTE.unpack_from(buf, offset)
+    length, = LENGTH.unpack_from(buf, offset + BYTE.size)
+    offset += BYTE.size + LENGTH.size
+    if kind == KEYS:
+        numbers = array.array('l', struct.unpack_from('<%sq' % length, buf, offset))
+        return numbers, offset + length * 8
+    items = []
+    for unused in xrange(length):
+        item, offset = decodeString(buf, offset)
+        items.append(intern(item))
+    return items, offset
+
+
+def encodeBools(values):
+    items = values.items if type(values) is data_dict.AllProperties.ListValue else data_dict.BitList(values)
+    size = (items.length + 7) // 8
+    packed = binascii.unhexlify('%0*x' % (size * 2, items.bits)) if size else ''
+    return LENGTH.pack(items.length) + packed
+
+
+def decodeBools(buf, offset):
+    length, = LENGTH.unpack_from(buf, offset)
+    offset += LENGTH.size
+    size = (length + 7) // 8
+    items = data_dict.BitList()
+    items.length = length
+    if size:
+        items.bits = int(binascii.hexlify(buf[offset:offset + size]), 16)
+    return items, offset + size
+
+
+class Codec(object):
+    """ How the values of one kind of descriptor are encoded.
+        Fixed width values are converted to a number by toRaw() and packed with struct format fmt.
+        Others are encoded by encode(value) and decoded by decode(buf, offset) -> (value, offset)."""
+    def __init__(self, fmt=None, toRaw=None, fromRaw=None, encode=None, decode=None,
+                 encodeRepeated=None, decodeRepeated=None):
+        self.fmt = fmt
+        self.toRaw = toRaw
+        self.fromRaw = fromRaw
+        if fmt is not None:
+            packer = struct.Struct('<' + fmt)
+            encode = lambda value: packer.pack(toRaw(value))
+            decode = lambda buf, offset: (fromRaw(packer.unpack_from(buf, offset)[0]), offset + packer.size)
+            encodeRepeated = encodeRepeated or self.encodeFixedItems
+            decodeRepeated = decodeRepeated or self.decodeFixedItems
+        self.encode = encode
+        self.decode = decode
+        self.encodeRepeated = encodeRepeated or self.encodeItems
+        self.decodeRepeated = decodeRepeated or self.decodeItems
+
+    def encodeFixedItems(self, values):
+        return LENGTH.pack(len(values)) + struct.pack('<%s%s' % (len(values), self.fmt), *map(self.toRaw, values))
+
+    def decodeFixedItems(self, buf, offset):
+        length, = LENGTH.unpack_from(buf, offset)
+        offset += LENGTH.size
+        fmt = '<%s%s' % (length, self.fmt)
+        return map(self.fromRaw, struct.unpack_from(fmt, buf, offset)), offset + struct.calcsize(fmt)
+
+    def encodeItems(self, values):
+        return LENGTH.pack(len(values)) + ''.join(map(self.encode, values))
+
+    def decodeItems(self, buf, offset):
+        length, = LENGTH.unpack_from(buf, offset)
+        offset += LENGTH.size
+        items = []
+        for unused in xrange(length):
+            item, offset = self.decode(buf, offset)
+            items.append(item)
+        return items, offset
+
+
+CODECS = {data_dict.BooleanProperty: Codec('B', boolToRaw, boolFromRaw,
+                                           encodeRepeated=encodeBools, decodeRepeated=decodeBools),
+          data_dict.IntegerProperty: Codec('q', integerToRaw, integerFromRaw),
+          data_dict.EnumProperty: Codec('i', enumToRaw, enumFromRaw),
+          data_dict.StringProperty: Codec(encode=encodeString, decode=decodeString,
+                                          encodeRepeated=encodeStrings, decodeRepeated=decodeStrings),
+          data_dict.UserProperty: Codec(encode=encodeUser, decode=decodeUser),
+          data_dict.DateTimeProperty: Codec('q', dateTimeToRaw, dateTimeFromRaw)}
+
+# {version: ({descriptor type: its Codec before version}, {class name: labels of the descriptors added in version})}
+# Bodies from before version don't have the added descriptors so they decode with their defaults.
+CHANGES = {2: ({data_dict.UserProperty: Codec(decode=decodeUserV1)},
+               {'Container': ('activeAttribs', 'activeKinds', 'ancestors', 'attribCounts', 'attribKinds',
+                              'subtreeCounts')})}
+
+
+def codecFor(cls, label, descriptor, codecs=CODECS):
+    for base in type(descriptor).__mro__:
+        if base in codecs:
+            return codecs[base]
+    raise TypeError('No encoding for %s.%s' % (cls.__name__, label))
+
+
+def layout(cls, version=VERSION):
+    """ ([(label, descriptor, codec) of the fixed width descriptors], [the same for the others]) in bodies of cls
+        encoded by version."""
+    codecs = dict(CODECS)
+    added = set()
+    for newer in sorted(CHANGES, reverse=True):
+        if newer > version:
+            oldCodecs, addedLabels = CHANGES[newer]
+            codecs.update(oldCodecs)
+            added.update(addedLabels.get(cls.__name__, ()))
+    fixed = []
+    variable = []
+    for label, descriptor in sorted(cls._properties.items()):
+        if label in added:
+            continue
+        codec = codecFor(cls, label, descriptor, codecs)
+        if codec.fmt is not None and not descriptor.repeated:
+            fixed.append((label, descriptor, codec))
+        else:
+            variable.append((label, descriptor, codec))
+    return fixed, variable
+
+
+def decoders(fixed, variable):
+    """ (struct of the fixed width values, [(store, fromRaw) for each], [(store, decode, repeated descriptor or None)
+        for each of the others]) for a layout()."""
+    return (struct.Struct('<' + ''.join(codec.fmt for label, descriptor, codec in fixed)),
+            [(setter(descriptor), codec.fromRaw) for label, descriptor, codec in fixed],
+            [(setter(descriptor), codec.decodeRepeated if descriptor.repeated else codec.decode,
+              descriptor if descriptor.repeated else None)
+             for label, descriptor, codec in variable])
+
+
+class Schema(object):
+    """ Encodes and decodes the body of entities of one class."""
+    def __init__(self, cls):
+        self.cls = cls
+        fixed, variable = layout(cls)
+        self.fixedGet = [(operator.attrgetter(label), codec.toRaw) for label, descriptor, codec in fixed]
+        self.variableGet = [(operator.attrgetter(label), codec.encodeRepeated if descriptor.repeated else codec.encode)
+                            for label, descriptor, codec in variable]
+        self.fixed, self.fixedSet, self.variableSet = decoders(fixed, variable)
+        self.olderDecoders = {}    # {version: decoders() for bodies encoded by that older version}
+
+    def encode(self, entity):
+        parts = [encodeString(entity.key), encodeString(getattr(entity, 'parent', None)),
+                 self.fixed.pack(*[toRaw(get(entity)) for get, toRaw in self.fixedGet])]
+        for get, encoder in self.variableGet:
+            parts.append(encoder(get(entity)))
+        extras = dict((k, v) for k, v in getattr(entity, '__dict__', {}).iteritems() if k not in ('key', 'parent'))
+        if extras:
+            parts.append(encodeString(pickle.dumps(extras, pickle.HIGHEST_PROTOCOL)))
+        else:
+            parts.append(encodeString(None))
+        return ''.join(parts)
+
+    def decode(self, buf, offset, version=VERSION):
+        """ (entity, offset of the end of its body)"""
+        if version == VERSION:
+            fixed, fixedSet, variableSet = self.fixed, self.fixedSet, self.variableSet
+        else:
+            fixed, fixedSet, variableSet = self.older(version)
+        cls = self.cls
+        entity = cls.__new__(cls)
+        entity.key, offset = decodeString(buf, offset)
+        entity.parent, offset = decodeString(buf, offset)
+        raw = fixed.unpack_from(buf, offset)
+        offset += fixed.size
+        for (store, fromRaw), value in zip(fixedSet, raw):
+            store(entity, fromRaw(value))
+        for store, decoder, repeated in variableSet:
+            value, offset = decoder(buf, offset)
+            if repeated is not None:
+                value = data_dict.restoreListValue(repeated, value)
+            store(entity, value)
+        extras, offset = decodeString(buf, offset)
+        if extras is not None:
+            entity.__dict__.update(pickle.loads(extras))
+        return entity, offset
+
+    def older(self, version):
+        try:
+            return self.olderDecoders[version]
+        except KeyError:
+            return self.olderDecoders.setdefault(version, decoders(*layout(self.cls, version)))
+
+
+def setter(descriptor):
+    """ Stores a value for descriptor, without checking it if the class uses __slots__."""
+    if descriptor.slot is not None:
+        return descriptor.slot.__set__
+    return descriptor.__set__
+
+
+gSchemas = {}    # {class: Schema}
+
+
+def schema(cls):
+    try:
+        return gSchemas[cls]
+    except KeyError:
+        # Two threads may both build one. Either will do.
+        return gSchemas.setdefault(cls, Schema(cls))
+
+
+def classNamed(name):
+    cls = getattr(data_dict, name, None)
+    if not isinstance(cls, data_dict.DescriptorOwner):
+        raise TypeError('%s is not a data_dict class.' % name)
+    return cls
+
+
+def checkClass(cls):
+    if getattr(data_dict, cls.__name__, None) is not cls:
+        raise TypeError('Only data_dict classes can be encoded, not %s' % cls)
+
+
+def encode(entity):
+    cls = type(entity)
+    checkClass(cls)
+    return BYTE.pack(VERSION) + encodeString(cls.__name__) + schema(cls).encode(entity)
+
+
+def decode(data):
+    version = checkVersion(data)
+    name, offset = decodeString(data, BYTE.size)
+    return schema(classNamed(name)).decode(data, offset, version)[0]
+
+
+def encodeMulti(entities):
+    classNumbers = {}
+    names = []
+    bodies = []
+    for entity in entities:
+        cls = type(entity)
+        number = classNumbers.get(cls)
+        if number is None:
+            checkClass(cls)
+            number = classNumbers[cls] = len(names)
+            names.append(encodeString(cls.__name__))
+        bodies.append(LENGTH.pack(number) + schema(cls).encode(entity))
+    return ''.join([BYTE.pack(VERSION), LENGTH.pack(len(names))] + names + [LENGTH.pack(len(bodies))] + bodies)
+
+
+def decodeMulti(data):
+    version = checkVersion(data)
+    offset = BYTE.size
+    count, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    schemas = []
+    for unused in xrange(count):
+        name, offset = decodeString(data, offset)
+        schemas.append(schema(classNamed(name)))
+    count, = LENGTH.unpack_from(data, offset)
+    offset += LENGTH.size
+    entities = []
+    for unused in xrange(count):
+        number, = LENGTH.unpack_from(data, offset)
+        entity, offset = schemas[number].decode(data, offset + LENGTH.size, version)
+        entities.append(entity)
+    return entities
+
+
+def checkVersion(data):
+    """ The version data was encoded with, if this one can decode it."""
+    version, = BYTE.unpack_from(data, 0)
+    if not 1 <= version <= VERSION:
+        raise ValueError('Encoded with version %s, not 1 to %s.' % (version, VERSION))
+    return version
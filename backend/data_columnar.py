@@ -0,0 +1,164 @@
+""" Optional column store of the data_dict Containers for whole tree reports.
+    Needs numpy. eg.
+        table = ContainerTable()
+        table.attach()    # Load gContainer and follow every .put() from now on.
+        table.countByType(active=True)
+"""
+from types import *
+import logging
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import data_dict
+
+
+class ContainerTable(object):
+    """ Every Container as a row across numpy arrays:
+            active:     bool
+            contType:   int8, the ContentType value or 0 if unset.
+            menuParent: int32, the row of the parent Container or -1 if there isn't one.
+            present:    bool, False for deleted Containers and parents that haven't been .put() yet.
+        Rows are never re-used so row numbers stay valid in menuParent.
+    """
+    def __init__(self, capacity=1024):
+        if numpy is None:
+            raise ImportError('ContainerTable needs numpy.')
+        self.lock = threading.Lock()    # Held while updating, as puts of different keys can run at the same time.
+        self._reset(capacity)
+
+    def _reset(self, capacity):
+        self.rows = {}    # {key: row}
+        self.keys = []    # Key of each row.
+        self.active = numpy.zeros(capacity, dtype=numpy.bool_)
+        self.contType = numpy.zeros(capacity, dtype=numpy.int8)
+        self.menuParent = numpy.empty(capacity, dtype=numpy.int32)
+        self.menuParent.fill(-1)
+        self.present = numpy.zeros(capacity, dtype=numpy.bool_)
+
+    def __len__(self):
+        return int(numpy.count_nonzero(self.present[:len(self.keys)]))
+
+    def attach(self):
+        """ Load the Containers already in gContainer and keep up to date with .put() and .delete() .
+            gWriteLock is held meanwhile so no write can land between the load and the listener being added."""
+        with data_dict.gWriteLock:
+            self.load()
+            data_dict.addListener(self.update)
+
+    def detach(self):
+        data_dict.removeListener(self.update)
+
+    def load(self):
+        """ Replace the table with the Containers in gContainer."""
+        with self.lock:
+            self._reset(len(self.active))
+            for key, entity in data_dict.gContainer.items():
+                self._update(key, entity)
+
+    def update(self, key, entity):
+        """ Listener for data_dict.gListeners ."""
+        with self.lock:
+            self._update(key, entity)
+
+    def _update(self, key, entity):
+        if key is None:
+            # The whole store was cleared.
+            self._reset(len(self.active))
+            return
+        if entity is None or type(entity) is not data_dict.Container:
+            if key in self.rows:
+                row = self.rows[key]
+                self.present[row] = False
+                self.active[row] = False
+                self.contType[row] = 0
+                self.menuParent[row] = -1
+            return
+
+        row = self.row(key)
+        self.present[row] = True
+        self.active[row] = bool(entity.active)
+        self.contType[row] = entity.contType or 0
+        if entity.menuParent is None:
+            self.menuParent[row] = -1
+        else:
+            self.menuParent[row] = self.row(entity.menuParent)
+
+    def row(self, key):
+        """ Row of key, allocating one if key hasn't been seen before."""
+        row = self.rows.get(key)
+        if row is None:
+            row = len(self.keys)
+            if row == len(self.active):
+                self._grow(2 * row)
+            self.rows[key] = row
+            self.keys.append(key)
+        return row
+
+    def _grow(self, capacity):
+        extra = capacity - len(self.active)
+        self.active = numpy.concatenate((self.active, numpy.zeros(extra, dtype=numpy.bool_)))
+        self.contType = numpy.concatenate((self.contType, numpy.zeros(extra, dtype=numpy.int8)))
+        menuParent = numpy.empty(extra, dtype=numpy.int32)
+        menuParent.fill(-1)
+        self.menuParent = numpy.concatenate((self.menuParent, menuParent))
+        self.present = numpy.concatenate((self.present, numpy.zeros(extra, dtype=numpy.bool_)))
+
+    def mask(self, active=None, contType=None):
+        """ Bool array of the rows matching active and contType, which may be a single ContentType or a list."""
+        size = len(self.keys)
+        mask = self.present[:size].copy()
+        if active is not None:
+            if active:
+                mask &= self.active[:size]
+            else:
+                mask &= ~self.active[:size]
+        if contType is not None:
+            if type(contType) is ListType:
+                mask &= numpy.in1d(self.contType[:size], contType)
+            else:
+                mask &= self.contType[:size] == contType
+        return mask
+
+    def select(self, active=None, contType=None):
+        """ Keys of the Containers matching active and contType."""
+        return [self.keys[row] for row in numpy.flatnonzero(self.mask(active, contType))]
+
+    def count(self, active=None, contType=None):
+        return int(numpy.count_nonzero(self.mask(active, contType)))
+
+    def countByType(self, active=None):
+        """ {ContentType: number of Containers} """
+        size = len(self.keys)
+        counts = numpy.bincount(self.contType[:size][self.mask(active)])
+        return dict((contType, int(count)) for contType, count in enumerate(counts) if count)
+
+    def activeInTree(self):
+        """ Bool array of the rows that are active and whose ancestors are all active too.
+            Takes one vectorized pass per level of the tree."""
+        size = len(self.keys)
+        menuParent = self.menuParent[:size]
+        hasParent = numpy.flatnonzero(menuParent >= 0)
+        parents = menuParent[hasParent]
+        visible = self.active[:size] & self.present[:size]
+        while True:
+            nextVisible = visible.copy()
+            nextVisible[hasParent] &= visible[parents]
+            if numpy.array_equal(nextVisible, visible):
+                return visible
+            visible = nextVisible
+
+    def inactiveSubtrees(self):
+        """ Keys of the Containers that are hidden, either by being inactive or by having an inactive ancestor,
+            but whose parent is visible. ie. the roots of the hidden parts of the tree."""
+        size = len(self.keys)
+        visible = self.activeInTree()
+        menuParent = self.menuParent[:size]
+        parentVisible = numpy.ones(size, dtype=numpy.bool_)
+        hasParent = numpy.flatnonzero(menuParent >= 0)
+        parentVisible[hasParent] = visible[menuParent[hasParent]]
+        roots = self.present[:size] & ~visible & parentVisible
+        return [self.keys[row] for row in numpy.flatnonzero(roots)]
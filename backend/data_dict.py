@@ -2,14 +2,621 @@ from google.appengine.ext import ndb    # For converting keys.
 from google.appengine.api import users
 
 from types import *
+import array
+import contextlib
+import datetime
+import functools
+import gc
+import heapq
+import itertools
 import logging
+import math
+import operator
+import random
+import sys
+import threading
+
+import data_session
+import data_trace
 
 gContainer = {}
-gKeyCounter = 0
+gKeyCounter = 0   # Highest key number reserved by any thread. See allocateKey().
+gChildren = {}    # {parent key: set(child keys)} for every entity stored with a parent=.
+gParents = {}     # {key: parent key} as it was when the entity was last .put().
+gKinds = {}       # {kind name: set(keys)} The set stays when the last key of a kind is deleted.
+gIndex = {}       # {(kind name, property label): {value: set(keys)}} for properties declared indexed=True.
+gIndexed = {}     # {key: (kind name, indexed labels, values)} as they were when the entity was last .put().
+                  # Values of repeated properties are frozensets.
+gListeners = ()   # Called as listener(key, entity) after .put(), listener(key, None) after .delete()
+                  # and listener(None, None) after clear(). Calls for the same key are made one at a time and in order
+                  # but listeners that share state between keys need their own lock.
+gCommitListeners = ()    # Called as listener(items) once per write with every (key, entity or None) it stored,
+                         # and listener([(None, None)]) after clear(). Made in the same order as the writes.
+                         # Every item has been stored before any listener is called. See notifyListeners().
+                         # Both are tuples, replaced rather than changed by addListener() and removeListener(),
+                         # so a write in another thread always sees a whole one.
+gListenerLock = threading.Lock()
+
+KEY_BLOCK = 1000      # Key numbers a thread reserves from gKeyCounter at a time.
+gKeyLock = threading.Lock()     # Only taken to reserve a block of keys.
+gKeyBlocks = threading.local()  # .next and .end of the calling thread's block and the .generation it was reserved in.
+gKeyGeneration = 0              # Incremented whenever gKeyCounter is reset so reserved blocks are abandoned.
+gWriteLock = threading.Lock()
+                  # Held for the whole of every write, and by anything that needs the store to stand still.
+                  # One lock rather than one per key: the GIL runs the writes one at a time anyway and working out
+                  # finer grained locks cost more than they saved. See benchmarks/data_dict_puts.py .
+                  # Not reentrant, so listeners mustn't .put() or .delete() .
+
+# Every write is given a version number. Transactions read the store as it was at a version. See Transaction.
+HISTORY_SWEEP = 10000   # Sweep gHistory for versions no transaction needs once it holds this many keys.
+gHistory = {}           # {key: [(version, entity or None, version it was replaced at)]} oldest first.
+                        # Values that were overwritten or deleted but may still be read by a transaction.
+gCommitLock = threading.Lock()  # Only held to number commits and open snapshots.
+gCommitIssued = 0       # Highest version handed out.
+gCommitPending = set()  # Versions still being written.
+gSnapshots = {}         # {version: number of open transactions reading it}
+gTransaction = threading.local()    # .current Transaction of the calling thread.
 
 root_key = 'dct_root'
 
 
+def clear():
+    with gWriteLock:
+        gContainer.clear()
+        gChildren.clear()
+        gParents.clear()
+        gKinds.clear()
+        gIndex.clear()
+        gIndexed.clear()
+        gHistory.clear()
+        resetKeys(0)
+        notifyListeners([(None, None)])
+
+
+def useContainer(container, keyCounter=0):
+    """ Keep entities in container, which can be any mapping, rather than a dict. eg. data_mmap.MappedContainer
+        The indexes are rebuilt from what is already in container."""
+    global gContainer
+    clear()
+    gContainer = container
+    resetKeys(keyCounter)
+    with gWriteLock, gcPaused():
+        for key, entity in container.iteritems():
+            indexParent(key, getattr(entity, 'parent', None))
+            indexProperties(key, entity)
+        if gListeners or gCommitListeners:
+            notifyListeners(container.items())
+
+
+STATE_VERSION = 1
+
+
+def dumpState(version=None):
+    """ Everything needed to recreate the store as plain lists and dicts that pickle quickly. See loadState().
+        (STATE_VERSION, gKeyCounter, [dumpEntities() for each kind], {(kind name, label): {value: [keys]}})
+        Given a version from openSnapshot(), the store as it was then. No locks are taken so writers carry on
+        while it is copied. Otherwise gWriteLock is held for the whole copy."""
+    with gcPaused():
+        if version is not None:
+            kinds = _dumpKinds(snapshotEntities(version))
+            index = indexKinds(kinds)
+        else:
+            with gWriteLock:
+                kinds = _dumpKinds(gContainer.itervalues())
+                index = dict((name, dict((value, list(keys)) for value, keys in values.iteritems()))
+                             for name, values in gIndex.iteritems())
+    return (STATE_VERSION, gKeyCounter, kinds, index)
+
+
+def _dumpKinds(entities):
+    byClass = {}
+    for entity in entities:
+        byClass.setdefault(type(entity), []).append(entity)
+    return [dumpEntities(cls, entities) for cls, entities in byClass.iteritems()]
+
+
+def snapshotEntities(version):
+    """ Every entity stored at version, from openSnapshot(). Takes no locks.
+        gContainer is read before gHistory: anything deleted since version was added to gHistory before it was
+        removed from gContainer, so it is in one or the other."""
+    keys = set(gContainer.keys())
+    keys.update(gHistory.keys())
+    return [entity for entity in itertools.imap(snapshotGet, keys, itertools.repeat(version)) if entity is not None]
+
+
+def indexKinds(kinds):
+    """ {(kind name, label): {value: [keys]}} as gIndex would be for the entities dumped in kinds."""
+    index = {}
+    for cls, keys, parents, extras, columns in kinds:
+        for label, values in columns:
+            descriptor = cls._properties[label]
+            if not descriptor.indexed:
+                continue
+            byValue = index.setdefault((cls.__name__, label), {})
+            if not descriptor.repeated:
+                for key, value in itertools.izip(keys, values):
+                    byValue.setdefault(value, []).append(key)
+                continue
+            for key, storage in itertools.izip(keys, values):
+                items = descriptor.default if storage is None else restoreListValue(descriptor, storage)
+                for item in set(items):
+                    byValue.setdefault(item, []).append(key)
+    return index
+
+
+def loadState(state):
+    """ Replace the store with one from dumpState(). Listeners see a clear() followed by a .put() of every entity."""
+    version, keyCounter, kinds, index = state
+    if version != STATE_VERSION:
+        raise ValueError('Unknown state version: %s' % version)
+    clear()
+    with gWriteLock:
+        with gcPaused():
+            _loadKinds(kinds, index)
+        resetKeys(keyCounter)
+        if gListeners or gCommitListeners:
+            notifyListeners(gContainer.items())
+
+
+def _loadKinds(kinds, index):
+    for dumped in kinds:
+        cls, keys, parents = dumped[:3]
+        entities, columns = loadEntities(dumped)
+        gContainer.update(itertools.izip(keys, entities))
+
+        # Rebuild the indexes from the columns rather than entity by entity.
+        kind = cls.__name__
+        gKinds[kind] = set(keys)
+        labels = getattr(cls, '_indexed', ())
+        if labels:
+            indexed = [[frozenset(cls._properties[label].default if value is None else value) for value in columns[label]]
+                       if cls._properties[label].repeated else columns[label]
+                       for label in labels]
+            values = itertools.izip(*indexed)
+        else:
+            values = itertools.repeat(())
+        gIndexed.update(itertools.izip(keys, itertools.izip(itertools.repeat(kind), itertools.repeat(labels), values)))
+        for key, parent in itertools.izip(keys, parents):
+            if parent is not None:
+                gParents[key] = parent
+                gChildren.setdefault(parent, set()).add(key)
+
+    for name, values in index.iteritems():
+        gIndex[name] = dict((value, set(keys)) for value, keys in values.iteritems())
+
+
+def dumpEntities(cls, entities):
+    """ Entities, all of class cls, as plain lists. See loadEntities().
+        (class, keys, parents, ad hoc attributes or None, [(label, values)])
+        The entities aren't changed, so they can be dumped while other threads use them. Repeated values that were
+        never set are dumped as None and stay unset when loaded."""
+    keys = [entity.key for entity in entities]
+    parents = [getattr(entity, 'parent', None) for entity in entities]
+    # Anything other than descriptors, key and parent has to be kept as it is.
+    extras = [dict((k, v) for k, v in getattr(entity, '__dict__', {}).iteritems() if k not in ('key', 'parent'))
+              for entity in entities]
+    if not any(extras):
+        extras = None
+    columns = []
+    for label, descriptor in getattr(cls, '_properties', {}).iteritems():
+        # Not getattr(entity, label) as that sets the default on entities that haven't got a value.
+        unset = None if descriptor.repeated else descriptor.default
+        if descriptor.slot is not None:
+            count = len(entities)
+            values = map(getattr, entities, itertools.repeat(descriptor.slot.__name__, count),
+                         itertools.repeat(unset, count))
+        else:
+            values = [entity.values.get(label, unset) for entity in entities]
+        if descriptor.repeated:
+            values = [None if value is None else value.storage() for value in values]
+        columns.append((label, values))
+    return (cls, keys, parents, extras, columns)
+
+
+def loadEntities(dumped):
+    """ Rebuild the entities from dumpEntities(). Returns (entities, {label: values})."""
+    cls, keys, parents, extras, columns = dumped
+    # Build the entities with map() over the slots' setters rather than a Python loop per entity.
+    entities = map(cls.__new__, itertools.repeat(cls, len(keys)))
+    map(DataStore.__dict__['key'].__set__, entities, keys)
+    map(DataStore.__dict__['parent'].__set__, entities, parents)
+    if extras is not None:
+        for entity, extra in itertools.izip(entities, extras):
+            entity.__dict__.update(extra)
+    columns = dict(columns)
+    for label, values in columns.iteritems():
+        descriptor = cls._properties[label]
+        targets = entities
+        if descriptor.repeated:
+            listValues = makeListValues(descriptor, [value for value in values if value is not None])
+            if len(listValues) < len(values):
+                # Left unset, as they were when dumped. Their column has None.
+                targets = [entity for entity, value in itertools.izip(entities, values) if value is not None]
+                made = iter(listValues)
+                columns[label] = [None if value is None else next(made) for value in values]
+            else:
+                columns[label] = listValues
+            values = listValues
+        if descriptor.slot is not None:
+            map(descriptor.slot.__set__, targets, values)
+        else:
+            for entity, value in itertools.izip(targets, values):
+                descriptor.__set__(entity, value)
+    return entities, columns
+
+
+@contextlib.contextmanager
+def gcPaused():
+    """ Building or walking millions of objects makes the cyclic garbage collector run over and over for nothing."""
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+def store(key, entity):
+    """ Save entity as key and update the indexes and listeners. (DataStore.put() without the key allocation
+        and auto_now properties.)"""
+    storeMulti(((key, entity),))
+
+
+def storeMulti(items, readKeys=(), snapshot=None):
+    """ store() each (key, entity) in items, or remove() it if entity is None, as a single version.
+        gWriteLock is taken once for the lot.
+        If snapshot is given, raise TransactionFailedError without writing anything if any of the keys, or of
+        readKeys, has been written since that version."""
+    indexed = [None if entity is None else indexedValues(entity) for key, entity in items]
+    with gWriteLock:
+        if snapshot is not None:
+            for key in itertools.chain(readKeys, (key for key, entity in items)):
+                if currentVersion(key) > snapshot:
+                    raise TransactionFailedError('%s has changed.' % key)
+        version = beginCommit()
+        try:
+            for (key, entity), entityIndexed in itertools.izip(items, indexed):
+                # Keep the value being replaced for transactions reading an earlier version.
+                # Nothing is kept for new keys as an entity newer than a transaction's snapshot is invisible to it.
+                old = gContainer.get(key)
+                if old is not None:
+                    gHistory.setdefault(key, []).append((getattr(old, '_version', 0), old, version))
+                if entity is None:
+                    gContainer.pop(key, None)
+                    indexParent(key, None)
+                    indexProperties(key, None)
+                else:
+                    entity._version = version
+                    gContainer[key] = entity
+                    indexParent(key, getattr(entity, 'parent', None))
+                    indexProperties(key, entity, entityIndexed)
+            # Only once everything is stored so a listener that fails can't leave the write half done.
+            notifyListeners(items)
+        finally:
+            endCommit(version)
+    if len(gHistory) > HISTORY_SWEEP:
+        collectVersions()
+
+
+def addListener(listener, commit=False):
+    """ Add listener to gListeners, or to gCommitListeners if commit. Returns False if it was already there."""
+    global gListeners, gCommitListeners
+    with gListenerLock:
+        listeners = gCommitListeners if commit else gListeners
+        if listener in listeners:
+            return False
+        if commit:
+            gCommitListeners = listeners + (listener,)
+        else:
+            gListeners = listeners + (listener,)
+        return True
+
+
+def removeListener(listener, commit=False):
+    global gListeners, gCommitListeners
+    with gListenerLock:
+        if commit:
+            gCommitListeners = tuple(other for other in gCommitListeners if other != listener)
+        else:
+            gListeners = tuple(other for other in gListeners if other != listener)
+
+
+def notifyListeners(items):
+    """ Call every listener in gListeners for each (key, entity) of items, then every one in gCommitListeners with
+        all of them. A listener that raises doesn't stop the others being called. The first exception is raised
+        once they all have been."""
+    error = None
+    listeners, commitListeners = gListeners, gCommitListeners
+    for key, entity in items:
+        for listener in listeners:
+            try:
+                listener(key, entity)
+            except Exception:
+                logging.exception('Listener %s failed on %s.' % (listener, key))
+                error = error or sys.exc_info()
+    if commitListeners:
+        items = list(items)
+        for listener in commitListeners:
+            try:
+                listener(items)
+            except Exception:
+                logging.exception('Listener %s failed.' % listener)
+                error = error or sys.exc_info()
+    if error is not None:
+        raise error[0], error[1], error[2]
+
+
+def remove(key):
+    storeMulti(((key, None),))
+
+
+def removeMulti(keys):
+    storeMulti([(key, None) for key in keys])
+
+
+def allocateKey():
+    """ Next key number for the calling thread. Each thread reserves KEY_BLOCK numbers at a time so gKeyLock is
+        only contended once per block. Numbers are unique but not handed out in order across threads."""
+    global gKeyCounter
+    block = gKeyBlocks
+    if getattr(block, 'generation', None) != gKeyGeneration or block.next == block.end:
+        with gKeyLock:
+            block.generation = gKeyGeneration
+            block.next = gKeyCounter + 1
+            gKeyCounter += KEY_BLOCK
+            block.end = gKeyCounter + 1
+    number = block.next
+    block.next += 1
+    return number
+
+
+def resetKeys(keyCounter):
+    """ Set gKeyCounter and abandon the blocks threads have already reserved."""
+    global gKeyCounter, gKeyGeneration
+    with gKeyLock:
+        gKeyCounter = keyCounter
+        gKeyGeneration += 1
+
+
+def reserveKeys(number):
+    """ Make sure allocateKey() never hands out number or anything lower, eg. after entities were loaded with their
+        keys. Blocks threads have already reserved are abandoned as they may include number."""
+    global gKeyCounter, gKeyGeneration
+    with gKeyLock:
+        gKeyCounter = max(gKeyCounter, number)
+        gKeyGeneration += 1
+
+
+class TransactionFailedError(Exception):
+    """ A transaction's entities were changed by another thread before it could commit."""
+
+
+def beginCommit():
+    """ Number a new version. Pass it to endCommit() once it has been written."""
+    global gCommitIssued
+    with gCommitLock:
+        gCommitIssued += 1
+        gCommitPending.add(gCommitIssued)
+        return gCommitIssued
+
+
+def endCommit(version):
+    with gCommitLock:
+        gCommitPending.discard(version)
+
+
+def committedVersion():
+    """ Highest version that has been written along with every version before it. Call with gCommitLock held."""
+    if gCommitPending:
+        return min(gCommitPending) - 1
+    return gCommitIssued
+
+
+def openSnapshot():
+    """ Version for a transaction to read. Versions it may need are kept in gHistory until closeSnapshot()."""
+    with gCommitLock:
+        version = committedVersion()
+        gSnapshots[version] = gSnapshots.get(version, 0) + 1
+        return version
+
+
+def closeSnapshot(version):
+    with gCommitLock:
+        gSnapshots[version] -= 1
+        if not gSnapshots[version]:
+            del gSnapshots[version]
+
+
+def currentVersion(key):
+    """ Version of the last write to key, or 0 if it isn't known."""
+    entity = gContainer.get(key)
+    if entity is not None:
+        return getattr(entity, '_version', 0)
+    history = gHistory.get(key)
+    if history:
+        # Deleted.
+        return history[-1][2]
+    return 0
+
+
+def snapshotGet(key, version):
+    """ The entity stored at key as it was at version, or None. Takes no locks.
+        gHistory is appended to before the replacement is stored so anything newer than version has its
+        predecessor there by the time it can be seen."""
+    entity = gContainer.get(key)
+    if entity is not None and getattr(entity, '_version', 0) <= version:
+        return entity
+    for oldVersion, oldEntity, replacedAt in reversed(gHistory.get(key, ())):
+        if oldVersion <= version < replacedAt:
+            return oldEntity
+    return None
+
+
+def collectVersions():
+    """ Forget the versions in gHistory that no open or future transaction can read."""
+    with gCommitLock:
+        oldest = min(gSnapshots) if gSnapshots else committedVersion()
+    for key in gHistory.keys():
+        with gWriteLock:
+            history = [entry for entry in gHistory.get(key, ()) if entry[2] > oldest]
+            if history:
+                gHistory[key] = history
+            else:
+                gHistory.pop(key, None)
+
+
+def copyEntity(entity):
+    """ Copy of entity with its own repeated property lists, so changing it doesn't change the original."""
+    cls = type(entity)
+    copied = cls.__new__(cls)
+    for base in cls.__mro__:
+        for name in getattr(base, '__slots__', ()):
+            if name in ('__dict__', '__weakref__'):
+                continue
+            try:
+                value = getattr(entity, name)
+            except AttributeError:
+                continue
+            if type(value) is AllProperties.ListValue:
+                value = value.copy()
+            setattr(copied, name, value)
+    if hasattr(entity, '__dict__'):
+        for name, value in entity.__dict__.iteritems():
+            if name == 'values' and type(value) is DictType:
+                # Descriptor values of classes without __slots__.
+                value = dict((label, v.copy() if type(v) is AllProperties.ListValue else v)
+                             for label, v in value.iteritems())
+            copied.__dict__[name] = value
+    return copied
+
+
+def currentTransaction():
+    return getattr(gTransaction, 'current', None)
+
+
+def currentSession():
+    """ The calling thread's data_session.Session."""
+    return data_session.current()
+
+
+def fetchMulti(keys):
+    return map(gContainer.get, keys)
+
+
+def isStored(key, entity):
+    """ True if entity, read from the store earlier, is still what is stored at key. Every write stores a new
+        object or the same one changed in place, and deleting leaves nothing, so identity is enough."""
+    return gContainer.get(key) is entity
+
+
+class Transaction(object):
+    """ Reads the store as it was when the transaction started and buffers writes until .commit() .
+        Entities read are copies so changing one has no effect outside the transaction unless it is .put() .
+        .commit() fails with TransactionFailedError if anything the transaction read or wrote has been written by
+        someone else since it started.
+        Queries still find keys through the current indexes but return entities as of the snapshot.
+        Like ndb they don't see the transaction's own writes."""
+    def __init__(self):
+        self.snapshot = openSnapshot()
+        self.reads = set()
+        self.writes = {}    # {key: entity or None if deleted}
+        self.order = []     # Keys in the order they were first written.
+        self.cache = {}     # {key: copy already returned by .get()}
+        self.onCommit = []  # Called once the writes have been committed. See callOnCommit().
+        self.closed = False
+
+    def get(self, key):
+        if key in self.writes:
+            return self.writes[key]
+        if key not in self.cache:
+            self.reads.add(key)
+            entity = snapshotGet(key, self.snapshot)
+            self.cache[key] = None if entity is None else copyEntity(entity)
+        return self.cache[key]
+
+    def peek(self, key):
+        """ Like .get() but without copying the entity, for callers that only look at it."""
+        if key in self.writes:
+            return self.writes[key]
+        if key in self.cache:
+            return self.cache[key]
+        self.reads.add(key)
+        return snapshotGet(key, self.snapshot)
+
+    def put(self, key, entity):
+        if key not in self.writes:
+            self.order.append(key)
+        self.writes[key] = entity
+
+    def delete(self, key):
+        self.put(key, None)
+
+    def commit(self):
+        try:
+            if self.order:
+                storeMulti([(key, self.writes[key]) for key in self.order], list(self.reads), self.snapshot)
+        except TransactionFailedError:
+            self.onCommit = []
+            raise
+        finally:
+            self.close()
+            # Even if a listener failed, as the writes were stored before the listeners were called.
+            onCommit, self.onCommit = self.onCommit, []
+            for callback in onCommit:
+                callback()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            closeSnapshot(self.snapshot)
+
+
+def transaction(callback, retries=3, **options):
+    """ Run callback() in a Transaction, committing its writes together, and return its result.
+        If another thread got there first the whole callback is run again, up to retries more times.
+        An exception from callback discards the writes. Inside another transaction callback joins it.
+        Other options, eg. xg=True, are accepted for compatibility with ndb and ignored."""
+    if currentTransaction() is not None:
+        return callback()
+    for attempt in range(retries + 1):
+        txn = Transaction()
+        gTransaction.current = txn
+        try:
+            result = callback()
+            gTransaction.current = None
+            txn.commit()
+            return result
+        except TransactionFailedError:
+            if attempt == retries:
+                raise
+            logging.info('Transaction conflict, retrying.')
+        finally:
+            gTransaction.current = None
+            txn.close()
+
+
+def callOnCommit(callback):
+    """ Call callback() once the current transaction has committed, or now if there isn't one.
+        As ndb's Context.call_on_commit(), it isn't called if the transaction fails."""
+    txn = currentTransaction()
+    if txn is None:
+        callback()
+    else:
+        txn.onCommit.append(callback)
+
+
+def transactional(func=None, **options):
+    """ Decorator to run a function with transaction(). Use as @transactional or @transactional(retries=1)"""
+    if func is None:
+        return lambda func: transactional(func, **options)
+
+    @functools.wraps(func)
+    def inTransaction(*args, **kwargs):
+        return transaction(lambda: func(*args, **kwargs), **options)
+    return inTransaction
+
+
 class ContentType(object):
   ROOT = 1
   AREA = 2
@@ -20,24 +627,60 @@ class ContentType(object):
 class AllProperties(object):
     # The metaClass DescriptorOwner will look for this tag later and replace it with the correct descriptor name.
     label = ""
+    # Member descriptor of the __slots__ entry holding this property's value.
+    # Set by DescriptorOwner for classes that use __slots__. Otherwise values are kept in instance.values .
+    slot = None
 
     def checkInput(self, data):
-        return (not self.repeated and \
-                    (data is None or type(data) is self.dataType)) or \
-               (self.repeated and type(data) is ListType and \
-                    len([item for item in data if type(item) is self.dataType]) == len(data))
+        return self.check(data)
 
-    def __init__(self, dataType, default=None, repeated=False):
+    def __init__(self, dataType, default=None, repeated=False, indexed=False):
         if repeated == True and default is None:
             default = []
 
         self.default = default
         self.repeated = repeated
         self.dataType = dataType
-        if self.checkInput(default):
+        self.indexed = indexed    # Maintain a {value: set(keys)} index in gIndex when entities are .put().
+        self.compile()
+        if self.check(default):
             return
         raise TypeError
 
+    def compile(self):
+        """ Build the checks once rather than working the rules out on every assignment:
+                self.check(data):       Can data be assigned? Repeated properties take a list.
+                self.checkStored(data): Is data a valid value as stored? Repeated values are ListValues by then.
+                self.checkItems(items): Can each of items be in a repeated value? Used by its ListValue.
+        """
+        checkValue = self.makeValueCheck()
+        if not self.repeated:
+            self.check = self.checkStored = checkValue
+            return
+        checkItems = self.checkItems = self.makeItemsCheck()
+        self.check = lambda data: type(data) is ListType and checkItems(data)
+        self.checkStored = lambda data: (type(data) is AllProperties.ListValue or type(data) is ListType) and checkItems(data)
+
+    def __getstate__(self):
+        """ For pickling a ListValue with its property. The compiled checks are rebuilt and the slot isn't needed."""
+        state = dict(self.__dict__)
+        for name in ('check', 'checkStored', 'checkItems', 'slot'):
+            state.pop(name, None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.compile()
+
+    def makeValueCheck(self):
+        dataType = self.dataType
+        return lambda data: data is None or type(data) is dataType
+
+    def makeItemsCheck(self):
+        allowed = frozenset([self.dataType])
+        # map() and issuperset() keep the loop over the items in C.
+        return lambda items: allowed.issuperset(map(type, items))
+
     def __get__(self, instance, owner):
         if instance is None:
             # Only happens when parent class of this descriptor is un-initiated.
@@ -46,41 +689,238 @@ class AllProperties(object):
             # Where this class is the descriptor .authur .
 
             # We return an self.Uninitiated() object which traps comparisons. (==)
-            logging.debug(owner)
-            logging.debug(self.label)
+            if data_trace.gTracer is not None:
+                data_trace.gTracer.event('AllProperties.Uninitiated', owner=owner.__name__, label=self.label)
             return self.Uninitiated(owner.__name__, self.label)
 
+        if self.slot is not None:
+            try:
+                return self.slot.__get__(instance, owner)
+            except AttributeError:
+                value = self.makeDefault()
+                self.slot.__set__(instance, value)
+                return value
+
         if self.label not in instance.values:
-            if self.repeated:
-                self.default = self.ListValue(self.dataType, self.default)
-            instance.values[self.label] = self.default
+            instance.values[self.label] = self.makeDefault()
 
         return instance.values[self.label]
 
+    def makeDefault(self):
+        if self.repeated:
+            # Each instance gets its own copy so appending to one doesn't change the others.
+            return self.ListValue(self, self.default, checked=True)
+        return self.default
+
     def __set__(self, instance, value):
-        if not self.checkInput(value):
+        if not self.check(value):
             logging.debug(type(value))
             logging.debug(value)
             raise TypeError
 
         if self.repeated:
-            value = self.ListValue(self.dataType, value)
-        instance.values[self.label] = value
+            value = self.ListValue(self, value, checked=True)
+        if self.slot is not None:
+            self.slot.__set__(instance, value)
+        else:
+            instance.values[self.label] = value
+
+    class ListValue(object):
+        """ Values of a repeated property. Behaves like, and compares equal to, a list but is stored compactly:
+                StringType:  Keys made by DataStore.make_key() as an array of their numbers, with ROOT_NUMBER
+                             for root_key. Once anything else is added the strings are kept in a list, interned.
+                BooleanType: A BitList.
+                other types: A list.
+            Every change is checked against the rules of descriptor, the property it belongs to. From MEMBERS_MIN
+            items a set of the stored values is kept too so 'in' doesn't have to scan."""
+        __slots__ = ('descriptor', 'dataType', 'items', 'members')
+        MEMBERS_MIN = 64
+
+        def __init__(self, descriptor, items=(), checked=False):
+            items = list(items)
+            self.descriptor = descriptor
+            self.dataType = descriptor.dataType
+            if not checked:
+                self.checkItems(items)
+            self.items = packItems(self.dataType, items)
+            self.members = None
+
+        def checkItems(self, items):
+            if not self.descriptor.checkItems(items):
+                logging.debug(items)
+                raise TypeError
 
-    class ListValue(list):
-        """Overload a list to perform some value checking on repeated values."""
+        def encode(self, values):
+            """ values as they are kept in self.items . Switches a key array to a list if any of them isn't a key."""
+            if type(self.items) is array.array:
+                numbers = map(itemNumber, values)
+                if None not in numbers:
+                    return numbers
+                self.items = map(intern, self)
+                self.members = None
+            if self.dataType is StringType:
+                return map(intern, values)
+            return values
+
+        def lookup(self, value):
+            """ value as it would be kept in self.items, or MISSING if it can't be there."""
+            if type(self.items) is array.array:
+                if type(value) is not StringType:
+                    return MISSING
+                number = itemNumber(value)
+                return MISSING if number is None else number
+            try:
+                hash(value)
+            except TypeError:
+                return MISSING
+            return value
+
+        def storage(self):
+            """ Copy of self.items for dumpEntities()."""
+            if type(self.items) is BitList:
+                return self.items.copy()
+            return self.items[:]
+
+        def copy(self):
+            copied = restoreListValue(self.descriptor, self.storage())
+            if self.members is not None:
+                # Copying the set is much quicker than building it again from the items on the next 'in'.
+                copied.members = set(self.members)
+            return copied
+
+        def __len__(self):
+            return len(self.items)
+
+        def __iter__(self):
+            if type(self.items) is array.array:
+                if ROOT_NUMBER in self.items:
+                    # Each number's key, or root_key for ROOT_NUMBER, without a Python call for each.
+                    return itertools.imap(ROOT_KEYS.get, self.items, itertools.imap(KEY_FORMAT.__mod__, self.items))
+                return itertools.imap(KEY_FORMAT.__mod__, self.items)
+            return iter(self.items)
+
+        def __getitem__(self, index):
+            if type(index) is SliceType:
+                return list(self)[index]
+            if type(self.items) is array.array:
+                return itemKey(self.items[index])
+            return self.items[index]
+
+        def __setitem__(self, index, value):
+            if type(index) is SliceType:
+                values = list(self)
+                value = list(value)
+                self.checkItems(value)
+                values[index] = value
+                self.items = packItems(self.dataType, values)
+            else:
+                self.checkItems([value])
+                self.items[index] = self.encode([value])[0]
+            self.members = None
+
+        def __delitem__(self, index):
+            if type(index) is SliceType and type(self.items) is BitList:
+                values = list(self)
+                del values[index]
+                self.items = packItems(self.dataType, values)
+            else:
+                del self.items[index]
+            self.members = None
+
+        def append(self, value):
+            self.checkItems([value])
+            value = self.encode([value])[0]
+            self.items.append(value)
+            if self.members is not None:
+                self.members.add(value)
+
+        def extend(self, values):
+            values = list(values)
+            self.checkItems(values)
+            values = self.encode(values)
+            self.items.extend(values)
+            if self.members is not None:
+                self.members.update(values)
+
+        def __iadd__(self, values):
+            self.extend(values)
+            return self
+
+        def insert(self, index, value):
+            self.checkItems([value])
+            value = self.encode([value])[0]
+            self.items.insert(index, value)
+            if self.members is not None:
+                self.members.add(value)
+
+        def pop(self, index=-1):
+            value = self[index]
+            del self[index]
+            return value
+
+        def remove(self, value):
+            del self[self.index(value)]
+
+        def index(self, value):
+            stored = self.lookup(value)
+            if stored is MISSING:
+                raise ValueError('%r is not in list' % (value,))
+            return self.items.index(stored)
+
+        def count(self, value):
+            stored = self.lookup(value)
+            if stored is MISSING:
+                return 0
+            return self.items.count(stored)
+
+        def reverse(self):
+            self.items = packItems(self.dataType, list(self)[::-1])
+
+        def sort(self, *args, **kwargs):
+            values = list(self)
+            values.sort(*args, **kwargs)
+            self.items = packItems(self.dataType, values)
+            self.members = None
+
+        def __contains__(self, value):
+            stored = self.lookup(value)
+            if stored is MISSING:
+                return False
+            if len(self.items) < self.MEMBERS_MIN or type(self.items) is BitList:
+                return stored in self.items
+            if self.members is None:
+                self.members = set(self.items)
+            return stored in self.members
 
-        def __init__(self, dataType, *kargs):
-            list.__init__(self, *kargs)
-            self.dataType = dataType
+        def __eq__(self, other):
+            if type(other) is AllProperties.ListValue:
+                if type(self.items) is type(other.items) is array.array:
+                    return self.items == other.items
+                return list(self) == list(other)
+            if type(other) is ListType:
+                return list(self) == other
+            return NotImplemented
 
-        def __setitem__(self, key, value):
-            if type(value) is self.dataType:
-                list.__setitem__(self, key, value)
-            elif type(value) is ListType and len([item for item in value if type(item) is self.dataType]) == len(value):
-                list.__setitem__(self, key, value)
-            else:
-                raise TypeError
+        def __ne__(self, other):
+            equal = self.__eq__(other)
+            if equal is NotImplemented:
+                return equal
+            return not equal
+
+        __hash__ = None
+
+        def __add__(self, other):
+            return list(self) + list(other)
+
+        def __radd__(self, other):
+            return list(other) + list(self)
+
+        def __repr__(self):
+            return repr(list(self))
+
+        def __reduce__(self):
+            # pickle can't find nested classes by name so rebuild through a module level function.
+            return (restoreListValue, (self.descriptor, self.storage()))
 
     class Uninitiated(object):
         """This is returned if the uninitiated parent class is ever requested.
@@ -93,28 +933,217 @@ class AllProperties(object):
             self.descriptorLabel = descriptorLabel
 
         def __eq__(self, other):
-            logging.debug("__eq__")
             return (self.classType, self.descriptorLabel, "==", other)
 
-        def __cmp__(self, other):
-            logging.debug("__cmp__")
-            return (self.classType, self.descriptorLabel, "cmp", other)
+        def __ne__(self, other):
+            return (self.classType, self.descriptorLabel, "!=", other)
+
+        def __lt__(self, other):
+            return (self.classType, self.descriptorLabel, "<", other)
+
+        def __le__(self, other):
+            return (self.classType, self.descriptorLabel, "<=", other)
+
+        def __gt__(self, other):
+            return (self.classType, self.descriptorLabel, ">", other)
+
+        def __ge__(self, other):
+            return (self.classType, self.descriptorLabel, ">=", other)
+
+        def __neg__(self):
+            """ Descending sort order for .order(). eg. .order(-Attrib.modified) """
+            return (self.classType, self.descriptorLabel, "desc")
+
+
+KEY_FORMAT = 'dct_%d'    # DataStore.make_key() of a number.
+MISSING = object()       # Returned by ListValue.lookup() for values it can't hold.
+ROOT_NUMBER = -1         # Stands for root_key in a key array, so lists of ancestors can be one.
+ROOT_KEYS = {ROOT_NUMBER: root_key}
+
+
+def keyNumber(key):
+    """ n if key is the DataStore.make_key(n) of a number that fits in an array('l'), otherwise None."""
+    if key[:4] == 'dct_':
+        digits = key[4:]
+        if digits.isdigit() and len(digits) < 19 and (digits[0] != '0' or digits == '0'):
+            return int(digits)
+    return None
+
+
+def itemNumber(key):
+    """ Number that stands for key in a key array, or None if it can't be in one."""
+    if key == root_key:
+        return ROOT_NUMBER
+    return keyNumber(key)
+
+
+def itemKey(number):
+    """ The key a number in a key array stands for."""
+    return ROOT_KEYS.get(number) or KEY_FORMAT % number
+
+
+def packItems(dataType, values):
+    """ The storage ListValue uses for a list of values of dataType."""
+    if dataType is StringType:
+        numbers = map(itemNumber, values)
+        if None not in numbers:
+            return array.array('l', numbers)
+        return map(intern, values)
+    if dataType is BooleanType:
+        return BitList(values)
+    return values
+
+
+class BitList(object):
+    """ Bools packed into the bits of an int. Storage for ListValue."""
+    __slots__ = ('bits', 'length')
+
+    def __init__(self, values=()):
+        self.bits = 0
+        self.length = 0
+        self.extend(values)
+
+    def __len__(self):
+        return self.length
+
+    def position(self, index):
+        if index < 0:
+            index += self.length
+        if not 0 <= index < self.length:
+            raise IndexError('list index out of range')
+        return index
+
+    def __getitem__(self, index):
+        return bool(self.bits >> self.position(index) & 1)
+
+    def __setitem__(self, index, value):
+        index = self.position(index)
+        if value:
+            self.bits |= 1 << index
+        else:
+            self.bits &= ~(1 << index)
+
+    def __delitem__(self, index):
+        index = self.position(index)
+        low = self.bits & ((1 << index) - 1)
+        self.bits = self.bits >> (index + 1) << index | low
+        self.length -= 1
+
+    def insert(self, index, value):
+        # Same clamping as list.insert()
+        if index < 0:
+            index = max(index + self.length, 0)
+        index = min(index, self.length)
+        low = self.bits & ((1 << index) - 1)
+        self.bits = self.bits >> index << (index + 1) | bool(value) << index | low
+        self.length += 1
+
+    def append(self, value):
+        if value:
+            self.bits |= 1 << self.length
+        self.length += 1
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def __iter__(self):
+        bits = self.bits
+        for unused in xrange(self.length):
+            yield bool(bits & 1)
+            bits >>= 1
+
+    def __contains__(self, value):
+        if value == True:
+            return self.bits != 0
+        if value == False:
+            return self.bits != (1 << self.length) - 1
+        return False
+
+    def index(self, value):
+        for index, item in enumerate(self):
+            if item == value:
+                return index
+        raise ValueError('%r is not in list' % (value,))
+
+    def count(self, value):
+        return sum(1 for item in self if item == value)
+
+    def copy(self):
+        copied = BitList()
+        copied.bits = self.bits
+        copied.length = self.length
+        return copied
+
+    def __getstate__(self):
+        return (self.bits, self.length)
+
+    def __setstate__(self, state):
+        self.bits, self.length = state
+
+
+def makeListValue(descriptor, items):
+    return AllProperties.ListValue(descriptor, items)
+
+
+def restoreListValue(descriptor, items):
+    """ ListValue of descriptor around items, which are already checked and stored as packItems() would."""
+    listValue = AllProperties.ListValue.__new__(AllProperties.ListValue)
+    listValue.descriptor = descriptor
+    listValue.dataType = descriptor.dataType
+    listValue.items = items
+    listValue.members = None
+    return listValue
+
+
+def makeListValues(descriptor, storages):
+    """ [restoreListValue(descriptor, items) for items in storages] without a Python call per list.
+        A plain list is valid storage for any type so lists from before the compact storage still load."""
+    count = len(storages)
+    listValues = map(AllProperties.ListValue.__new__, itertools.repeat(AllProperties.ListValue, count))
+    map(AllProperties.ListValue.items.__set__, listValues, storages)
+    map(AllProperties.ListValue.descriptor.__set__, listValues, itertools.repeat(descriptor, count))
+    map(AllProperties.ListValue.dataType.__set__, listValues, itertools.repeat(descriptor.dataType, count))
+    map(AllProperties.ListValue.members.__set__, listValues, itertools.repeat(None, count))
+    return listValues
 
 
 class BooleanProperty(AllProperties):
-    def __init__(self, default=None, repeated=False):
-        AllProperties.__init__(self, BooleanType, default=default, repeated=repeated)
+    def __init__(self, default=None, repeated=False, indexed=False):
+        AllProperties.__init__(self, BooleanType, default=default, repeated=repeated, indexed=indexed)
 
 
-class EnumProperty(AllProperties):
-    def __init__(self, classType, default=None, repeated=False):
-        AllProperties.__init__(self, classType, default=default, repeated=repeated)
+class IntegerProperty(AllProperties):
+    def __init__(self, default=None, repeated=False, indexed=False):
+        AllProperties.__init__(self, IntType, default=default, repeated=repeated, indexed=indexed)
 
-    def checkInput(self, data):
-        return (not self.repeated and \
-                    (data is None or data in [getattr(self.dataType, k) for k in dir(self.dataType) if k[0] != '_'])) or \
-               (self.repeated and type(data) is ListType and \
-                    len([item for item in data if type(item) is self.dataType]) == len(data))
+
+class EnumProperty(AllProperties):
+    def __init__(self, classType, default=None, repeated=False, indexed=False):
+        AllProperties.__init__(self, classType, default=default, repeated=repeated, indexed=indexed)
+
+    def makeValueCheck(self):
+        values = self.values()
+        def checkValue(data):
+            try:
+                return data is None or data in values
+            except TypeError:
+                # Unhashable
+                return False
+        return checkValue
+
+    def makeItemsCheck(self):
+        values = self.values()
+        def checkItems(items):
+            try:
+                return values.issuperset(items)
+            except TypeError:
+                return False
+        return checkItems
+
+    def values(self):
+        """ frozenset of the public attributes of the enum class, eg. ContentType.ROOT """
+        return frozenset(getattr(self.dataType, k) for k in dir(self.dataType) if k[0] != '_')
 
 
 class StringProperty(AllProperties):
@@ -123,8 +1152,20 @@ class StringProperty(AllProperties):
 
 
 class UserProperty(AllProperties):
-    def __init__(self, default=None, repeated=False):
-        AllProperties.__init__(self, users.User, default=default, repeated=repeated)
+    def __init__(self, default=None, repeated=False, indexed=False):
+        AllProperties.__init__(self, users.User, default=default, repeated=repeated, indexed=indexed)
+
+
+class DateTimeProperty(AllProperties):
+    def __init__(self, default=None, repeated=False, indexed=False, auto_now=False, auto_now_add=False):
+        AllProperties.__init__(self, datetime.datetime, default=default, repeated=repeated, indexed=indexed)
+        self.auto_now = auto_now            # Set to the current time on every .put().
+        self.auto_now_add = auto_now_add    # Set to the current time on the first .put().
+
+    def touch(self, instance, now):
+        """ Called by DataStore.put() on descriptors with auto_now or auto_now_add set."""
+        if self.auto_now or self.__get__(instance, type(instance)) is None:
+            self.__set__(instance, now)
 
 
 class DescriptorOwner(type):
@@ -132,23 +1173,42 @@ class DescriptorOwner(type):
     http://nbviewer.ipython.org/urls/gist.github.com/ChrisBeaumont/5758381/raw/descriptor_writeup.ipynb
     http://stackoverflow.com/questions/100003/what-is-a-metaclass-in-python """
     def __new__(cls, name, bases, attrs):
+        # Keep descriptor values in __slots__ rather than a per-instance dict if the base classes use __slots__.
+        # The slot for descriptor "foo" is called "_v_foo" as "foo" is taken by the descriptor itself.
+        slotted = '__slots__' not in attrs and all(hasattr(base, '__slots__') for base in bases)
+        if slotted:
+            attrs['__slots__'] = tuple(sorted('_v_' + n for n, v in attrs.items() if isinstance(v, AllProperties)))
+
         # find all descriptors, auto-set their labels
         for n, v in attrs.items():
-            logging.debug((n,v))
-            logging.debug(type(v))
-
-            #if isinstance(v, UserProperty):
-            if hasattr(v, 'label'):  #type(v) == types.functionType:
-                logging.debug("*")
+            if hasattr(v, 'label'):
                 v.label = n
-        return super(DescriptorOwner, cls).__new__(cls, name, bases, attrs)
+        newClass = super(DescriptorOwner, cls).__new__(cls, name, bases, attrs)
+        if slotted:
+            for n, v in attrs.items():
+                if isinstance(v, AllProperties):
+                    v.slot = vars(newClass)['_v_' + n]
+
+        # All descriptors, including inherited ones.
+        properties = {}
+        for base in reversed(newClass.__mro__):
+            properties.update((label, v) for label, v in vars(base).items() if isinstance(v, AllProperties))
+        newClass._properties = properties
+        newClass._indexed = tuple(sorted(label for label, v in properties.items() if v.indexed))
+        newClass._autoNow = tuple(v for v in properties.values()
+                                  if getattr(v, 'auto_now', False) or getattr(v, 'auto_now_add', False))
+        newClass._validators = tuple((label, properties[label].checkStored) for label in sorted(properties))
+        return newClass
 
 
 class DataStore(object):
     __metaclass__ = DescriptorOwner
+    # Subclasses get a slot per descriptor from DescriptorOwner.
+    # __dict__ is only allocated if something other than a descriptor, key or parent gets assigned.
+    # _version: see storeMulti(). __weakref__: see data_mmap.MappedContainer .
+    __slots__ = ('__dict__', '__weakref__', 'key', 'parent', '_version')
 
     def __init__(self, **kwargs):
-        self.values = {}    # (Key:Value)s assigned to descriptor instances where Key is the descriptor object name.
         self.key = None     # May get overwritten by kwargs.
         for k in kwargs:
             setattr(self, k, kwargs[k])
@@ -158,18 +1218,111 @@ class DataStore(object):
             key = self.key
         if key is None:
             raise KeyError
+        txn = currentTransaction()
+        if txn is not None:
+            return txn.get(key)
+        if data_session.gSession.current is not None:
+            return currentSession().get_multi([key], fetchMulti, isStored)[0]
         return gContainer.get(key)
 
     def put(self, value=None):
-        global gKeyCounter
         if self.key is None:
-            gKeyCounter += 1
-            self.key = DataStore.make_key(gKeyCounter)
+            self.key = DataStore.make_key(allocateKey())
         if value is None:
             value = self
-        gContainer[self.key] = value
+        autoNow = getattr(type(value), '_autoNow', ())
+        if autoNow:
+            now = datetime.datetime.now()
+            for descriptor in autoNow:
+                descriptor.touch(value, now)
+        txn = currentTransaction()
+        if txn is not None:
+            txn.put(self.key, value)
+        else:
+            store(self.key, value)
         return self.key
 
+    def validate(self):
+        """ Check every descriptor's value, including any set without going through the descriptor.
+            Raises TypeError for the first bad one."""
+        for label, checkStored in type(self)._validators:
+            if not checkStored(getattr(self, label)):
+                logging.error('Bad value for %s.%s: %s' % (type(self).__name__, label, getattr(self, label)))
+                raise TypeError
+
+    def to_dict(self, include=None, exclude=None):
+        """ {label: value} of the descriptors, as ndb.Model.to_dict() . Repeated values are copied into lists."""
+        values = {}
+        for label in type(self)._properties:
+            if (include is None or label in include) and (exclude is None or label not in exclude):
+                value = getattr(self, label)
+                if type(value) is AllProperties.ListValue:
+                    value = list(value)
+                values[label] = value
+        return values
+
+    def populate(self, **kwargs):
+        """ Set several values at once, eg. from .to_dict() of another entity."""
+        for k in kwargs:
+            setattr(self, k, kwargs[k])
+
+    @staticmethod
+    def get_multi(keys):
+        """ Entity for each of keys, or None where there isn't one, in the same order."""
+        txn = currentTransaction()
+        if txn is not None:
+            return map(txn.get, keys)
+        session = currentSession()
+        if session is not None:
+            return session.get_multi(keys, fetchMulti, isStored)
+        return map(gContainer.get, keys)
+
+    @staticmethod
+    def put_multi(entities, validate=False):
+        """ .put() each of entities, taking the locks once. Returns their keys in the same order.
+            validate=True to .validate() each of them first, eg. for entities built by an import."""
+        if validate:
+            for entity in entities:
+                entity.validate()
+        now = datetime.datetime.now()
+        for entity in entities:
+            if entity.key is None:
+                entity.key = DataStore.make_key(allocateKey())
+            for descriptor in getattr(type(entity), '_autoNow', ()):
+                descriptor.touch(entity, now)
+        txn = currentTransaction()
+        if txn is not None:
+            for entity in entities:
+                txn.put(entity.key, entity)
+        else:
+            storeMulti([(entity.key, entity) for entity in entities])
+        return [entity.key for entity in entities]
+
+    @staticmethod
+    def delete_multi(keys):
+        txn = currentTransaction()
+        if txn is not None:
+            for key in keys:
+                txn.delete(key)
+        else:
+            removeMulti(list(keys))
+
+    @staticmethod
+    def allocate_key():
+        """ A new key for an entity that needs to be referred to before it is .put()."""
+        return DataStore.make_key(allocateKey())
+
+    def delete(self, key=None):
+        if key is None:
+            key = self.key
+        if key is None:
+            raise KeyError
+        txn = currentTransaction()
+        if txn is not None:
+            txn.delete(key)
+        else:
+            remove(key)
+
     # Don't know if we'll use this
     def __setitem__(self, key, value):
         if key is not None:
@@ -197,38 +1350,424 @@ class DataStore(object):
         return 'dct_%s' % intiger
 
     @classmethod
-    def query(cls, ancestor=None, **kwargs):
-        logging.debug("DataStore.query(%s, ancestor=%s, %s)" % (cls, ancestor, kwargs))
-        self = cls.__new__(cls)
-        self.ancestor = ancestor
-        self.filters = kwargs
-        return self
+    @data_trace.traced('DataStore.query', fields=lambda cls, *args, **kwargs: {'kind': cls.__name__, 'args': args,
+                                                                                'kwargs': kwargs})
+    def query(cls, *args, **kwargs):
+        return Query(cls, *args, **kwargs)
+
+
+class Query(object):
+    """ Evaluates .query().filter().order().fetch() chains against gContainer.
+        Filters are the (classType, label, operator, value) tuples built by AllProperties.Uninitiated.
+        eg.
+            AttribName.query(ancestor=key).filter(AttribName.authur==user).order(-AttribName.modified).fetch(1)
+    """
+    operators = {"==": operator.eq,
+                 "!=": operator.ne,
+                 "<": operator.lt,
+                 "<=": operator.le,
+                 ">": operator.gt,
+                 ">=": operator.ge}
+
+    def __init__(self, kind, *args, **kwargs):
+        self.kind = kind
+        self.ancestor = kwargs.pop('ancestor', None)
+        self.filters = []
+        self.orders = []    # [(classType, label, "asc" or "desc")] with the key as the final tie-break.
+        for item in args + tuple(kwargs.pop('filters', ())):
+            self._addFilter(item)
+        self.order(*kwargs.pop('orders', ()))
+        if kwargs:
+            raise TypeError('Unknown query options: %s' % kwargs.keys())
+
+    def _addFilter(self, item):
+        if type(item) is not TupleType or len(item) != 4 or item[2] not in self.operators:
+            logging.error('Not a filter: %s' % (item,))
+            raise TypeError
+        self.filters.append(item)
 
+    @data_trace.traced('Query.filter', fields=lambda self, *args, **kwargs: {'args': args, 'kwargs': kwargs})
     def filter(self, *args, **kwargs):
-        logging.debug("DataStore.filter(%s, %s)" % (args, kwargs))
-        self.filters.update(kwargs)
+        for item in args:
+            self._addFilter(item)
+        # Keyword filters are shorthand for equality, eg. .filter(active=True)
+        for label, value in kwargs.items():
+            self._addFilter((self.kind.__name__, label, "==", value))
         return self
 
-    def fetch(self, **kwargs):
-        logging.debug("DataStore.fetch(%s)" % kwargs)
+    def order(self, *args):
+        for item in args:
+            if type(item) is AllProperties.Uninitiated:
+                item = (item.classType, item.descriptorLabel, "asc")
+            if type(item) is not TupleType or len(item) != 3 or item[2] not in ("asc", "desc"):
+                logging.error('Not an order: %s' % (item,))
+                raise TypeError
+            self.orders.append(item)
         return self
-    def count(self, **kwargs):
-        logging.debug("DataStore.count(%s)" % kwargs)
-        return 0
+
+    @data_trace.traced('Query.fetch', fields=lambda self, limit=None, offset=0: {'kind': self.kind.__name__,
+                                                                                'limit': limit, 'offset': offset})
+    def fetch(self, limit=None, offset=0):
+        plan = self._plan()
+        keys = self._orderedKeys(plan)
+        if keys is not None:
+            # Rows come out in order so stop as soon as enough have been seen.
+            return list(itertools.islice(self._rows(plan, keys), offset, None if limit is None else offset + limit))
+        rows = self._rows(plan)
+        if limit is None:
+            return sorted(rows, key=self._sortKey)[offset:]
+        # Only the first offset + limit rows are wanted so keep a heap of that size rather than sorting everything.
+        return heapq.nsmallest(offset + limit, rows, key=self._sortKey)[offset:]
+
+    @data_trace.traced('Query.count', fields=lambda self, limit=None, offset=0: {'kind': self.kind.__name__,
+                                                                                'limit': limit, 'offset': offset})
+    def count(self, limit=None, offset=0):
+        plan = self._plan()
+        txn = currentTransaction()
+        if plan.exact and txn is None:
+            # Everything was answered by a single index so the count is just the size of its key set.
+            total = len(plan)
+        else:
+            if txn is None and not plan.residual:
+                rows = self._candidates(plan)
+            else:
+                # A transaction counts its snapshot, which the current indexes may not match.
+                rows = self._rows(plan, read=None if txn is None else txn.peek)
+            if limit is not None:
+                # Stop as soon as enough rows have been seen.
+                rows = itertools.islice(rows, offset + limit)
+            total = sum(1 for unused in rows)
+        total = max(total - offset, 0)
+        if limit is None:
+            return total
+        return min(total, limit)
+
+    def get(self):
+        results = self.fetch(1)
+        if results:
+            return results[0]
+        return None
+
+    def __iter__(self):
+        return iter(self.fetch())
+
+    def explain(self):
+        """ Describe how this query would be run. eg.
+                {'driver': ('index', 'contType', 3), 'probes': [('index', 'active', True), ('kind', 'Container')],
+                 'ancestor': None, 'residual': [], 'order': [], 'estimatedRows': 12}
+            The driver is the access path that is iterated; probes are checked by set membership,
+            an ancestor by walking up gParents and residual filters against each entity."""
+        plan = self._plan()
+        return {'driver': plan.driver,
+                'probes': [name for name, keys in plan.probes],
+                'ancestor': plan.ancestor,
+                'residual': plan.residual,
+                'order': self.orders,
+                'estimatedRows': plan.estimate()}
+
+    def _plan(self):
+        """ Every equality filter on an indexed property, the kind and the ancestor each give a set of keys.
+            The smallest set of known size drives the query and the rest are checked by membership."""
+        kindName = self.kind.__name__
+        paths = []    # [(name, set of keys)]
+        residual = []
+        if self.kind is not DataStore:
+            paths.append((('kind', kindName), gKinds.get(kindName, frozenset())))
+        for item in self.filters:
+            classType, label, op, value = item
+            if op == "==" and label in self.kind._indexed:
+                paths.append((('index', label, value), indexedKeys(kindName, label, [value])))
+            else:
+                residual.append(item)
+        if self.kind is not DataStore and len(paths) > 1:
+            # gIndex is per kind so any index already limits the results to the kind.
+            paths = paths[1:]
+        paths.sort(key=lambda path: len(path[1]))
+
+        ancestor = None
+        if self.ancestor is not None:
+            # The size of a subtree isn't known without walking it, but it has at least as many members as
+            # the ancestor has children. If a smaller set is available, check each of its keys' parents instead.
+            if paths and len(paths[0][1]) <= len(gChildren.get(self.ancestor, ())):
+                ancestor = self.ancestor
+            else:
+                keys = set(descendantKeys(self.ancestor))
+                if self.ancestor not in gContainer:
+                    # Its descendants are still found, as ndb does, but it isn't there to be one of the results.
+                    keys.discard(self.ancestor)
+                paths.insert(0, (('ancestor', self.ancestor), keys))
+        kind = kindName if self.kind is not DataStore else None
+        if not paths:
+            return QueryPlan(kind, ('scan',), None, [], ancestor, residual)
+        return QueryPlan(kind, paths[0][0], paths[0][1], paths[1:], ancestor, residual)
+
+    def _rows(self, plan, keys=None, read=None):
+        """ Generate the entities matching plan, in the order of keys if given, otherwise in no particular order.
+            read replaces the function entities are read with."""
+        if keys is None:
+            # Copy the driving set in one step so other threads' writes can't change it while it is iterated.
+            keys = plan.keys
+            if keys is None:
+                keys = gContainer.keys()
+            else:
+                keys = list(keys)
+        txn = currentTransaction()
+        get = read or (gContainer.get if txn is None else txn.get)
+        for key in self._candidates(plan, keys):
+            entity = get(key)
+            # In a transaction the snapshot may differ from what the indexes were built from so check everything.
+            if entity is None or not self.match(entity, plan.residual if txn is None else None):
+                continue
+            yield entity
+
+    def _candidates(self, plan, keys=None):
+        """ Generate the keys of plan's driver (or keys) that are in every probe and under the ancestor.
+            Without residual filters these are the results, found without reading any entities."""
+        if keys is None:
+            keys = gContainer.keys() if plan.keys is None else list(plan.keys)
+        for key in keys:
+            if plan.probes and not all(key in probeKeys for name, probeKeys in plan.probes):
+                continue
+            if plan.ancestor is not None and not isAncestor(key, plan.ancestor):
+                continue
+            yield key
+
+    def _orderedKeys(self, plan):
+        """ Generate plan's candidate keys in the order .fetch() returns them, or None if that needs the entities.
+            Without .order() that is key order. A single order on an indexed property that isn't repeated can be
+            read from its gIndex entry, unless a transaction's snapshot may not match the index."""
+        if not self.orders:
+            return inKeyOrder(gContainer.keys() if plan.keys is None else list(plan.keys))
+        if len(self.orders) != 1 or plan.driver[0] != 'kind' or currentTransaction() is not None:
+            return None
+        classType, label, direction = self.orders[0]
+        descriptor = self.kind._properties.get(label)
+        if descriptor is None or not descriptor.indexed or descriptor.repeated:
+            return None
+        return self._indexOrder(label, direction, plan.keys)
+
+    def _indexOrder(self, label, direction, kindKeys):
+        index = gIndex.get((self.kind.__name__, label), {})
+        # Same as _sortKey(): unset values first, and keys ascending within a value whichever the direction.
+        values = sorted(index.keys(), key=lambda value: (value is not None, value), reverse=direction == "desc")
+        for value in values:
+            for key in inKeyOrder(list(index.get(value, ()))):
+                if key in kindKeys:
+                    yield key
+
+    def _sortKey(self, entity):
+        sortKey = []
+        for classType, label, direction in self.orders:
+            value = getattr(entity, label, None)
+            # Unset values sort first rather than being compared with values of another type.
+            value = (value is not None, value)
+            if direction == "desc":
+                value = Descending(value)
+            sortKey.append(value)
+        sortKey.append(keyOrder(entity.key))
+        return sortKey
+
+    def match(self, entity, filters=None):
+        """ Does entity satisfy this query's kind and filters? (The ancestor is resolved by _plan().)"""
+        if self.kind is not DataStore and type(entity) is not self.kind:
+            return False
+        if filters is None:
+            filters = self.filters
+        for classType, label, op, value in filters:
+            if not self.matchFilter(entity, label, op, value):
+                return False
+        return True
+
+    @classmethod
+    def matchFilter(cls, entity, label, op, value):
+        try:
+            entityValue = getattr(entity, label)
+        except AttributeError:
+            return False
+        if entityValue is None and op != "==" and op != "!=":
+            # Unset properties never satisfy an inequality filter.
+            return False
+        if type(entityValue) is AllProperties.ListValue:
+            # Repeated properties match if any of their values match.
+            return any(cls.operators[op](item, value) for item in entityValue)
+        return cls.operators[op](entityValue, value)
+
+
+class QueryPlan(object):
+    """ The access paths Query._plan() chose. See Query.explain()."""
+    def __init__(self, kind, driver, keys, probes, ancestor, residual):
+        self.kind = kind            # Name of the kind queried, or None for any kind.
+        self.driver = driver        # Name of the access path that is iterated.
+        self.keys = keys            # Its keys, or None to iterate all of gContainer.
+        self.probes = probes        # [(name, set of keys)] each result must be a member of.
+        self.ancestor = ancestor    # Ancestor to check by walking gParents, or None.
+        self.residual = residual    # Filters with no index that are checked against each entity.
+        self.exact = not probes and ancestor is None and not residual
+
+    def __len__(self):
+        if self.keys is None:
+            return len(gContainer)
+        return len(self.keys)
+
+    def estimate(self):
+        """ Rows expected, assuming the probes are independent of the driver and of each other."""
+        rows = float(len(self))
+        kindSize = len(gKinds.get(self.kind, ())) if self.kind is not None else len(gContainer)
+        for name, keys in self.probes:
+            if name[0] == 'index':
+                # Index keys are all of the one kind.
+                rows *= float(len(keys)) / max(kindSize, 1)
+            elif name[0] == 'kind':
+                rows *= float(len(keys)) / max(len(gContainer), 1)
+        return int(math.ceil(rows))
+
+
+class Descending(object):
+    """ Wraps a sort value so that it sorts in reverse."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def indexParent(key, parent):
+    """ Move key to parent's entry in the gChildren index. A parent of None removes it from the index."""
+    oldParent = gParents.get(key)
+    if oldParent == parent:
+        return
+    if oldParent is not None:
+        siblings = gChildren[oldParent]
+        siblings.discard(key)
+        if not siblings:
+            del gChildren[oldParent]
+        del gParents[key]
+    if parent is not None:
+        gChildren.setdefault(parent, set()).add(key)
+        gParents[key] = parent
+
+
+def indexedValues(entity):
+    """ (kind name, indexed labels, values) of entity as kept in gIndexed."""
+    values = []
+    for label in getattr(type(entity), '_indexed', ()):
+        value = getattr(entity, label)
+        if type(value) is AllProperties.ListValue:
+            value = frozenset(value)
+        values.append(value)
+    return (type(entity).__name__, getattr(type(entity), '_indexed', ()), tuple(values))
+
+
+def indexProperties(key, entity, indexed=None):
+    """ Update gKinds and gIndex for the entity stored at key. An entity of None removes key from them.
+        indexed saves working out indexedValues(entity) again."""
+    old = gIndexed.pop(key, None)
+    if old is not None:
+        kind, labels, values = old
+        gKinds[kind].discard(key)
+        for label, value in itertools.izip(labels, values):
+            index = gIndex[(kind, label)]
+            for value in (value if type(value) is frozenset else (value,)):
+                keys = index[value]
+                keys.discard(key)
+                if not keys:
+                    del index[value]
+    if entity is None:
+        return
+
+    if indexed is None:
+        indexed = indexedValues(entity)
+    kind, labels, values = indexed
+    gKinds.setdefault(kind, set()).add(key)
+    for label, value in itertools.izip(labels, values):
+        index = gIndex.setdefault((kind, label), {})
+        for item in (value if type(value) is frozenset else (value,)):
+            index.setdefault(item, set()).add(key)
+    gIndexed[key] = indexed
+
+
+def indexedKeys(kind, label, values):
+    """ Set of keys of kind whose label property was one of values when last .put().
+        Don't modify the returned set; it may be the index itself."""
+    index = gIndex.get((kind, label), {})
+    if len(values) == 1:
+        return index.get(values[0], frozenset())
+    keys = set()
+    for value in values:
+        keys.update(index.get(value, ()))
+    return keys
+
+
+def descendantKeys(ancestor):
+    """ ancestor followed by every key below it in the gChildren index.
+        (Same as ndb, an entity counts as its own ancestor.)"""
+    keys = [ancestor]
+    seen = set(keys)
+    for key in keys:
+        for child in list(gChildren.get(key, ())):
+            if child not in seen:
+                seen.add(child)
+                keys.append(child)
+    return keys
+
+
+def isAncestor(key, ancestor):
+    """ True if ancestor is key or is further up key's chain in the gParents index."""
+    seen = set()
+    while key is not None and key not in seen:
+        if key == ancestor:
+            return True
+        seen.add(key)
+        key = gParents.get(key)
+    return False
+
+
+def inKeyOrder(keys):
+    """ Generate keys sorted by keyOrder(). A heap rather than sorted() so taking the first few is O(n)."""
+    heap = map(keyOrder, keys)
+    heapq.heapify(heap)
+    while heap:
+        yield heapq.heappop(heap)[2]
+
+
+def keyOrder(key):
+    """ Sort keys the same order they were allocated in. ('dct_2' before 'dct_10'.)"""
+    if type(key) is StringType and key.startswith('dct_') and key[4:].isdigit():
+        return (0, int(key[4:]), key)
+    return (1, 0, key)
 
 
 class Container(DataStore):
-    active = BooleanProperty()
-    contType = EnumProperty(ContentType)
+    active = BooleanProperty(indexed=True)
+    contType = EnumProperty(ContentType, indexed=True)
     menuParent = StringProperty()
     menuChildren = StringProperty(repeated=True)
     attributes = StringProperty(repeated=True)
+    ancestors = StringProperty(repeated=True)    # Keys of the menuParent chain, root first. See Element.move()
+    subtreeCounts = IntegerProperty(repeated=True)    # Containers below this one. See countSlot()
+    attribKinds = StringProperty(repeated=True)    # Class names of the attributes, with their number in attribCounts .
+    attribCounts = IntegerProperty(repeated=True)
+    activeKinds = StringProperty(repeated=True)    # Class names with an active attribute, its key in activeAttribs .
+    activeAttribs = StringProperty(repeated=True)
+
+class CountShard(DataStore):
+    """ Part of the subtreeCounts of a Container, kept apart so that changes below the same Container rarely write
+        the same entity. See addSubtreeCounts()."""
+    counts = IntegerProperty(repeated=True)
 
 class Attrib(DataStore):
-    authur = UserProperty()
-    created = None
-    modified = None
-    active = BooleanProperty()
+    authur = UserProperty(indexed=True)
+    created = DateTimeProperty(auto_now_add=True)
+    modified = DateTimeProperty(auto_now=True)
+    active = BooleanProperty(indexed=True)
 
 class AttribName(Attrib):
     text = StringProperty()
@@ -237,13 +1776,306 @@ class AttribDescription(Attrib):
     text = StringProperty()
 
 
+def copyAttrib(attribute, parent):
+    attributeClass = type(attribute)
+    props = attribute.to_dict()
+    props['parent'] = parent
+    return attributeClass(**props)
+
+
+class TreeNode(object):
+    """ A Container in the tree returned by Element.getDescendants().
+        The children of every node at the same depth are fetched together the first time any of them is asked for,
+        so walking the whole tree takes one DataStore.get_multi() per level."""
+    __slots__ = ('key', 'container', 'level', '_children')
+
+    def __init__(self, container, level):
+        self.key = container.key
+        self.container = container
+        self.level = level          # TreeLevel this node is in.
+        self._children = None       # Set by self.level.loadChildren()
+
+    @property
+    def children(self):
+        """ TreeNodes of the menuChildren that pass the filters, in menuChildren order. Empty below the depth asked for."""
+        if self._children is None:
+            self.level.loadChildren()
+        return self._children
+
+    def walk(self):
+        """ This node and everything below it, a level at a time."""
+        level = [self]
+        while level:
+            for node in level:
+                yield node
+            level = [child for node in level for child in node.children]
+
+
+class TreeLevel(object):
+    """ The TreeNodes at one depth of a getDescendants() tree."""
+    def __init__(self, remaining, active, contType):
+        self.nodes = []
+        self.remaining = remaining    # Levels that may still be fetched below this one. None for no limit.
+        self.active = active
+        self.contType = contType
+
+    def matches(self, container):
+        return (type(container) is Container and
+                (self.active is None or container.active == self.active) and
+                (self.contType is None or container.contType in self.contType))
+
+    def loadChildren(self):
+        if self.remaining == 0:
+            for node in self.nodes:
+                node._children = []
+            return
+        keys = [key for node in self.nodes for key in node.container.menuChildren]
+        # Discard keys the Container indexes already rule out before fetching anything.
+        if self.active is not None:
+            allowed = indexedKeys(Container.__name__, 'active', [self.active])
+            keys = [k for k in keys if k in allowed]
+        if self.contType is not None:
+            allowed = indexedKeys(Container.__name__, 'contType', self.contType)
+            keys = [k for k in keys if k in allowed]
+        containers = dict(zip(keys, DataStore.get_multi(keys)))
+
+        childLevel = TreeLevel(None if self.remaining is None else self.remaining - 1, self.active, self.contType)
+        for node in self.nodes:
+            node._children = []
+            for key in node.container.menuChildren:
+                container = containers.get(key)
+                if container is not None and self.matches(container):
+                    child = TreeNode(container, childLevel)
+                    childLevel.nodes.append(child)
+                    node._children.append(child)
+
+
+def updateAncestors(container):
+    """ Set .ancestors of every Container below container from container's own.
+        Returns the ones that changed, to be .put()."""
+    level = TreeLevel(None, None, None)
+    top = TreeNode(container, level)
+    level.nodes.append(top)
+    changed = []
+    # walk() yields a node before its children so each child's parent is already up to date.
+    for node in top.walk():
+        ancestors = list(node.container.ancestors) + [node.key]
+        for child in node.children:
+            if child.container.ancestors != ancestors:
+                child.container.ancestors = ancestors
+                changed.append(child.container)
+    return changed
+
+
+COUNT_SLOTS = 8    # Length of Container.subtreeCounts .
+COUNT_SHARDS = 16    # CountShards of each Container.
+SHARD_RETRIES = 10
+
+
+def countSlot(contType, active):
+    """ Position in Container.subtreeCounts of the count of Containers of contType that are or aren't active."""
+    return (contType - ContentType.ROOT) * 2 + (1 if active else 0)
+
+
+def ownCounts(container):
+    """ Counts, laid out as subtreeCounts, of just container itself."""
+    counts = [0] * COUNT_SLOTS
+    if container.contType is not None:
+        counts[countSlot(container.contType, container.active)] = 1
+    return counts
+
+
+def totalCounts(container):
+    """ Counts of container and everything below it."""
+    return [own + below for own, below in zip(ownCounts(container), subtreeCounts(container))]
+
+
+def subtreeCounts(container, shards=None):
+    """ Counts of everything below container: its own subtreeCounts plus those in its CountShards."""
+    if shards is None:
+        shards = DataStore.get_multi(shardKeys(container.key))
+    counts = list(container.subtreeCounts or [0] * COUNT_SLOTS)
+    for shard in shards:
+        if shard is not None:
+            counts = [have + count for have, count in zip(counts, shard.counts)]
+    return counts
+
+
+def shardKeys(key):
+    """ Keys of the CountShards of the Container key."""
+    return ['%s.counts.%s' % (key, shard) for shard in range(COUNT_SHARDS)]
+
+
+def addCounts(container, counts, sign=1):
+    container.subtreeCounts = [have + sign * count
+                               for have, count in zip(container.subtreeCounts or [0] * COUNT_SLOTS, counts)]
+
+
+def changeActive(container, active):
+    """ Set container.active. Returns the change to the counts of the Containers above it."""
+    before = ownCounts(container)
+    container.active = active
+    return [after - was for after, was in zip(ownCounts(container), before)]
+
+
+def addSubtreeCounts(keys, counts):
+    """ Add counts to the subtree counts of each Container of keys. Each goes to a random one of its CountShards in a
+        transaction of its own, so the Containers themselves aren't written and changes under the same Container
+        rarely conflict. Call through callOnCommit() so the counts only change once what they count has been
+        committed. Counts lost to a failure in between are repaired by rebuildCounts()."""
+    if not any(counts):
+        return
+    for key in keys:
+        transaction(functools.partial(_addToShard, random.choice(shardKeys(key)), counts), retries=SHARD_RETRIES)
+
+
+def addSubtreeCountsOnCommit(keys, counts):
+    callOnCommit(functools.partial(addSubtreeCounts, list(keys), counts))
+
+
+def _addToShard(key, counts):
+    shard = DataStore(key=key).get()
+    if shard is None:
+        shard = CountShard(key=key, counts=[0] * COUNT_SLOTS)
+    shard.counts = [have + count for have, count in zip(shard.counts, counts)]
+    shard.put()
+
+
+def rebuildCounts(key=root_key):
+    """ Recount subtreeCounts of every Container below and including key, eg. for Containers from before they were
+        kept or after a failed write. The CountShards are folded into the Containers' own subtreeCounts, so nothing
+        else should be changing the tree meanwhile. Returns the number of Containers whose counts were wrong."""
+    container = DataStore(key=key).get()
+    if type(container) is not Container:
+        logging.error('Not a key: %s' % key)
+        raise TypeError
+    level = TreeLevel(None, None, None)
+    top = TreeNode(container, level)
+    level.nodes.append(top)
+    totals = {}    # {key: counts of it and everything below it}
+    changed = []
+    shards = []
+    wrong = 0
+    # Deepest first so every child is counted before its parent.
+    for node in reversed(list(top.walk())):
+        counts = [0] * COUNT_SLOTS
+        for child in node.children:
+            counts = [have + count for have, count in zip(counts, totals[child.key])]
+        totals[node.key] = [own + count for own, count in zip(ownCounts(node.container), counts)]
+        nodeShards = [shard for shard in DataStore.get_multi(shardKeys(node.key)) if shard is not None]
+        if subtreeCounts(node.container, nodeShards) != counts:
+            wrong += 1
+        if nodeShards or list(node.container.subtreeCounts or [0] * COUNT_SLOTS) != counts:
+            node.container.subtreeCounts = counts
+            changed.append(node.container)
+            shards.extend(shard.key for shard in nodeShards)
+    DataStore.put_multi(changed)
+    DataStore.delete_multi(shards)
+    return wrong
+
+
+def rebuildAncestors(key=root_key):
+    """ Repair .ancestors of every Container below key, eg. for Containers from before they were kept.
+        Returns the number changed."""
+    container = DataStore(key=key).get()
+    if type(container) is not Container:
+        logging.error('Not a key: %s' % key)
+        raise TypeError
+    changed = updateAncestors(container)
+    DataStore.put_multi(changed)
+    return len(changed)
+
+
+def attribCount(container, kind):
+    """ Number of attributes of kind, a class name, container has."""
+    kinds = list(container.attribKinds)
+    return container.attribCounts[kinds.index(kind)] if kind in kinds else 0
+
+
+def countAttrib(container, kind):
+    """ Add one to attribCount(container, kind)."""
+    kinds = list(container.attribKinds)
+    if kind in kinds:
+        counts = list(container.attribCounts)
+        counts[kinds.index(kind)] += 1
+        container.attribCounts = counts
+    else:
+        container.attribKinds = kinds + [kind]
+        container.attribCounts = list(container.attribCounts) + [1]
+
+
+def activeAttrib(container, kind):
+    """ Key of container's active attribute of kind, or None."""
+    for activeKind, key in zip(container.activeKinds, container.activeAttribs):
+        if activeKind == kind:
+            return key
+    return None
+
+
+def pointActiveAttrib(container, kind, key):
+    """ Make key, or None for none, container's active attribute of kind."""
+    pairs = [(activeKind, activeKey) for activeKind, activeKey in zip(container.activeKinds, container.activeAttribs)
+             if activeKind != kind]
+    if key is not None:
+        pairs.append((kind, key))
+    container.activeKinds = [activeKind for activeKind, activeKey in pairs]
+    container.activeAttribs = [activeKey for activeKind, activeKey in pairs]
+
+
+def summarizeAttribs(container):
+    """ Set the attribute counts and active pointers of container from its attributes if it doesn't have them,
+        eg. a Container from before they were kept. Where a kind has more than one active attribute the first stays
+        active. Returns {key: attribute} of the attributes switched off, to be .put()."""
+    if len(container.attribKinds) or not len(container.attributes):
+        return {}
+    changed = {}
+    for attribute in DataStore.get_multi(list(container.attributes)):
+        if attribute is None:
+            continue
+        kind = type(attribute).__name__
+        countAttrib(container, kind)
+        if attribute.active:
+            if activeAttrib(container, kind) is None:
+                pointActiveAttrib(container, kind, attribute.key)
+            else:
+                attribute.active = False
+                changed[attribute.key] = attribute
+    return changed
+
+
+def rebuildAttribSummaries(key=root_key):
+    """ summarizeAttribs() every Container below and including key. Returns the number of Containers changed."""
+    container = DataStore(key=key).get()
+    if type(container) is not Container:
+        logging.error('Not a key: %s' % key)
+        raise TypeError
+    level = TreeLevel(None, None, None)
+    top = TreeNode(container, level)
+    level.nodes.append(top)
+    count = 0
+    for node in top.walk():
+        if len(node.container.attributes) and not len(node.container.attribKinds):
+            DataStore.put_multi(summarizeAttribs(node.container).values() + [node.container])
+            count += 1
+    return count
+
+
+STRONG = 'strong'        # As data_ndb. Lookups here never start a transaction so both read the same way.
+EVENTUAL = 'eventual'
+CONSISTENCIES = (STRONG, EVENTUAL)
+
+
 class Element:
-    def __init__(self, key=None, active=None, contType=None, menuParent=None):
+    def __init__(self, key=None, active=None, contType=None, menuParent=None, consistency=STRONG):
+        if consistency not in CONSISTENCIES:
+            logging.error('Not a consistency: %s' % consistency)
+            raise TypeError
         self.key = None
         self.container = None
         self.attribs = None
         self.keys = []
         self.containers = []
+        self.consistency = consistency
         if key is not None:
             self.lookup(key=key, active=active, contType=contType)
         else:
@@ -279,14 +2111,23 @@ class Element:
         return
 
     def lookupMultiple(self, keys=None, active=None, contType=None):
-            keys = list(set(keys))
-            keys = [k for k in keys if type(k) is StringType]
+            # Keep the first of any duplicates, in the order they were asked for.
+            seen = set()
+            keys = [k for k in keys if type(k) is StringType and not (k in seen or seen.add(k))]
+            # Discard keys the Container indexes already rule out before fetching anything.
+            if active is not None:
+                allowed = indexedKeys(Container.__name__, 'active', [active])
+                keys = [k for k in keys if k in allowed]
+            if contType is not None:
+                allowed = indexedKeys(Container.__name__, 'contType', contType)
+                keys = [k for k in keys if k in allowed]
             self.keys = []
             self.containers = []
-            for key in keys:
-                entity = DataStore(key=key).get()
+            for entity in DataStore.get_multi(keys):
                 if entity is None:
                     continue
+                # The indexes are as of the last .put() so the entity read, from a transaction's snapshot or
+                # changed in place since, may not match them.
                 if active is not None and not entity.active == active:
                     continue
                 if contType is not None and entity.contType not in contType:
@@ -295,6 +2136,125 @@ class Element:
                 self.containers.append(entity)
             return
 
+    def getDescendants(self, depth=1, contType=None, active=None):
+        """ TreeNode of this Element's container whose .children go down depth levels (None for all of them),
+            or None if there isn't a container.
+            Children that don't match contType (one or a list) or active are left out, along with everything below
+            them. Levels are fetched as they are first used."""
+        if contType is not None and type(contType) is not ListType:
+            contType = [contType]
+        # Get up to date version of container from datastore incase self.container is stale.
+        container = DataStore(key=self.key).get() if self.key is not None else None
+        if type(container) is not Container:
+            return None
+        level = TreeLevel(depth, active, contType)
+        root = TreeNode(container, level)
+        level.nodes.append(root)
+        return root
+
+    def getBreadcrumbs(self):
+        """ Containers from the root down to this Element's menuParent, fetched together."""
+        container = self.container if self.container is not None else DataStore(key=self.key).get()
+        if container is None:
+            return []
+        return [ancestor for ancestor in DataStore.get_multi(list(container.ancestors)) if ancestor is not None]
+
+    def countDescendants(self, contType=None, active=None):
+        """ Number of Containers below this Element of contType (one or a list) and active, from its subtreeCounts."""
+        if contType is not None and type(contType) is not ListType:
+            contType = [contType]
+        container = self.container if self.container is not None else DataStore(key=self.key).get()
+        if container is None:
+            return 0
+        counts = subtreeCounts(container)
+        total = 0
+        for slotType in (ContentType.ROOT, ContentType.AREA, ContentType.CRAG, ContentType.CLIMB):
+            for slotActive in (False, True):
+                if (contType is None or slotType in contType) and (active is None or bool(active) == slotActive):
+                    total += counts[countSlot(slotType, slotActive)]
+        return total
+
+    @transactional
+    def setActive(self, active):
+        """ Set .active of this Element's Container. The counts of the Containers above it follow once it commits."""
+        container = DataStore(key=self.key).get()
+        if type(container) is not Container:
+            logging.error('Not a key: %s' % self.key)
+            raise TypeError
+        addSubtreeCountsOnCommit(container.ancestors, changeActive(container, active))
+        container.put()
+        # Do this last so it is not done yet if transaction is rolled back.
+        self.container = container
+
+    @transactional
+    def setAttribActive(self, key):
+        """ Make attribute key the active one of its kind and switch off the one that was.
+            Writes the two attributes and the Container whatever the number of attributes."""
+        container = DataStore(key=self.key).get()
+        attribute = DataStore(key=key).get()
+        if type(container) is not Container or not isinstance(attribute, Attrib) or key not in container.attributes:
+            logging.error('Not an attribute of %s: %s' % (self.key, key))
+            raise TypeError
+        changed = summarizeAttribs(container)
+        attribute = changed.get(key, attribute)
+        kind = type(attribute).__name__
+        previous = activeAttrib(container, kind)
+        if previous is not None and previous != key:
+            old = changed.get(previous) or DataStore(key=previous).get()
+            if old is not None:
+                old.active = False
+                changed[previous] = old
+        attribute.active = True
+        changed[key] = attribute
+        pointActiveAttrib(container, kind, key)
+        DataStore.put_multi(changed.values() + [container])
+        # Do this last so it is not done yet if transaction is rolled back.
+        self.container = container
+
+    def isUnder(self, key):
+        """ True if the Container key is above this Element in the tree."""
+        container = self.container if self.container is not None else DataStore(key=self.key).get()
+        return container is not None and key in container.ancestors
+
+    @transactional(xg=True)
+    def move(self, menuParent):
+        """ Make this Element a child of menuParent, an Element or key, and update .ancestors of everything below it.
+            The counts of the Containers above it, old and new, follow once it commits."""
+        parentKey = menuParent if type(menuParent) is StringType else menuParent.key
+        container = DataStore(key=self.key).get()
+        newParent = DataStore(key=parentKey).get()
+        if (type(container) is not Container or type(newParent) is not Container or
+                parentKey == self.key or self.key in newParent.ancestors):
+            logging.error('Can not move %s under %s' % (self.key, parentKey))
+            raise TypeError
+        if container.menuParent == parentKey:
+            return
+
+        # Take the subtree's counts off the old parent and add them to the new one. The Containers above them
+        # follow on commit.
+        totals = totalCounts(container)
+        changed = [container, newParent]
+        oldParent = DataStore(key=container.menuParent).get() if container.menuParent is not None else None
+        if oldParent is not None:
+            if self.key in oldParent.menuChildren:
+                oldParent.menuChildren.remove(self.key)
+            addCounts(oldParent, totals, -1)
+            addSubtreeCountsOnCommit(oldParent.ancestors, [-count for count in totals])
+            changed.append(oldParent)
+        delta = totals
+        if self.key not in newParent.menuChildren:
+            newParent.menuChildren.append(self.key)
+            delta = [count + change for count, change in zip(totals, changeActive(newParent, True))]
+        addCounts(newParent, totals)
+        addSubtreeCountsOnCommit(newParent.ancestors, delta)
+        container.menuParent = parentKey
+        container.ancestors = list(newParent.ancestors) + [parentKey]
+        changed.extend(updateAncestors(container))
+        DataStore.put_multi(changed)
+        # Do this last so it is not done yet if transaction is rolled back.
+        self.container = container
+
+    @transactional(xg=True)
     def create(self, active=None, contType=None, menuParent=None):
         user = users.get_current_user()
         if user is not None:
@@ -305,13 +2265,12 @@ class Element:
                     tmpContainer = Container(key=root_key).get()
                     if tmpContainer is None:
                         tmpContainer = Container(key=root_key, active=True, contType=contType, menuParent=None, menuChildren=[])
-                        tmpKey = tmpContainer.put()
+                        tmpKey = tmpContainer.key
 
-                        attribute = AttribName(parent=tmpKey, text="root", authur=user)
-                        attributeKey = attribute.put()
-
-                        tmpContainer.attributes = [attributeKey]
-                        tmpContainer.put()
+                        attribute = AttribName(key=DataStore.allocate_key(), parent=tmpKey, text="root", authur=user)
+                        tmpContainer.attributes = [attribute.key]
+                        countAttrib(tmpContainer, AttribName.__name__)
+                        DataStore.put_multi([tmpContainer, attribute])
                 if tmpKey is None:
                     logging.info('Tried to bootstrap but something went wrong')
                     logging.info('user:  %s' % user)
@@ -341,48 +2300,74 @@ class Element:
                     active = False
 
                 #self.container = Container(parent=root_key, active=active, contType=contType, menuParent=menuParent.key)
-                tmpContainer = Container(active=active, contType=contType, menuParent=menuParent.key, menuChildren=[])
-                tmpKey = tmpContainer.put()
-
+                tmpContainer = Container(key=DataStore.allocate_key(), active=active, contType=contType,
+                                         menuParent=menuParent.key, menuChildren=[],
+                                         ancestors=list(menuParent.container.ancestors) + [menuParent.key])
+                tmpKey = tmpContainer.key
+
+                # Only the new Container and its parent are written here. The counts of the Containers above
+                # follow on commit so that creating anywhere in the tree doesn't write the root.
+                delta = ownCounts(tmpContainer)
                 if tmpKey not in menuParent.container.menuChildren:
                     menuParent.container.menuChildren.append(tmpKey)
-                    menuParent.container.active = True
-                    menuParent.container.put()
+                    delta = [count + change
+                             for count, change in zip(delta, changeActive(menuParent.container, True))]
+                addCounts(menuParent.container, ownCounts(tmpContainer))
+                addSubtreeCountsOnCommit(menuParent.container.ancestors, delta)
+                DataStore.put_multi([tmpContainer, menuParent.container])
             # Do these last so they are not done yet if transaction is rolled back.
             self.key = tmpKey
             self.container = tmpContainer
 
+    @data_trace.traced('Element.addAttrib', key=lambda self, attribute: self.key,
+                       fields=lambda self, attribute: {'kind': type(attribute).__name__})
+    @transactional
     def addAttrib(self, attribute):
         user = users.get_current_user()
         if user is not None:
             attributeClass = type(attribute)
             attributeInstance = attributeClass()
             attributeInstance.authur=user
-            logging.debug(attributeInstance)
-            logging.debug(dir(attributeInstance))
 
             query = attributeInstance.query(ancestor=self.key).filter(attributeClass.authur==user)
-            logging.debug(attributeClass.authur)
-            logging.debug(attributeClass.authur==user)
 
-            #query = query.filter(authur==user)
-            #existingAttribs = query.fetch(1)
-            #existingAttribs = attributeInstance.query(ancestor=self.key)#.filter(attributeInstance.authur==user).fetch(1)
+            existingAttribs = query.fetch(1)
 
             if len(existingAttribs):
-                props = attribute.to_dict()
+                # Keep who wrote it and when, which the new attribute hasn't got.
+                props = attribute.to_dict(exclude=['authur', 'created', 'modified'])
                 attribute = existingAttribs[0]
                 attribute.populate(**props)
             else:
                 attribute.authur = user
                 attribute = copyAttrib(attribute, self.key)
+            # Get up to date version of container from datastore incase the one hee is stale.
+            tmpContainer = DataStore(key=self.key).get()
+            changed = summarizeAttribs(tmpContainer)
             attributeKey = attribute.put()
 
-            # Get up to date version of container from datastore incase the one hee is stale.
-            tmpContainer = self.key.get()
+            kind = type(attribute).__name__
+            containerChanged = bool(changed)
             if attributeKey and attributeKey not in tmpContainer.attributes:
                 tmpContainer.attributes.append(attributeKey)
-                tmpContainer.put()
+                countAttrib(tmpContainer, kind)
+                containerChanged = True
+            previous = activeAttrib(tmpContainer, kind)
+            if attribute.active and previous != attributeKey:
+                # Only one active attribute of a kind.
+                if previous is not None:
+                    old = changed.get(previous) or DataStore(key=previous).get()
+                    if old is not None:
+                        old.active = False
+                        changed[previous] = old
+                pointActiveAttrib(tmpContainer, kind, attributeKey)
+                containerChanged = True
+            elif not attribute.active and previous == attributeKey:
+                pointActiveAttrib(tmpContainer, kind, None)
+                containerChanged = True
+            changed.pop(attributeKey, None)
+            if containerChanged:
+                DataStore.put_multi(changed.values() + [tmpContainer])
                 # Do this after .put() so self.container is not modified if transaction is rolledback.
                 self.container = tmpContainer
 
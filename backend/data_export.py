@@ -0,0 +1,231 @@
+""" Stream the route tree to and from a file of JSON lines, for moving a database between environments.
+    eg.
+        exportTree('/tmp/routes.jsonl.gz', DictStore())    # or NdbStore()
+        ...
+        importTree('/tmp/routes.jsonl.gz', DictStore())
+
+    The tree is walked depth first from the root so memory use depends on its depth and the widest Container,
+    not on its size. Files ending in .gz are compressed.
+
+    The first line is HEADER. Each following line is one entity:
+        {"kind": class name, "key": key, "parent": parent key, "values": {label: value}}
+    Keys are strings for data_dict and [kind, id, ...] from ndb.Key.flat() for data_ndb, which has no separate parent.
+    Values that JSON doesn't have are written as {"datetime": ISO 8601} and {"user": email, "auth_domain": domain, "user_id": id}.
+    Enums are their number.
+"""
+import datetime
+import gzip
+import itertools
+import json
+
+from google.appengine.api import users
+
+import data_dict
+
+FORMAT = 'routeticker'
+VERSION = 1
+HEADER = {'format': FORMAT, 'version': VERSION}
+BATCH = 500    # Entities fetched or written at a time.
+ENCODER = json.JSONEncoder(separators=(',', ':'))    # Not sort_keys=True as that stops json using its C encoder.
+
+
+class DictStore(object):
+    """ Reads and writes data_dict."""
+    rootKey = data_dict.root_key
+
+    def kind(self, name):
+        cls = getattr(data_dict, name, None)
+        if not isinstance(cls, data_dict.DescriptorOwner):
+            raise TypeError('%s is not a data_dict class.' % name)
+        return cls
+
+    def get_multi(self, keys):
+        return data_dict.DataStore.get_multi(keys)
+
+    def shardKeys(self, key):
+        return data_dict.shardKeys(key)
+
+    def put_multi(self, entities):
+        # Stored directly rather than with DataStore.put_multi() so auto_now doesn't change the modified times.
+        # The values were checked as the entities were built.
+        data_dict.storeMulti([(entity.key, entity) for entity in entities])
+        numbers = [data_dict.keyNumber(entity.key) for entity in entities]
+        data_dict.reserveKeys(max([number for number in numbers if number is not None] or [0]))
+
+    def toRecord(self, entity):
+        values = dict((label, self.encodeValue(value)) for label, value in entity.to_dict().iteritems())
+        return {'kind': type(entity).__name__, 'key': entity.key, 'parent': getattr(entity, 'parent', None),
+                'values': values}
+
+    def fromRecord(self, record):
+        cls = self.kind(record['kind'])
+        values = dict((str(label), self.decodeValue(value)) for label, value in record['values'].iteritems())
+        entity = cls(**values)
+        entity.key = self.decodeValue(record['key'])
+        entity.parent = self.decodeValue(record['parent'])
+        return entity
+
+    def encodeValue(self, value):
+        if type(value) is datetime.datetime:
+            return {'datetime': value.isoformat()}
+        if isinstance(value, users.User):
+            return {'user': value.email(), 'auth_domain': value.auth_domain(), 'user_id': value.user_id()}
+        if isinstance(value, list):
+            return map(self.encodeValue, value)
+        return value
+
+    def decodeValue(self, value):
+        if type(value) is dict:
+            if 'datetime' in value:
+                text = value['datetime']
+                return datetime.datetime.strptime(text, '%Y-%m-%dT%H:%M:%S.%f' if '.' in text else '%Y-%m-%dT%H:%M:%S')
+            if 'user' in value:
+                authDomain = value.get('auth_domain')    # Missing from files exported before it was kept.
+                return users.User(email=str(value['user']), _auth_domain=authDomain and str(authDomain),
+                                  _user_id=value['user_id'] and str(value['user_id']))
+            raise ValueError('Unknown value: %s' % (value,))
+        if type(value) is list:
+            return map(self.decodeValue, value)
+        if type(value) is unicode:
+            # StringProperty only takes str.
+            return value.encode('utf-8')
+        return value
+
+
+class NdbStore(DictStore):
+    """ Reads and writes data_ndb."""
+    def __init__(self):
+        from google.appengine.ext import ndb
+        from google.appengine.ext.ndb import msgprop
+        from protorpc import messages
+        import data_ndb
+        self.ndb = ndb
+        self.msgprop = msgprop
+        self.messages = messages
+        self.models = data_ndb
+        self.rootKey = data_ndb.root_key
+
+    def kind(self, name):
+        cls = getattr(self.models, name, None)
+        if not (isinstance(cls, type) and issubclass(cls, self.ndb.Model)):
+            raise TypeError('%s is not a data_ndb class.' % name)
+        return cls
+
+    def get_multi(self, keys):
+        return self.ndb.get_multi(keys)
+
+    def shardKeys(self, key):
+        return self.models.shardKeys(key)
+
+    def put_multi(self, entities):
+        # Unlike DictStore, properties with auto_now are set to the time of the import.
+        self.models.putMulti(entities)
+        # Stop the datastore handing out the imported ids again. Ids under a parent are left as allocate_ids() works
+        # per parent and automatic ids for child entities are scattered.
+        highest = {}
+        for entity in entities:
+            key = entity.key
+            if key.parent() is None and type(key.id()) in (int, long):
+                highest[key.kind()] = max(highest.get(key.kind(), 0), key.id())
+        for kind, number in highest.items():
+            self.kind(kind).allocate_ids(max=number)
+
+    def toRecord(self, entity):
+        values = dict((label, self.encodeValue(value)) for label, value in entity.to_dict().iteritems())
+        return {'kind': type(entity).__name__, 'key': list(entity.key.flat()), 'parent': None, 'values': values}
+
+    def fromRecord(self, record):
+        cls = self.kind(record['kind'])
+        values = {}
+        for label, value in record['values'].iteritems():
+            value = self.decodeValue(value)
+            prop = cls._properties[label]
+            if isinstance(prop, self.msgprop.EnumProperty) and value is not None:
+                value = prop._enum_type(value)
+            values[str(label)] = value
+        return cls(key=self.decodeKey(record['key']), **values)
+
+    def encodeValue(self, value):
+        if isinstance(value, self.ndb.Key):
+            return {'key': list(value.flat())}
+        if isinstance(value, self.messages.Enum):
+            return value.number
+        return DictStore.encodeValue(self, value)
+
+    def decodeValue(self, value):
+        if type(value) is dict and 'key' in value:
+            return self.decodeKey(value['key'])
+        if type(value) is list:
+            return map(self.decodeValue, value)
+        if type(value) is unicode:
+            # ndb takes unicode but keep str where it was str so it compares the same.
+            return value
+        return DictStore.decodeValue(self, value)
+
+    def decodeKey(self, flat):
+        return self.ndb.Key(flat=[item.encode('utf-8') if type(item) is unicode else item for item in flat])
+
+
+def fetch(store, keys, batchSize=BATCH):
+    """ The entities of keys that exist, fetched batchSize at a time."""
+    for start in xrange(0, len(keys), batchSize):
+        for entity in store.get_multi(keys[start:start + batchSize]):
+            if entity is not None:
+                yield entity
+
+
+def walk(store, rootKey=None, batchSize=BATCH):
+    """ Every Container below and including rootKey (default the root of the tree), each followed by its attributes
+        and the CountShards holding the rest of its subtreeCounts. Depth first so a parent always comes before its
+        children."""
+    stack = [fetch(store, [rootKey if rootKey is not None else store.rootKey], batchSize)]
+    while stack:
+        container = next(stack[-1], None)
+        if container is None:
+            stack.pop()
+            continue
+        yield container
+        for entity in fetch(store, list(container.attributes) + store.shardKeys(container.key), batchSize):
+            yield entity
+        if container.menuChildren:
+            stack.append(fetch(store, list(container.menuChildren), batchSize))
+
+
+def openFile(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def exportTree(path, store, rootKey=None, batchSize=BATCH):
+    """ Write the tree below rootKey to path. Returns the number of entities written."""
+    count = 0
+    with openFile(path, 'wb') as exportFile:
+        exportFile.write(json.dumps(HEADER, sort_keys=True) + '\n')
+        for entity in walk(store, rootKey, batchSize):
+            exportFile.write(ENCODER.encode(store.toRecord(entity)) + '\n')
+            count += 1
+    return count
+
+
+def records(path):
+    """ The entity records in a file written by exportTree(), read one line at a time."""
+    with openFile(path, 'rb') as importFile:
+        header = json.loads(importFile.readline() or 'null')
+        if type(header) is not dict or header.get('format') != FORMAT or header.get('version') != VERSION:
+            raise ValueError('%s is not a version %s %s export.' % (path, VERSION, FORMAT))
+        for line in importFile:
+            if line.strip():
+                yield json.loads(line)
+
+
+def importTree(path, store, batchSize=BATCH):
+    """ .put() every entity in path, keeping their keys, batchSize at a time. Returns the number of entities."""
+    count = 0
+    entities = itertools.imap(store.fromRecord, records(path))
+    while True:
+        batch = list(itertools.islice(entities, batchSize))
+        if not batch:
+            return count
+        store.put_multi(batch)
+        count += len(batch)
@@ -0,0 +1,220 @@
+""" Durable storage for data_dict: an append-only log of every .put(), .delete() and clear() plus periodic snapshots.
+    eg.
+        journal = Journal('/var/lib/routeticker')
+        journal.open()    # Recover from the last snapshot and the log after it, then log everything from now on.
+        ...
+        journal.close()
+
+    Files in the directory:
+        snapshot.<N>  data_dict.dumpState() as it was before anything in log.<N> was written.
+        log.<N>       Records, each framed as RECORD_HEADER followed by the pickled record.
+    Recovery loads the newest snapshot and replays the logs numbered the same or higher.
+"""
+import cPickle as pickle
+import logging
+import os
+import struct
+import threading
+import zlib
+
+import data_dict
+
+RECORD_HEADER = struct.Struct('<II')    # (length of the pickled record, crc32 of the pickled record)
+
+PUT = 1       # (PUT, data_dict.dumpEntities() of the entity, gKeyCounter) Only in logs written before COMMIT.
+DELETE = 2    # (DELETE, key) Only in logs written before COMMIT.
+CLEAR = 3     # (CLEAR,)
+COMMIT = 4    # (COMMIT, [(key, data_dict.dumpEntities() of the entity or None if deleted)], gKeyCounter)
+              # Everything one data_dict.storeMulti() wrote, so it is replayed all or nothing.
+
+
+class Journal(object):
+    def __init__(self, directory, sync=False, snapshotEvery=100000, background=True):
+        self.directory = directory
+        self.sync = sync                        # os.fsync() after every record rather than leaving it to the OS.
+        self.snapshotEvery = snapshotEvery      # Records between automatic snapshots. None to only snapshot on request.
+        self.background = background    # Write snapshots to disk from another thread.
+        self.segment = None    # Number of the log being appended to.
+        self.log = None
+        self.records = 0       # Records written since the last snapshot.
+        self.snapshotThread = None    # Thread starting an automatic snapshot.
+        self.writerThread = None      # Thread writing a background snapshot.
+        self.lock = threading.RLock()    # Taken after data_dict's gWriteLock, never before.
+
+    def open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.recover()
+        self._startSegment(max(self._segments('log') + self._segments('snapshot') + [0]) + 1)
+        data_dict.addListener(self.write, commit=True)
+
+    def close(self):
+        data_dict.removeListener(self.write, commit=True)
+        self.wait()
+        if self.log is not None:
+            self.log.close()
+            self.log = None
+
+    def recover(self):
+        """ Replace the contents of data_dict with the newest snapshot plus the log records written after it.
+            A record that was only partly written when the process died is discarded."""
+        snapshots = self._segments('snapshot')
+        base = 0
+        if snapshots:
+            base = snapshots[-1]
+            with open(self._path('snapshot', base), 'rb') as snapshotFile:
+                with data_dict.gcPaused():
+                    state = pickle.load(snapshotFile)
+                data_dict.loadState(state)
+        else:
+            data_dict.clear()
+
+        records = 0
+        for segment in self._segments('log'):
+            if segment >= base:
+                records += self._replay(segment)
+        logging.info('Recovered %s entities from snapshot %s and %s log records.' % (len(data_dict.gContainer), base, records))
+
+    def write(self, items):
+        """ Listener for data_dict.gCommitListeners ."""
+        if items == [(None, None)]:
+            record = (CLEAR,)
+        else:
+            record = (COMMIT, [(key, None if entity is None else data_dict.dumpEntities(type(entity), [entity]))
+                               for key, entity in items], data_dict.gKeyCounter)
+        data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            self.log.write(RECORD_HEADER.pack(len(data), zlib.crc32(data) & 0xffffffff))
+            self.log.write(data)
+            self.log.flush()
+            if self.sync:
+                os.fsync(self.log.fileno())
+
+            self.records += 1
+            if (self.snapshotEvery is not None and self.records >= self.snapshotEvery and
+                    not self._running(self.snapshotThread) and not self._running(self.writerThread)):
+                # This thread holds data_dict's gWriteLock, which a snapshot needs, so start it from another
+                # thread.
+                self.snapshotThread = threading.Thread(target=self.snapshot)
+                self.snapshotThread.start()
+
+    def snapshot(self):
+        """ Start a new log and write a snapshot of everything before it.
+            Once the snapshot is complete the older logs and snapshots are deleted.
+            Writers are only held up while the new log is started and a data_dict.openSnapshot() version taken.
+            The store as it was at that version is then copied and written to disk, before this returns or from
+            another thread if self.background ."""
+        with data_dict.gWriteLock, self.lock:
+            if self._running(self.writerThread):
+                logging.warning('Snapshot %s still being written.' % self.segment)
+                return
+            segment = self.segment + 1
+            self._startSegment(segment)
+            self.records = 0
+            # No write is part done while gWriteLock is held, so the new log has every write after version.
+            version = data_dict.openSnapshot()
+            if self.background:
+                self.writerThread = threading.Thread(target=self._writeInBackground, args=(segment, version))
+                self.writerThread.start()
+                return
+        self._writeVersion(segment, version)
+
+    def _writeInBackground(self, segment, version):
+        try:
+            self._writeVersion(segment, version)
+        except Exception:
+            logging.exception('Writing snapshot %s failed.' % segment)
+
+    def _writeVersion(self, segment, version):
+        try:
+            state = data_dict.dumpState(version)
+        finally:
+            data_dict.closeSnapshot(version)
+        self._writeSnapshot(segment, state)
+        with self.lock:
+            self._prune(segment)
+
+    def wait(self):
+        """ Block until any background snapshot has finished."""
+        if self.snapshotThread is not None:
+            self.snapshotThread.join()
+        # Only once the snapshotThread is done, as it may start a writerThread.
+        if self.writerThread is not None:
+            self.writerThread.join()
+
+    def _running(self, thread):
+        return thread is not None and thread.is_alive()
+
+    def _writeSnapshot(self, segment, state):
+        path = self._path('snapshot', segment)
+        with open(path + '.tmp', 'wb') as snapshotFile:
+            pickle.dump(state, snapshotFile, pickle.HIGHEST_PROTOCOL)
+            snapshotFile.flush()
+            os.fsync(snapshotFile.fileno())
+        os.rename(path + '.tmp', path)
+
+    def _prune(self, segment):
+        """ Delete the files snapshot <segment> makes redundant."""
+        for prefix in ('snapshot', 'log'):
+            for older in self._segments(prefix):
+                if older < segment:
+                    os.remove(self._path(prefix, older))
+
+    def _replay(self, segment):
+        """ Apply the records in log <segment>. Returns the number applied."""
+        path = self._path('log', segment)
+        records = 0
+        good = 0    # Offset of the end of the last complete record.
+        with open(path, 'rb') as logFile:
+            while True:
+                header = logFile.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                length, crc = RECORD_HEADER.unpack(header)
+                data = logFile.read(length)
+                if len(data) < length or zlib.crc32(data) & 0xffffffff != crc:
+                    break
+                self._apply(pickle.loads(data))
+                records += 1
+                good = logFile.tell()
+        if good < os.path.getsize(path):
+            logging.warning('Discarding %s bytes of incomplete record from %s.' % (os.path.getsize(path) - good, path))
+            with open(path, 'r+b') as logFile:
+                logFile.truncate(good)
+        return records
+
+    def _apply(self, record):
+        if record[0] == COMMIT:
+            unused, dumped, keyCounter = record
+            data_dict.storeMulti([(key, None if entity is None else data_dict.loadEntities(entity)[0][0])
+                                  for key, entity in dumped])
+            data_dict.reserveKeys(keyCounter)
+        elif record[0] == PUT:
+            unused, dumped, keyCounter = record
+            entities, columns = data_dict.loadEntities(dumped)
+            data_dict.store(entities[0].key, entities[0])
+            data_dict.reserveKeys(keyCounter)
+        elif record[0] == DELETE:
+            data_dict.remove(record[1])
+        elif record[0] == CLEAR:
+            data_dict.clear()
+        else:
+            raise ValueError('Unknown log record: %s' % (record,))
+
+    def _startSegment(self, segment):
+        if self.log is not None:
+            self.log.close()
+        self.segment = segment
+        self.log = open(self._path('log', segment), 'ab')
+
+    def _path(self, prefix, segment):
+        return os.path.join(self.directory, '%s.%08d' % (prefix, segment))
+
+    def _segments(self, prefix):
+        """ Sorted numbers of the complete files called <prefix>.<N> ."""
+        segments = []
+        for name in os.listdir(self.directory):
+            start, dot, number = name.partition('.')
+            if start == prefix and number.isdigit():
+                segments.append(int(number))
+        return sorted(segments)
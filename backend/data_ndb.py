@@ -2,9 +2,15 @@ from google.appengine.ext import ndb
 from google.appengine.ext.ndb import msgprop
 from protorpc import messages
 from google.appengine.api import users
+from google.appengine.datastore import entity_pb
+import functools
 import logging
+import random
 from types import *
 
+import data_cache
+import data_session
+
 root_key = ndb.Key('Container', 'root')
 
 class Type(messages.Enum):
@@ -19,6 +25,17 @@ class Container(ndb.Model):
     menuParent = ndb.KeyProperty()
     menuChildren = ndb.KeyProperty(repeated=True)
     attributes = ndb.KeyProperty(repeated=True)
+    ancestors = ndb.KeyProperty(repeated=True)    # Keys of the menuParent chain, root first. See Element.move()
+    subtreeCounts = ndb.IntegerProperty(repeated=True, indexed=False)    # Containers below this one. See countSlot()
+    attribKinds = ndb.StringProperty(repeated=True, indexed=False)    # Attribute kinds, their number in attribCounts .
+    attribCounts = ndb.IntegerProperty(repeated=True, indexed=False)
+    activeAttribs = ndb.KeyProperty(repeated=True, indexed=False)    # The active attribute of each kind that has one.
+
+
+class CountShard(ndb.Model):
+    """ Part of the subtreeCounts of a Container, kept apart so that changes below the same Container rarely write
+        the same entity group. See addSubtreeCounts()."""
+    counts = ndb.IntegerProperty(repeated=True, indexed=False)
 
 
 class Attrib(ndb.Model):
@@ -36,6 +53,415 @@ class AttribDescription(Attrib):
     text = ndb.TextProperty()
 
 
+GET_MULTI_BATCH = 1000    # Most keys the datastore takes in one get.
+
+
+class TreeNode(object):
+    """ A Container in the tree returned by Element.getDescendants().
+        The children of every node at the same depth are fetched together the first time any of them is asked for,
+        so walking the whole tree takes one round of ndb.get_multi() per level."""
+    __slots__ = ('key', 'container', 'level', '_children')
+
+    def __init__(self, container, level):
+        self.key = container.key
+        self.container = container
+        self.level = level          # TreeLevel this node is in.
+        self._children = None       # Set by self.level.loadChildren()
+
+    @property
+    def children(self):
+        """ TreeNodes of the menuChildren that pass the filters, in menuChildren order. Empty below the depth asked for."""
+        if self._children is None:
+            self.level.loadChildren()
+        return self._children
+
+    def walk(self):
+        """ This node and everything below it, a level at a time."""
+        level = [self]
+        while level:
+            for node in level:
+                yield node
+            level = [child for node in level for child in node.children]
+
+
+class TreeLevel(object):
+    """ The TreeNodes at one depth of a getDescendants() tree."""
+    def __init__(self, remaining, active, contType, options=None):
+        self.nodes = []
+        self.remaining = remaining    # Levels that may still be fetched below this one. None for no limit.
+        self.active = active
+        self.contType = contType
+        self.options = options or {}    # readOptions() to fetch the children with.
+
+    def matches(self, container):
+        return (type(container) is Container and
+                (self.active is None or container.active == self.active) and
+                (self.contType is None or container.contType in self.contType))
+
+    def loadChildren(self):
+        if self.remaining == 0:
+            for node in self.nodes:
+                node._children = []
+            return
+        keys = [key for node in self.nodes for key in node.container.menuChildren]
+        containers = dict(zip(keys, batchedGetMulti(keys, **self.options)))
+
+        childLevel = TreeLevel(None if self.remaining is None else self.remaining - 1, self.active, self.contType,
+                               self.options)
+        for node in self.nodes:
+            node._children = []
+            for key in node.container.menuChildren:
+                container = containers.get(key)
+                if container is not None and self.matches(container):
+                    child = TreeNode(container, childLevel)
+                    childLevel.nodes.append(child)
+                    node._children.append(child)
+
+
+PUT_MULTI_BATCH = 500
+
+
+def updateAncestors(container):
+    """ Set .ancestors of every Container below container from container's own.
+        Returns the ones that changed, to be .put()."""
+    level = TreeLevel(None, None, None)
+    top = TreeNode(container, level)
+    level.nodes.append(top)
+    changed = []
+    # walk() yields a node before its children so each child's parent is already up to date.
+    for node in top.walk():
+        ancestors = list(node.container.ancestors) + [node.key]
+        for child in node.children:
+            if child.container.ancestors != ancestors:
+                child.container.ancestors = ancestors
+                changed.append(child.container)
+    return changed
+
+
+def encodeEntity(entity):
+    return ndb.ModelAdapter().entity_to_pb(entity).Encode()
+
+
+def decodeEntity(data):
+    return ndb.ModelAdapter().pb_to_entity(entity_pb.EntityProto(data))
+
+
+def cachedGetMulti(keys, **options):
+    """ ndb.get_multi(keys, **options) through the current data_session and data_cache when they are enabled.
+        Reads in a transaction go straight to the datastore so they are part of it, and only eventually consistent
+        reads use data_cache as it can be ttl seconds behind."""
+    if ndb.in_transaction():
+        return ndb.get_multi(keys, **options)
+    session = data_session.current()
+    if session is not None:
+        return session.get_multi(keys, lambda missing: fetchThroughCache(missing, **options))
+    return fetchThroughCache(keys, **options)
+
+
+def usesCache(options):
+    """ True if a read with options, outside a transaction, goes through data_cache."""
+    return data_cache.gCache is not None and options.get('read_policy') == ndb.EVENTUAL_CONSISTENCY
+
+
+def fetchThroughCache(keys, **options):
+    cache = data_cache.gCache
+    if not usesCache(options):
+        return ndb.get_multi(keys, **options)
+    names = [key.urlsafe() for key in keys]
+
+    def fetch(missing):
+        entities = ndb.get_multi([ndb.Key(urlsafe=name) for name in missing], **options)
+        return dict((name, encodeEntity(entity)) for name, entity in zip(missing, entities) if entity is not None)
+    found = cache.get_multi(names, fetch)
+    return [decodeEntity(found[name]) if name in found else None for name in names]
+
+
+@ndb.tasklet
+def cachedGetMulti_async(keys, **options):
+    """ cachedGetMulti() returning a Future, which only waits on the datastore if it isn't answered from
+        data_session or data_cache."""
+    if ndb.in_transaction() or (not usesCache(options) and data_session.current() is None):
+        entities = yield ndb.get_multi_async(keys, **options)
+    else:
+        entities = cachedGetMulti(keys, **options)
+    raise ndb.Return(entities)
+
+
+def batchedGetMulti(keys, **options):
+    """ cachedGetMulti() of any number of keys, GET_MULTI_BATCH at a time."""
+    # Start every batch before waiting for any of them.
+    futures = [cachedGetMulti_async(keys[start:start + GET_MULTI_BATCH], **options)
+               for start in range(0, len(keys), GET_MULTI_BATCH)]
+    return [entity for future in futures for entity in future.get_result()]
+
+
+def invalidate(keys):
+    """ Drop keys from data_cache and the current data_session after they are written, once the current transaction
+        commits if there is one."""
+    keys = [key for key in keys if key is not None]
+    cache = data_cache.gCache
+    if cache is not None:
+        names = [key.urlsafe() for key in keys]
+        # Called straight away outside a transaction.
+        ndb.get_context().call_on_commit(lambda: cache.invalidate(names))
+    session = data_session.current()
+    if session is not None:
+        ndb.get_context().call_on_commit(lambda: session.forget(keys))
+
+
+def putMulti(entities):
+    """ ndb.put_multi(entities) and drop them from data_cache."""
+    keys = ndb.put_multi(entities)
+    invalidate(keys)
+    return keys
+
+
+def putInBatches(entities):
+    for start in range(0, len(entities), PUT_MULTI_BATCH):
+        putMulti(entities[start:start + PUT_MULTI_BATCH])
+
+
+def rebuildAncestors(key=root_key):
+    """ Repair .ancestors of every Container below key, eg. for Containers from before they were kept.
+        Returns the number changed."""
+    container = key.get()
+    if type(container) is not Container:
+        logging.error('Not a key: %s' % key)
+        raise TypeError
+    changed = updateAncestors(container)
+    putInBatches(changed)
+    return len(changed)
+
+
+COUNT_SLOTS = 8    # Length of Container.subtreeCounts .
+COUNT_SHARDS = 16    # CountShards of each Container.
+SHARD_RETRIES = 10
+
+
+def countSlot(contType, active):
+    """ Position in Container.subtreeCounts of the count of Containers of contType that are or aren't active."""
+    return (contType.number - Type.ROOT.number) * 2 + (1 if active else 0)
+
+
+def ownCounts(container):
+    """ Counts, laid out as subtreeCounts, of just container itself."""
+    counts = [0] * COUNT_SLOTS
+    counts[countSlot(container.contType, container.active)] = 1
+    return counts
+
+
+def totalCounts(container, shards=None):
+    """ Counts of container and everything below it."""
+    return [own + below for own, below in zip(ownCounts(container), subtreeCounts(container, shards))]
+
+
+def subtreeCounts(container, shards=None, **options):
+    """ Counts of everything below container: its own subtreeCounts plus those in its CountShards."""
+    if shards is None:
+        shards = cachedGetMulti(shardKeys(container.key), **options)
+    counts = list(container.subtreeCounts or [0] * COUNT_SLOTS)
+    for shard in shards:
+        if shard is not None:
+            counts = [have + count for have, count in zip(counts, shard.counts)]
+    return counts
+
+
+def shardKeys(key):
+    """ Keys of the CountShards of the Container key. Each is an entity group of its own."""
+    return [ndb.Key(CountShard, '%s.%s' % (key.urlsafe(), shard)) for shard in range(COUNT_SHARDS)]
+
+
+def addCounts(container, counts, sign=1):
+    container.subtreeCounts = [have + sign * count
+                               for have, count in zip(container.subtreeCounts or [0] * COUNT_SLOTS, counts)]
+
+
+def changeActive(container, active):
+    """ Set container.active. Returns the change to the counts of the Containers above it."""
+    before = ownCounts(container)
+    container.active = active
+    return [after - was for after, was in zip(ownCounts(container), before)]
+
+
+def addSubtreeCounts(keys, counts):
+    """ Add counts to the subtree counts of each Container of keys. Each goes to a random one of its CountShards in a
+        transaction of its own, so the Containers themselves aren't written and changes under the same Container
+        rarely conflict. Call through addSubtreeCountsOnCommit() so the counts only change once what they count has
+        been committed. Counts lost to a failure in between are repaired by rebuildCounts()."""
+    if not any(counts):
+        return
+    for key in keys:
+        shardKey = random.choice(shardKeys(key))
+        ndb.transaction(functools.partial(_addToShard, shardKey, counts), retries=SHARD_RETRIES,
+                        propagation=ndb.TransactionOptions.INDEPENDENT)
+        invalidate([shardKey])
+
+
+def addSubtreeCountsOnCommit(keys, counts):
+    """ addSubtreeCounts() once the current transaction commits, or now outside one."""
+    ndb.get_context().call_on_commit(functools.partial(addSubtreeCounts, list(keys), counts))
+
+
+def _addToShard(key, counts):
+    shard = key.get()
+    if shard is None:
+        shard = CountShard(key=key, counts=[0] * COUNT_SLOTS)
+    shard.counts = [have + count for have, count in zip(shard.counts, counts)]
+    shard.put()
+
+
+def rebuildCounts(key=root_key):
+    """ Recount subtreeCounts of every Container below and including key, eg. for Containers from before they were
+        kept or after a failed write. The CountShards are folded into the Containers' own subtreeCounts, so nothing
+        else should be changing the tree meanwhile. Returns the number of Containers whose counts were wrong."""
+    container = key.get()
+    if type(container) is not Container:
+        logging.error('Not a key: %s' % key)
+        raise TypeError
+    level = TreeLevel(None, None, None)
+    top = TreeNode(container, level)
+    level.nodes.append(top)
+    totals = {}    # {key: counts of it and everything below it}
+    changed = []
+    shards = []
+    wrong = 0
+    # Deepest first so every child is counted before its parent.
+    for node in reversed(list(top.walk())):
+        counts = [0] * COUNT_SLOTS
+        for child in node.children:
+            counts = [have + count for have, count in zip(counts, totals[child.key])]
+        totals[node.key] = [own + count for own, count in zip(ownCounts(node.container), counts)]
+        nodeShards = [shard for shard in ndb.get_multi(shardKeys(node.key)) if shard is not None]
+        if subtreeCounts(node.container, nodeShards) != counts:
+            wrong += 1
+        if nodeShards or list(node.container.subtreeCounts or [0] * COUNT_SLOTS) != counts:
+            node.container.subtreeCounts = counts
+            changed.append(node.container)
+            shards.extend(shard.key for shard in nodeShards)
+    putInBatches(changed)
+    ndb.delete_multi(shards)
+    invalidate(shards)
+    return wrong
+
+
+def attribCount(container, kind):
+    """ Number of attributes of kind container has."""
+    return container.attribCounts[container.attribKinds.index(kind)] if kind in container.attribKinds else 0
+
+
+def countAttrib(container, kind):
+    """ Add one to attribCount(container, kind)."""
+    if kind in container.attribKinds:
+        container.attribCounts[container.attribKinds.index(kind)] += 1
+    else:
+        container.attribKinds.append(kind)
+        container.attribCounts.append(1)
+
+
+def activeAttrib(container, kind):
+    """ Key of container's active attribute of kind, or None."""
+    for key in container.activeAttribs:
+        if key.kind() == kind:
+            return key
+    return None
+
+
+def pointActiveAttrib(container, kind, key):
+    """ Make key, or None for none, container's active attribute of kind."""
+    container.activeAttribs = [activeKey for activeKey in container.activeAttribs if activeKey.kind() != kind]
+    if key is not None:
+        container.activeAttribs.append(key)
+
+
+def summarizeAttribs(container):
+    """ Set the attribute counts and active pointers of container from its attributes if it doesn't have them,
+        eg. a Container from before they were kept. Where a kind has more than one active attribute the first stays
+        active. Returns {key: attribute} of the attributes switched off, to be .put()."""
+    if container.attribKinds or not container.attributes:
+        return {}
+    changed = {}
+    for attribute in ndb.get_multi(container.attributes):
+        if attribute is None:
+            continue
+        kind = attribute.key.kind()
+        countAttrib(container, kind)
+        if attribute.active:
+            if activeAttrib(container, kind) is None:
+                pointActiveAttrib(container, kind, attribute.key)
+            else:
+                attribute.active = False
+                changed[attribute.key] = attribute
+    return changed
+
+
+def rebuildAttribSummaries(key=root_key):
+    """ summarizeAttribs() every Container below and including key. Returns the number of Containers changed."""
+    container = key.get()
+    if type(container) is not Container:
+        logging.error('Not a key: %s' % key)
+        raise TypeError
+    level = TreeLevel(None, None, None)
+    top = TreeNode(container, level)
+    level.nodes.append(top)
+    count = 0
+    for node in top.walk():
+        if node.container.attributes and not node.container.attribKinds:
+            # A transaction each as a Container and its attributes are one entity group.
+            ndb.transaction(lambda: summarizeStored(node.key))
+            count += 1
+    return count
+
+
+def summarizeStored(key):
+    container = key.get()
+    putMulti(summarizeAttribs(container).values() + [container])
+
+
+STRONG = 'strong'        # Element reads in a transaction where one can hold them, otherwise strongly consistent.
+EVENTUAL = 'eventual'    # Element reads outside any transaction, with ndb.EVENTUAL_CONSISTENCY, through data_cache.
+CONSISTENCIES = (STRONG, EVENTUAL)
+
+
+def readOptions(consistency):
+    """ ndb options for every get and query of a read with consistency.
+        Reads in a transaction are strongly consistent whatever is asked for."""
+    if consistency == EVENTUAL and not ndb.in_transaction():
+        return {'read_policy': ndb.EVENTUAL_CONSISTENCY}
+    return {}
+
+
+def readConsistency(element, kwargs):
+    """ The consistency= in kwargs, or element's, checked and put back in kwargs for the method."""
+    consistency = kwargs.get('consistency') or element.consistency
+    if consistency not in CONSISTENCIES:
+        logging.error('Not a consistency: %s' % consistency)
+        raise TypeError
+    kwargs['consistency'] = consistency
+    return consistency
+
+
+def consistentRead(method):
+    """ Decorator for an Element method that only reads. Runs it in a transaction unless the Element's consistency,
+        or a consistency= argument, is EVENTUAL. The method is passed the consistency to pass on to readOptions()."""
+    @functools.wraps(method)
+    def read(self, *args, **kwargs):
+        if readConsistency(self, kwargs) == EVENTUAL:
+            return method(self, *args, **kwargs)
+        return ndb.transaction(lambda: method(self, *args, **kwargs), propagation=ndb.TransactionOptions.ALLOWED)
+    return read
+
+
+def consistentRead_async(method):
+    """ consistentRead for a tasklet method, returning a Future."""
+    @functools.wraps(method)
+    def read(self, *args, **kwargs):
+        if readConsistency(self, kwargs) == EVENTUAL:
+            return method(self, *args, **kwargs)
+        return ndb.transaction_async(lambda: method(self, *args, **kwargs),
+                                     propagation=ndb.TransactionOptions.ALLOWED)
+    return read
+
+
 class Element:
     """
     Instance variables:
@@ -48,12 +474,21 @@ class Element:
         self.containers: If a lookup for multiple keys has been performed this will contain a list of sucessfully retreived elements.
                          Otherwise it will contain an empty list.
     """
-    def __init__(self, key=None, active=None, contType=None, menuParent=None):
+    def __init__(self, key=None, active=None, contType=None, menuParent=None, fetch=True, consistency=STRONG):
+        """ fetch=False for an empty Element to be filled in by lookup_async().
+            consistency is STRONG or EVENTUAL, for the lookups and getAttrib*() reads of this Element.
+            Writes are always in a transaction."""
+        if consistency not in CONSISTENCIES:
+            logging.error('Not a consistency: %s' % consistency)
+            raise TypeError
         self.key = None
         self.container = None
         self.attribs = None
         self.keys = []
         self.containers = []
+        self.consistency = consistency
+        if not fetch:
+            return
         if key is not None:
             self.lookup(key=key, active=active, contType=contType)
         else:
@@ -66,11 +501,17 @@ class Element:
         if type(key) is StringType:
             key = ndb.Key(Container, key)
 
+        # Reads from data_session can't be part of a transaction so don't start one for them.
+        transactional = self.consistency == STRONG and data_session.current() is None
         if type(key) is ndb.Key:
-            self.lookupSingle(key, active, contType)
+            if transactional:
+                ndb.transaction(lambda: self.lookupSingle(key, active, contType),
+                                propagation=ndb.TransactionOptions.ALLOWED)
+            else:
+                self.lookupSingle(key, active, contType)
         elif type(key) is ListType:
             # Cross group transactions can only span 5 or less groups.
-            if len(key) <= 5:
+            if len(key) <= 5 and transactional:
                 ndb.transaction(lambda: self.lookupMultiple(key, active, contType), xg=True)
             else:
                 # LOOKUP NOT IN TRANSACTION.
@@ -79,9 +520,31 @@ class Element:
             logging.error('Not a key: %s' % key)
             raise TypeError
 
-    @ndb.transactional
     def lookupSingle(self, key=None, active=None, contType=None):
-            self.container = key.get()
+            self.matchSingle(key, cachedGetMulti([key], **readOptions(self.consistency))[0], active, contType)
+
+    @ndb.tasklet
+    def lookup_async(self, key, active=None, contType=None):
+        """ lookup() of a single key, returning a Future of this Element so several can be looked up at once.
+            See lookupElements_async()."""
+        if contType is not None and type(contType) is not ListType:
+            contType = [contType]
+        if type(key) is StringType:
+            key = ndb.Key(Container, key)
+        if type(key) is not ndb.Key:
+            logging.error('Not a key: %s' % key)
+            raise TypeError
+        # As lookup(), reads from data_session can't be part of a transaction so don't start one for them.
+        if self.consistency == STRONG and data_session.current() is None:
+            container = yield ndb.transaction_async(lambda: key.get_async(),
+                                                    propagation=ndb.TransactionOptions.ALLOWED)
+        else:
+            container = (yield cachedGetMulti_async([key], **readOptions(self.consistency)))[0]
+        self.matchSingle(key, container, active, contType)
+        raise ndb.Return(self)
+
+    def matchSingle(self, key, container, active, contType):
+            self.container = container
             if self.container is None:
                 return
 
@@ -99,7 +562,9 @@ class Element:
             key = [k for k in key if type(k) is ndb.Key]
             self.keys = []
             self.containers = []
-            for entity in ndb.get_multi(key):
+            for entity in batchedGetMulti(key, **readOptions(self.consistency)):
+                if entity is None:
+                    continue
                 if active is not None and not entity.active == active:
                     continue
                 if contType is not None and entity.contType not in contType:
@@ -108,6 +573,108 @@ class Element:
                 self.containers.append(entity)
             return
 
+    def getDescendants(self, depth=1, contType=None, active=None):
+        """ TreeNode of this Element's container whose .children go down depth levels (None for all of them),
+            or None if there isn't a container.
+            Children that don't match contType (one or a list) or active are left out, along with everything below
+            them. Levels are fetched as they are first used."""
+        if contType is not None and type(contType) is not ListType:
+            contType = [contType]
+        options = readOptions(self.consistency)
+        # Get up to date version of container from datastore incase self.container is stale.
+        container = cachedGetMulti([self.key], **options)[0] if self.key is not None else None
+        if type(container) is not Container:
+            return None
+        level = TreeLevel(depth, active, contType, options)
+        root = TreeNode(container, level)
+        level.nodes.append(root)
+        return root
+
+    def getBreadcrumbs(self):
+        """ Containers from the root down to this Element's menuParent, fetched together."""
+        options = readOptions(self.consistency)
+        container = self.container if self.container is not None else cachedGetMulti([self.key], **options)[0]
+        if container is None:
+            return []
+        return [ancestor for ancestor in cachedGetMulti(container.ancestors, **options) if ancestor is not None]
+
+    def countDescendants(self, contType=None, active=None):
+        """ Number of Containers below this Element of contType (one or a list) and active, from its subtreeCounts."""
+        if contType is not None and type(contType) is not ListType:
+            contType = [contType]
+        options = readOptions(self.consistency)
+        container = self.container if self.container is not None else cachedGetMulti([self.key], **options)[0]
+        if container is None:
+            return 0
+        counts = subtreeCounts(container, **options)
+        total = 0
+        for slotType in Type:
+            for slotActive in (False, True):
+                if (contType is None or slotType in contType) and (active is None or bool(active) == slotActive):
+                    total += counts[countSlot(slotType, slotActive)]
+        return total
+
+    @ndb.transactional
+    def setActive(self, active):
+        """ Set .active of this Element's Container. The counts of the Containers above it follow once it commits."""
+        container = self.key.get()
+        if type(container) is not Container:
+            logging.error('Not a key: %s' % self.key)
+            raise TypeError
+        addSubtreeCountsOnCommit(container.ancestors, changeActive(container, active))
+        putMulti([container])
+        # Do this last so it is not done yet if transaction is rolled back.
+        self.container = container
+
+    def isUnder(self, key):
+        """ True if the Container key is above this Element in the tree."""
+        container = (self.container if self.container is not None else
+                     cachedGetMulti([self.key], **readOptions(self.consistency))[0])
+        return container is not None and key in container.ancestors
+
+    def move(self, menuParent):
+        """ Make this Element a child of menuParent, an Element or key, and update .ancestors of everything below it.
+            A transaction can't span a whole subtree so the descendants, and the counts of the Containers above the
+            old and new parents, are updated after the move is committed."""
+        parentKey = menuParent if type(menuParent) is ndb.Key else menuParent.key
+        # Read outside the transaction so it only spans the Container and its old and new parents.
+        shards = ndb.get_multi(shardKeys(self.key))
+        container = ndb.transaction(lambda: self._move(parentKey, shards), xg=True)
+        if container is not None:
+            putInBatches(updateAncestors(container))
+            self.container = container
+
+    def _move(self, parentKey, shards):
+        container = self.key.get()
+        newParent = parentKey.get()
+        if (type(container) is not Container or type(newParent) is not Container or
+                parentKey == self.key or self.key in newParent.ancestors):
+            logging.error('Can not move %s under %s' % (self.key, parentKey))
+            raise TypeError
+        if container.menuParent == parentKey:
+            return None
+
+        # Take the subtree's counts off the old parent and add them to the new one. The Containers above them
+        # follow on commit.
+        totals = totalCounts(container, shards)
+        changed = [container, newParent]
+        oldParent = container.menuParent.get() if container.menuParent is not None else None
+        if oldParent is not None:
+            if self.key in oldParent.menuChildren:
+                oldParent.menuChildren.remove(self.key)
+            addCounts(oldParent, totals, -1)
+            addSubtreeCountsOnCommit(oldParent.ancestors, [-count for count in totals])
+            changed.append(oldParent)
+        if self.key not in newParent.menuChildren:
+            newParent.menuChildren.append(self.key)
+        addCounts(newParent, totals)
+        addSubtreeCountsOnCommit(newParent.ancestors, totals)
+
+        container.menuParent = parentKey
+        container.ancestors = newParent.ancestors + [parentKey]
+        putMulti(changed)
+        return container
+
     @ndb.transactional(xg=True)
     def create(self, active=None, contType=None, menuParent=None):
         user = users.get_current_user()
@@ -124,7 +691,9 @@ class Element:
                         attributeKey = attribute.put()
 
                         tmpContainer.attributes = [attributeKey]
+                        countAttrib(tmpContainer, attributeKey.kind())
                         tmpContainer.put()
+                        invalidate([tmpKey, attributeKey])
                 if tmpKey is None:
                     logging.info('Tried to bootstrap but something went wrong')
                     logging.info('user:  %s' % user)
@@ -143,12 +712,17 @@ class Element:
                 if active is None:
                     active = False
                 #self.container = Container(parent=root_key, active=active, contType=contType, menuParent=menuParent.key)
-                tmpContainer = Container(active=active, contType=contType, menuParent=menuParent.key, menuChildren=[])
+                tmpContainer = Container(active=active, contType=contType, menuParent=menuParent.key, menuChildren=[],
+                                         ancestors=menuParent.ancestors + [menuParent.key])
                 tmpKey = tmpContainer.put()
 
+                # Only the new Container and its parent are written here. The counts of the Containers above
+                # follow on commit so that creating anywhere in the tree doesn't write the root.
                 if tmpKey not in menuParent.menuChildren:
                     menuParent.menuChildren.append(tmpKey)
-                    menuParent.put()
+                addCounts(menuParent, ownCounts(tmpContainer))
+                addSubtreeCountsOnCommit(menuParent.ancestors, ownCounts(tmpContainer))
+                putMulti([menuParent])
 
             # Do these last so they are not done yet if transaction is rolled back.
             self.key = tmpKey
@@ -162,19 +736,41 @@ class Element:
             existingAttribs = attributeClass.query(ancestor=self.key).filter(attributeClass.authur==user).fetch(1)
 
             if len(existingAttribs):
-                props = attribute.to_dict()
+                # Keep who wrote it and when, which the new attribute hasn't got.
+                props = attribute.to_dict(exclude=['authur', 'created', 'modified'])
                 attribute = existingAttribs[0]
                 attribute.populate(**props)
             else:
                 attribute.authur = user
                 attribute = copyAttrib(attribute, self.key)
-            attributeKey = attribute.put()
-
             # Get up to date version of container from datastore incase the one hee is stale.
             tmpContainer = self.key.get()
+            changed = summarizeAttribs(tmpContainer)
+            attributeKey = attribute.put()
+            invalidate([attributeKey])
+
+            kind = attributeKey.kind()
+            containerChanged = bool(changed)
             if attributeKey and attributeKey not in tmpContainer.attributes:
                 tmpContainer.attributes.append(attributeKey)
-                tmpContainer.put()
+                countAttrib(tmpContainer, kind)
+                containerChanged = True
+            previous = activeAttrib(tmpContainer, kind)
+            if attribute.active and previous != attributeKey:
+                # Only one active attribute of a kind.
+                if previous is not None:
+                    old = changed.get(previous) or previous.get()
+                    if old is not None:
+                        old.active = False
+                        changed[previous] = old
+                pointActiveAttrib(tmpContainer, kind, attributeKey)
+                containerChanged = True
+            elif not attribute.active and previous == attributeKey:
+                pointActiveAttrib(tmpContainer, kind, None)
+                containerChanged = True
+            changed.pop(attributeKey, None)
+            if containerChanged:
+                putMulti(changed.values() + [tmpContainer])
                 # Do this after .put() so self.container is not modified if transaction is rolledback.
                 self.container = tmpContainer
 
@@ -206,18 +802,31 @@ class Element:
 
     @ndb.transactional
     def setAttribActive(self, key):
+        """ Make attribute key the active one of its kind and switch off the one that was.
+            Writes the two attributes and the Container whatever the number of attributes."""
+        container = self.key.get()
         attribute = key.get()
-        attributeClass = type(attribute)
-        existingAttribs = attributeClass.query(ancestor=self.key).fetch(1000)
-        for a in existingAttribs:
-            if key == a.key:
-                a.active = True
-            else:
-                a.active = False
-        ndb.put_multi(existingAttribs)
-
-    @ndb.transactional
-    def getAtribTypes(self):
+        if type(container) is not Container or not isinstance(attribute, Attrib) or key not in container.attributes:
+            logging.error('Not an attribute of %s: %s' % (self.key, key))
+            raise TypeError
+        changed = summarizeAttribs(container)
+        attribute = changed.get(key, attribute)
+        kind = key.kind()
+        previous = activeAttrib(container, kind)
+        if previous is not None and previous != key:
+            old = changed.get(previous) or previous.get()
+            if old is not None:
+                old.active = False
+                changed[previous] = old
+        attribute.active = True
+        changed[key] = attribute
+        pointActiveAttrib(container, kind, key)
+        putMulti(changed.values() + [container])
+        # Do this last so it is not done yet if transaction is rolled back.
+        self.container = container
+
+    @consistentRead
+    def getAtribTypes(self, consistency=None):
         # self.attribs = [attribType1, attribType2 ...]
         attribs = list(set([key.kind() for key in self.container.attributes]))
         if self.attribs is not None:
@@ -228,11 +837,11 @@ class Element:
                     attribs.append(attrib)
         self.attribs = attribs
 
-    @ndb.transactional
-    def getAttribDeep(self, attribute):
+    @consistentRead
+    def getAttribDeep(self, attribute, consistency=None):
         # self.attribs = [attribType1, [attribType2_instance1, attribType2_instance2 ...] ...]
         if self.attribs is None:
-            self.getAtribTypes()
+            self.getAtribTypes(consistency=consistency)
         outList = []
         for attrib in self.attribs:
             if type(attrib) is ListType:
@@ -247,18 +856,18 @@ class Element:
                 if not attrib == type(attribute).__name__:
                     outList.append(attrib)
 
-        attributes = type(attribute).query(ancestor=self.key).fetch(100)
+        attributes = type(attribute).query(ancestor=self.key).fetch(100, **readOptions(consistency))
         outList.append(attributes)
 
         self.attribs = outList
         return attributes
 
-    @ndb.transactional
-    def getAttribShallow(self, attribute):
+    @consistentRead
+    def getAttribShallow(self, attribute, consistency=None):
         """ Populate self.attribs with only the active attribute and pad the remainder of the array with None."""
         # self.attribs = [attribType1, [attribType2_instance1, None, None ...] ...]
         if self.attribs is None:
-            self.getAtribTypes()
+            self.getAtribTypes(consistency=consistency)
         outList = []
         for attrib in self.attribs:
             if type(attrib) is ListType:
@@ -278,28 +887,60 @@ class Element:
                 if not attrib == type(attribute).__name__:
                     outList.append(attrib)
 
-        numOfAttribs = type(attribute).query(ancestor=self.key).count(100)
-        attributes = type(attribute).query(ancestor=self.key).filter(type(attribute).active==True).fetch(1)
+        options = readOptions(consistency)
+        container = cachedGetMulti([self.key], **options)[0]
+        [(numOfAttribs, attributes)] = self.shallowAttribs_async(container, [type(attribute)], options).get_result()
         outList.append(attributes + [None] * (numOfAttribs -1))
 
         self.attribs = outList
         return attributes[0]
 
-    @ndb.transactional
-    def getAttribShallowAll(self):
+    def getAttribShallowAll(self, consistency=None):
+        self.getAttribShallowAll_async(consistency=consistency).get_result()
+
+    @consistentRead_async
+    @ndb.tasklet
+    def getAttribShallowAll_async(self, consistency=None):
+        """ getAttribShallowAll() with the queries for every kind of attribute running at once.
+            Returns a Future of self.attribs ."""
         if self.attribs is None:
-            self.getAtribTypes()
+            self.getAtribTypes(consistency=consistency)
+        # globals()[attrib] is the class whose name mathches the attrib string.
+        kinds = [globals()[attrib] for attrib in self.attribs if type(attrib) is not ListType]
+        options = readOptions(consistency)
+        container = (yield cachedGetMulti_async([self.key], **options))[0]
+        results = iter((yield self.shallowAttribs_async(container, kinds, options)))
         outList = []
         for attrib in self.attribs:
             if type(attrib) is ListType:
                 # this attrib has already been populated
                 outList.append(attrib)
             else:
-                # globals()[attrib] is the class whose name mathches the attrib string.
-                numOfAttribs = globals()[attrib].query(ancestor=self.key).count(100)
-                attributes = globals()[attrib].query(ancestor=self.key).filter(globals()[attrib].active==True).fetch(1)
+                numOfAttribs, attributes = next(results)
                 outList.append(attributes + [None] * (numOfAttribs -1))
         self.attribs = outList
+        raise ndb.Return(outList)
+
+    @ndb.tasklet
+    def shallowAttribs_async(self, container, kinds, options):
+        """ (number, [active attribute] or []) of each of kinds, attribute classes, of container, read with options.
+            Read through container's pointers in one get_multi, or by querying for a Container from before they
+            were kept."""
+        if container.attribKinds or not container.attributes:
+            names = [kind._get_kind() for kind in kinds]
+            keys = [activeAttrib(container, name) for name in names]
+            wanted = [key for key in keys if key is not None]
+            active = dict(zip(wanted, (yield cachedGetMulti_async(wanted, **options))))
+            results = [(attribCount(container, name), [active[key]] if active.get(key) is not None else [])
+                       for name, key in zip(names, keys)]
+        else:
+            futures = []
+            for kind in kinds:
+                futures.append(kind.query(ancestor=self.key).count_async(100, **options))
+                futures.append(kind.query(ancestor=self.key).filter(kind.active==True).fetch_async(1, **options))
+            values = yield futures
+            results = zip(values[0::2], values[1::2])
+        raise ndb.Return(results)
 
     def getMenuChildren(self):
         return [child.id() for child in self.container.menuChildren]
@@ -308,6 +949,15 @@ class Element:
         return self.container.menuParent.id()
 
 
+@ndb.tasklet
+def lookupElements_async(keys, active=None, contType=None, consistency=STRONG):
+    """ An Element for each of keys, looked up at once. Returns a Future of the list.
+        As for Element(key=key), an Element whose container doesn't exist or match has .container None."""
+    elements = yield [Element(fetch=False, consistency=consistency).lookup_async(key, active, contType)
+                      for key in keys]
+    raise ndb.Return(elements)
+
+
 def copyAttrib(attribute, parent):
     attributeClass = type(attribute)
     props = attribute.to_dict()
@@ -0,0 +1,102 @@
+""" Request scoped identity map, so each entity is fetched at most once per request.
+    eg.
+        with session() as current:
+            element = data_dict.Element(key=key)        # or data_ndb.Element
+            ...
+            current.putLater(entities, data_dict.DataStore.put_multi)
+        # Anything passed to putLater() has been written, one putMulti() call for each function.
+
+    Reads outside a transaction look in the current session first. Reads in a transaction always go to the store so
+    they are part of it. The store either checks what the session holds is still current as it is read
+    (data_dict) or has the session forget() keys it writes (data_ndb), so a request sees its own writes.
+    Nothing is kept between requests so nothing can go stale across them.
+"""
+import collections
+import contextlib
+import threading
+
+class SessionLocal(threading.local):
+    current = None    # A class default so looking it up when unset doesn't raise and catch AttributeError.
+
+
+gSession = SessionLocal()    # .current Session of the calling thread.
+
+
+def current():
+    return gSession.current
+
+
+@contextlib.contextmanager
+def session():
+    """ Run the with block in a new Session, eg. a request handler. Inside another session the block joins it.
+        putLater() writes are flushed at the end unless the block raised."""
+    outer = current()
+    if outer is not None:
+        yield outer
+        return
+    newSession = Session()
+    gSession.current = newSession
+    try:
+        yield newSession
+        newSession.flush()
+    finally:
+        gSession.current = None
+        newSession.close()
+
+
+class Session(object):
+    """ The entities read in one request."""
+    def __init__(self):
+        self.entities = {}     # {key: entity, or None if there isn't one}
+        self.pending = collections.OrderedDict()    # {putMulti: [entities]} for flush()
+        self.unwritten = {}    # {key: entity} of the pending entities that have keys.
+        self.hits = 0
+        self.fetched = 0
+
+    def get_multi(self, keys, fetch, isCurrent=None):
+        """ Entity for each of keys, or None where there isn't one, in the same order.
+            Keys not already read this session come from fetch(missing keys), which returns a list in the same order.
+            If given, isCurrent(key, entity) says whether what was read before is still what is stored. If not it
+            is fetched again. Entities passed to putLater() are always current."""
+        entities = self.entities
+        unwritten = self.unwritten
+        missing = []
+        for key in keys:
+            if key in unwritten:
+                continue
+            if key in entities and (isCurrent is None or isCurrent(key, entities[key])):
+                continue
+            missing.append(key)
+        # Each key once even if asked for twice.
+        missing = list(collections.OrderedDict.fromkeys(missing))
+        self.hits += len(keys) - len(missing)
+        if missing:
+            self.fetched += len(missing)
+            entities.update(zip(missing, fetch(missing)))
+        return [unwritten[key] if key in unwritten else entities[key] for key in keys]
+
+    def forget(self, keys):
+        """ Read keys from the store next time, eg. after they were written."""
+        for key in keys:
+            self.entities.pop(key, None)
+
+    def putLater(self, entities, putMulti):
+        """ Write entities with putMulti(entities) at the end of the session, together with everything else passed
+            with the same putMulti. They are read back from this session until then."""
+        self.pending.setdefault(putMulti, []).extend(entities)
+        for entity in entities:
+            if entity.key is not None:
+                self.unwritten[entity.key] = entity
+
+    def flush(self):
+        """ Write everything passed to putLater() so far."""
+        while self.pending:
+            putMulti, entities = self.pending.popitem(last=False)
+            putMulti(entities)
+            for entity in entities:
+                if self.unwritten.get(entity.key) is entity:
+                    del self.unwritten[entity.key]
+
+    def close(self):
+        self.entities.clear()
+        self.unwritten.clear()
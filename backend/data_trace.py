@@ -0,0 +1,130 @@
+""" Lightweight tracing of data_dict operations. Off until enable() is called and then close to free when disabled:
+    traced functions check one global and call straight through, and nothing is formatted until a record is read
+    or written out.
+    eg.
+        tracer = enable(sampleRate=0.01, path='/var/log/routeticker/trace.jsonl')
+        ...
+        for record in tracer.records():
+            print record.operation, record.key, record.duration
+
+    Each span becomes a Record. The newest <capacity> are kept in memory and, if a path was given, every one is also
+    appended to that file as a line of JSON.
+"""
+import collections
+import functools
+import json
+import random
+import threading
+import time
+
+Record = collections.namedtuple('Record', ('start', 'operation', 'key', 'duration', 'fields'))
+                  # start: time.time() the span began. duration: seconds. fields: dict of anything else recorded.
+
+gTracer = None    # The enabled Tracer, or None.
+
+
+def enable(capacity=10000, sampleRate=1.0, path=None):
+    """ Start tracing. Replaces any Tracer that was already enabled. Returns the new Tracer."""
+    global gTracer
+    tracer = Tracer(capacity, sampleRate, path)
+    disable()
+    gTracer = tracer
+    return tracer
+
+
+def disable():
+    """ Stop tracing. The Tracer that was enabled keeps the records it already has."""
+    global gTracer
+    tracer = gTracer
+    gTracer = None
+    if tracer is not None:
+        tracer.close()
+
+
+class Tracer(object):
+    def __init__(self, capacity=10000, sampleRate=1.0, path=None):
+        self.sampleRate = sampleRate    # Fraction of spans recorded.
+        self.buffer = collections.deque(maxlen=capacity)
+        self.output = open(path, 'a') if path is not None else None
+        self.lock = threading.Lock()    # Only needed to keep lines in self.output whole.
+
+    def sample(self):
+        return self.sampleRate >= 1 or random.random() < self.sampleRate
+
+    def begin(self, operation, key=None, **fields):
+        """ A Span that is recorded when it ends, or None if this one wasn't sampled."""
+        if not self.sample():
+            return None
+        return Span(self, operation, key, fields)
+
+    def event(self, operation, key=None, **fields):
+        """ Record something that doesn't take any time."""
+        if self.sample():
+            self.record(Record(time.time(), operation, key, 0.0, fields))
+
+    def record(self, record):
+        self.buffer.append(record)    # deque.append() is atomic.
+        if self.output is not None:
+            line = json.dumps(record._asdict(), default=repr) + '\n'
+            with self.lock:
+                if self.output is not None:
+                    self.output.write(line)
+
+    def records(self):
+        """ Oldest first."""
+        return list(self.buffer)
+
+    def close(self):
+        with self.lock:
+            if self.output is not None:
+                self.output.close()
+                self.output = None
+
+
+class Span(object):
+    """ Times from creation until end() or the end of a with block."""
+    __slots__ = ('tracer', 'operation', 'key', 'fields', 'start')
+
+    def __init__(self, tracer, operation, key, fields):
+        self.tracer = tracer
+        self.operation = operation
+        self.key = key
+        self.fields = fields
+        self.start = time.time()
+
+    def end(self, **fields):
+        duration = time.time() - self.start
+        self.fields.update(fields)
+        self.tracer.record(Record(self.start, self.operation, self.key, duration, self.fields))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is not None:
+            self.fields['error'] = excType.__name__
+        self.end()
+
+
+def traced(operation, key=None, fields=None):
+    """ Decorator that records a span for each call of the function while tracing is enabled.
+        key and fields are functions taking the same arguments as the decorated one, called only for sampled spans.
+        eg.
+            @traced('Element.addAttrib', key=lambda self, attribute: self.key)
+            def addAttrib(self, attribute):
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = gTracer
+            if tracer is None:
+                return func(*args, **kwargs)
+            span = tracer.begin(operation,
+                                key(*args, **kwargs) if key is not None else None,
+                                **(fields(*args, **kwargs) if fields is not None else {}))
+            if span is None:
+                return func(*args, **kwargs)
+            with span:
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,81 @@
+import unittest
+from google.appengine.ext import testbed
+
+import data_bulk
+import data_dict
+
+
+class LoadTreeTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    self.rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testLoad(self):
+    climbs = [{'contType': data_dict.ContentType.CLIMB, 'name': "climb %s" % number} for number in range(5)]
+    nodes = [{'contType': data_dict.ContentType.AREA, 'name': "area", 'description': "big", 'active': True,
+              'children': [{'contType': data_dict.ContentType.CRAG, 'name': "crag", 'children': climbs}]},
+             {'contType': data_dict.ContentType.AREA}]
+    keys = data_bulk.loadTree(nodes, data_dict.root_key, batchSize=2)
+
+    self.assertEqual(2, len(keys))
+    root = data_dict.DataStore(key=data_dict.root_key).get()
+    self.assertEqual(keys, root.menuChildren)
+
+    area = data_dict.DataStore(key=keys[0]).get()
+    self.assertEqual(True, area.active)
+    self.assertEqual(data_dict.ContentType.AREA, area.contType)
+    self.assertEqual(data_dict.root_key, area.menuParent)
+    self.assertEqual(["area", "big"], [data_dict.DataStore(key=key).get().text for key in area.attributes])
+    self.assertEqual(data_dict.AttribDescription, type(data_dict.DataStore(key=area.attributes[1]).get()))
+    self.assertEqual(['AttribName', 'AttribDescription'], area.attribKinds)
+    self.assertEqual([1, 1], area.attribCounts)
+
+    crag = data_dict.DataStore(key=area.menuChildren[0]).get()
+    self.assertEqual(False, crag.active)
+    self.assertEqual(keys[0], crag.menuParent)
+    self.assertEqual(5, len(crag.menuChildren))
+    for number, key in enumerate(crag.menuChildren):
+      climb = data_dict.DataStore(key=key).get()
+      self.assertEqual(crag.key, climb.menuParent)
+      self.assertEqual([data_dict.root_key, area.key, crag.key], climb.ancestors)
+      self.assertEqual([], climb.menuChildren)
+      name = data_dict.AttribName.query(ancestor=key).fetch()
+      self.assertEqual(["climb %s" % number], [attrib.text for attrib in name])
+      self.assertEqual('usermail@gmail.com', name[0].authur.email())
+      self.assertIsNotNone(name[0].created)
+
+    rootNode = data_dict.Element(key=data_dict.root_key)
+    self.assertEqual(8, rootNode.countDescendants())
+    self.assertEqual(5, rootNode.countDescendants(data_dict.ContentType.CLIMB))
+    self.assertEqual(1, rootNode.countDescendants(active=True))
+    self.assertEqual(6, data_dict.Element(key=keys[0]).countDescendants())
+    self.assertEqual(0, data_dict.rebuildCounts())
+
+    other = data_dict.DataStore(key=keys[1]).get()
+    self.assertEqual([], other.attributes)
+    self.assertEqual([], other.menuChildren)
+
+  def testBadParent(self):
+    with self.assertRaises(TypeError):
+      data_bulk.loadTree([{'contType': data_dict.ContentType.AREA, 'name': "area"}], 'dct_missing')
+    self.assertEqual(2, len(data_dict.gContainer))
+
+  def testBadNode(self):
+    with self.assertRaises(TypeError):
+      data_bulk.loadTree([{'contType': 74}], data_dict.root_key)
+    self.assertEqual([], data_dict.DataStore(key=data_dict.root_key).get().menuChildren)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import time
+import unittest
+
+import data_cache
+
+
+class Clock(object):
+  def __init__(self):
+    self.now = 1000.0
+
+  def __call__(self):
+    return self.now
+
+
+class LruTierTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.clock = Clock()
+    self.lru = data_cache.LruTier(capacity=3, ttl=10, clock=self.clock)
+
+  def testEviction(self):
+    for key, value in (('a', 1), ('b', 2), ('c', 3)):
+      self.lru.set_multi({key: value})
+    # Reading 'a' makes 'b' the least recently used.
+    self.assertEqual({'a': 1}, self.lru.get_multi(['a']))
+    self.lru.set_multi({'d': 4})
+    self.assertEqual({'a': 1, 'c': 3, 'd': 4}, self.lru.get_multi(['a', 'b', 'c', 'd']))
+    self.assertEqual(3, len(self.lru))
+
+    self.lru.delete_multi(['a', 'missing'])
+    self.assertEqual({}, self.lru.get_multi(['a']))
+    self.lru.clear()
+    self.assertEqual(0, len(self.lru))
+
+  def testExpiry(self):
+    self.lru.set_multi({'a': 1})
+    self.clock.now += 9
+    self.lru.set_multi({'b': 2})
+    self.assertEqual({'a': 1, 'b': 2}, self.lru.get_multi(['a', 'b']))
+    self.clock.now += 1
+    self.assertEqual({'b': 2}, self.lru.get_multi(['a', 'b']))
+    self.assertEqual(1, len(self.lru))
+
+
+class TieredCacheTestCase(unittest.TestCase):
+
+  def setUp(self):
+    self.fetched = []
+    self.store = {'a': 'A', 'b': 'B'}
+
+  def tearDown(self):
+    data_cache.disable()
+
+  def fetch(self, keys):
+    self.fetched.append(keys)
+    return dict((key, self.store[key]) for key in keys if key in self.store)
+
+  def testReadThrough(self):
+    cache = data_cache.enable(shared=data_cache.DictTier())
+    self.assertIs(cache, data_cache.gCache)
+    self.assertEqual({'a': 'A'}, cache.get_multi(['a', 'missing'], self.fetch))
+    self.assertEqual({'a': 'A', 'b': 'B'}, cache.get_multi(['a', 'b'], self.fetch))
+    self.assertEqual([['a', 'missing'], ['b']], self.fetched)
+    self.assertEqual({'localHits': 1, 'sharedHits': 0, 'misses': 3, 'invalidations': 0, 'hitRate': 0.25},
+                     cache.stats.to_dict())
+
+    # Another process has its own LRU but the same shared tier.
+    other = data_cache.TieredCache(data_cache.LruTier(), cache.shared)
+    self.assertEqual({'a': 'A'}, other.get_multi(['a'], self.fetch))
+    self.assertEqual(1, other.stats.sharedHits)
+
+    self.store['a'] = 'changed'
+    cache.invalidate(['a'])
+    self.assertEqual({'a': 'changed'}, cache.get_multi(['a'], self.fetch))
+    self.assertEqual({'a': 'changed'}, data_cache.TieredCache(data_cache.LruTier(), cache.shared).get_multi(['a'], self.fetch))
+    self.assertEqual(1, cache.stats.invalidations)
+
+    data_cache.disable()
+    self.assertIsNone(data_cache.gCache)
+
+  def testWriteWhileFetching(self):
+    cache = data_cache.enable()
+
+    def fetch(keys):
+      value = self.fetch(keys)
+      # Written and invalidated after the old value was read.
+      self.store['a'] = 'changed'
+      cache.invalidate(['a'])
+      return value
+    self.assertEqual({'a': 'A'}, cache.get_multi(['a'], fetch))
+    self.assertEqual({'a': 'changed'}, cache.get_multi(['a'], self.fetch))
+
+  def testOtherProcessWrites(self):
+    clock = Clock()
+    shared = data_cache.DictTier(clock=clock)
+    cache = data_cache.TieredCache(data_cache.LruTier(clock=clock), shared)
+    writer = data_cache.TieredCache(data_cache.LruTier(clock=clock), shared)
+
+    def fetch(keys):
+      value = self.fetch(keys)
+      # Another process writes after the old value was read.
+      self.store['a'] = 'changed'
+      writer.invalidate(['a'])
+      return value
+    self.assertEqual({'a': 'A'}, cache.get_multi(['a'], fetch))
+    self.assertEqual({}, shared.get_multi(['a']))
+    self.assertEqual({'a': 'changed'}, writer.get_multi(['a'], self.fetch))
+    self.assertEqual({}, shared.get_multi(['a']))
+
+    # Once the lock is over values are shared again.
+    clock.now += cache.lockSeconds
+    reader = data_cache.TieredCache(data_cache.LruTier(clock=clock), shared)
+    self.assertEqual({'a': 'changed'}, reader.get_multi(['a'], self.fetch))
+    self.assertEqual({'a': 'changed'}, shared.get_multi(['a']))
+
+  def testRepeatedReads(self):
+    fetched = []
+
+    def fetch(keys):
+      fetched.append(keys)
+      return self.fetch(keys)
+    cache = data_cache.enable()
+    for unused in range(20):
+      cache.get_multi(['a', 'b'], fetch)
+    self.assertEqual([['a', 'b']], fetched)
+    self.assertEqual(38, cache.stats.localHits)
+
+  def testLatency(self):
+    def slowFetch(keys):
+      # Roughly a datastore round trip.
+      time.sleep(0.002)
+      return self.fetch(keys)
+    keys = ['a', 'b']
+    start = time.time()
+    for unused in range(20):
+      slowFetch(keys)
+    uncached = time.time() - start
+
+    cache = data_cache.enable()
+    start = time.time()
+    for unused in range(20):
+      cache.get_multi(keys, slowFetch)
+    cached = time.time() - start
+    self.assertEqual(38, cache.stats.localHits)
+    self.assertLess(cached * 5, uncached)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+import array
+import binascii
+import datetime
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.api import users
+
+import data_codec
+import data_dict
+
+# encodeMulti() of a Container and an AttribName by version 1, before Users kept their auth domain and Containers had
+# ancestors, subtreeCounts and the attribute counts.
+VERSION_1 = binascii.unhexlify(
+    '010200000009000000436f6e7461696e65720a0000004174747269624e616d650200000000000000050000006463745f31ffffffff01'
+    '02000000010000000001010000000200000000000000ffffffffffffffff01000000050000006463745f33050000006463745f310240'
+    '126463e72c0500000000000000008012000000757365726d61696c40676d61696c2e636f6d020000003432040000006e616d65ffffffff')
+
+
+class CodecTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def assertSameEntity(self, expected, actual):
+    self.assertIs(type(expected), type(actual))
+    self.assertEqual(expected.key, actual.key)
+    self.assertEqual(getattr(expected, 'parent', None), actual.parent)
+    self.assertEqual(expected.to_dict(), actual.to_dict())
+
+  def testContainer(self):
+    container = data_dict.Container(key='dct_5', active=True, contType=data_dict.ContentType.CRAG,
+                                    menuParent='dct_1', menuChildren=['dct_%s' % number for number in range(100)],
+                                    attributes=['dct_7', 'not a key'], subtreeCounts=[0, 1, 2, 3, 4, 5, 6, -7],
+                                    ancestors=[data_dict.root_key, 'dct_1'])
+    copied = data_codec.decode(data_codec.encode(container))
+    self.assertSameEntity(container, copied)
+    self.assertIs(type(container.menuChildren.items), type(copied.menuChildren.items))
+    self.assertIs(array.array, type(copied.ancestors.items))
+    self.assertIn('dct_50', copied.menuChildren)
+    copied.menuChildren.append('dct_100')
+    self.assertEqual(100, len(container.menuChildren))
+
+    empty = data_dict.Container()
+    self.assertSameEntity(empty, data_codec.decode(data_codec.encode(empty)))
+
+  def testAttrib(self):
+    attrib = data_dict.AttribName(parent='dct_1', text="name", authur=users.User('usermail@gmail.com', _auth_domain='gmail.com'),
+                                  created=datetime.datetime(2016, 2, 29, 12, 0, 0, 123456))
+    attrib.note = "ad hoc"
+    copied = data_codec.decode(data_codec.encode(attrib))
+    self.assertSameEntity(attrib, copied)
+    self.assertEqual('usermail@gmail.com', copied.authur.email())
+    self.assertEqual('gmail.com', copied.authur.auth_domain())
+    self.assertEqual("ad hoc", copied.note)
+
+  def testMulti(self):
+    entities = [data_dict.Container(key='dct_1', active=False),
+                data_dict.AttribName(key='dct_2', parent='dct_1', text="name"),
+                data_dict.Container(key='dct_3', menuChildren=['dct_1'])]
+    copied = data_codec.decodeMulti(data_codec.encodeMulti(entities))
+    self.assertEqual(3, len(copied))
+    for entity, entityCopy in zip(entities, copied):
+      self.assertSameEntity(entity, entityCopy)
+    self.assertEqual([], data_codec.decodeMulti(data_codec.encodeMulti([])))
+
+  def testRepeated(self):
+    class Test(data_dict.DataStore):
+      flags = data_dict.BooleanProperty(repeated=True)
+      types = data_dict.EnumProperty(data_dict.ContentType, repeated=True)
+      numbers = data_dict.IntegerProperty(repeated=True)
+      times = data_dict.DateTimeProperty(repeated=True)
+    data_dict.Test = Test
+    try:
+      for length in (0, 1, 8, 9, 100):
+        test = Test(flags=[number % 3 == 0 for number in range(length)],
+                    types=[data_dict.ContentType.ROOT, data_dict.ContentType.CLIMB],
+                    times=[datetime.datetime(1969, 12, 31, 23, 59, 59, 1)],
+                    numbers=range(-1, length))
+        self.assertSameEntity(test, data_codec.decode(data_codec.encode(test)))
+    finally:
+      del data_dict.Test
+
+  def testErrors(self):
+    class Test(data_dict.DataStore):
+      text = data_dict.StringProperty()
+    with self.assertRaises(TypeError):
+      data_codec.encode(Test())
+    data = data_codec.encode(data_dict.Container())
+    with self.assertRaises(ValueError):
+      data_codec.decode(chr(data_codec.VERSION + 1) + data[1:])
+    with self.assertRaises(ValueError):
+      data_codec.decode(chr(0) + data[1:])
+
+  def testVersion1(self):
+    container, attrib = data_codec.decodeMulti(VERSION_1)
+    self.assertEqual('dct_1', container.key)
+    self.assertEqual(True, container.active)
+    self.assertEqual(data_dict.ContentType.AREA, container.contType)
+    self.assertEqual(['dct_2'], container.menuChildren)
+    self.assertEqual([], container.ancestors)
+    self.assertEqual([], container.subtreeCounts)
+    self.assertEqual([], container.attribCounts)
+
+    self.assertEqual('dct_3', attrib.key)
+    self.assertEqual('dct_1', attrib.parent)
+    self.assertEqual('name', attrib.text)
+    self.assertEqual(datetime.datetime(2016, 2, 29, 12, 0, 0, 123456), attrib.created)
+    self.assertEqual('usermail@gmail.com', attrib.authur.email())
+    self.assertEqual('42', attrib.authur.user_id())
+    self.assertEqual(users.User('someone@gmail.com').auth_domain(), attrib.authur.auth_domain())
+
+    # Written again it is the current version.
+    self.assertEqual(container.to_dict(), data_codec.decode(data_codec.encode(container)).to_dict())
+    self.assertEqual(attrib.authur, data_codec.decode(data_codec.encode(attrib)).authur)
+
+  def testDateTime(self):
+    for value in (None, datetime.datetime(1969, 12, 31, 23, 59, 59, 1), datetime.datetime(2016, 2, 29, 12, 0, 0, 123456)):
+      self.assertEqual(value, data_codec.dateTimeFromRaw(data_codec.dateTimeToRaw(value)))
+
+
+if __name__ == '__main__':
+    unittest.main()
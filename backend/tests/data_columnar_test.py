@@ -0,0 +1,102 @@
+import threading
+import unittest
+from google.appengine.ext import testbed
+
+import data_dict
+import data_columnar
+
+
+@unittest.skipIf(data_columnar.numpy is None, 'numpy is not installed')
+class ContainerTableTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.rootKey = data_dict.Container(active=True, contType=data_dict.ContentType.ROOT).put()
+    self.areaKey = data_dict.Container(active=True, contType=data_dict.ContentType.AREA, menuParent=self.rootKey).put()
+    self.hiddenAreaKey = data_dict.Container(active=False, contType=data_dict.ContentType.AREA, menuParent=self.rootKey).put()
+    self.cragKey = data_dict.Container(active=True, contType=data_dict.ContentType.CRAG, menuParent=self.areaKey).put()
+    self.hiddenCragKey = data_dict.Container(active=True, contType=data_dict.ContentType.CRAG, menuParent=self.hiddenAreaKey).put()
+    self.climbKeys = [data_dict.Container(active=(i % 2 == 0), contType=data_dict.ContentType.CLIMB, menuParent=self.cragKey).put()
+                      for i in range(5)]
+    data_dict.AttribName(parent=self.cragKey, text="not a container").put()
+
+    self.table = data_columnar.ContainerTable(capacity=2)
+    self.table.attach()
+
+  def tearDown(self):
+    self.table.detach()
+    self.testbed.deactivate()
+
+  def testLoad(self):
+    self.assertEqual(10, len(self.table))
+    row = self.table.rows[self.cragKey]
+    self.assertEqual(True, self.table.active[row])
+    self.assertEqual(data_dict.ContentType.CRAG, self.table.contType[row])
+    self.assertEqual(self.table.rows[self.areaKey], self.table.menuParent[row])
+    self.assertEqual(-1, self.table.menuParent[self.table.rows[self.rootKey]])
+
+  def testFilters(self):
+    self.assertEqual(3, self.table.count(active=True, contType=data_dict.ContentType.CLIMB))
+    self.assertEqual(2, self.table.count(active=False, contType=data_dict.ContentType.CLIMB))
+    self.assertEqual(set([self.areaKey, self.cragKey, self.hiddenCragKey]),
+                     set(self.table.select(active=True, contType=[data_dict.ContentType.AREA, data_dict.ContentType.CRAG])))
+    self.assertEqual({data_dict.ContentType.ROOT: 1, data_dict.ContentType.AREA: 1,
+                      data_dict.ContentType.CRAG: 2, data_dict.ContentType.CLIMB: 3},
+                     self.table.countByType(active=True))
+
+  def testTree(self):
+    visible = self.table.activeInTree()
+    self.assertTrue(visible[self.table.rows[self.cragKey]])
+    self.assertFalse(visible[self.table.rows[self.hiddenCragKey]])
+    self.assertEqual(set([self.hiddenAreaKey, self.climbKeys[1], self.climbKeys[3]]), set(self.table.inactiveSubtrees()))
+
+  def testFollowsPut(self):
+    area = data_dict.DataStore(key=self.hiddenAreaKey).get()
+    area.active = True
+    area.put()
+    self.assertEqual(set([self.climbKeys[1], self.climbKeys[3]]), set(self.table.inactiveSubtrees()))
+
+    newKey = data_dict.Container(active=True, contType=data_dict.ContentType.CLIMB, menuParent=self.hiddenCragKey).put()
+    self.assertIn(newKey, self.table.select(active=True, contType=data_dict.ContentType.CLIMB))
+    self.assertEqual(11, len(self.table))
+
+    data_dict.DataStore(key=newKey).delete()
+    self.assertNotIn(newKey, self.table.select())
+    self.assertEqual(10, len(self.table))
+
+    data_dict.clear()
+    self.assertEqual(0, len(self.table))
+    self.assertEqual({}, self.table.countByType())
+
+  def testAttachWhileWriting(self):
+    self.table.detach()
+    written = []
+
+    class Table(data_columnar.ContainerTable):
+      def load(self):
+        data_columnar.ContainerTable.load(self)
+        # Another thread writes after the load but before the listener is added.
+        writer = threading.Thread(target=lambda: written.append(
+            data_dict.Container(active=True, contType=data_dict.ContentType.CLIMB).put()))
+        writer.start()
+        writer.join(0.1)
+        self.writer = writer
+    self.table = Table()
+    self.table.attach()
+    self.table.writer.join()
+    self.assertIn(written[0], self.table.rows)
+    self.assertEqual(11, len(self.table))
+
+    # Loading again gives the same table.
+    data_columnar.ContainerTable.load(self.table)
+    self.assertEqual(11, len(self.table))
+
+
+if __name__ == '__main__':
+    unittest.main()
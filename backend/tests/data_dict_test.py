@@ -1,3 +1,6 @@
+import array
+import cPickle as pickle
+import threading
 import unittest
 from google.appengine.ext import testbed
 from protorpc import messages
@@ -6,6 +9,12 @@ from google.appengine.api import users
 import data_dict
 
 
+class PositiveProperty(data_dict.IntegerProperty):
+  """ Ints that must be positive, for testListValueOwnRules. At module level so its ListValues pickle."""
+  def makeItemsCheck(self):
+    return lambda items: all(type(item) is int and item > 0 for item in items)
+
+
 class PropertysTestCase(unittest.TestCase):
 
   def setUp(self):
@@ -218,12 +227,103 @@ class PropertysTestCase(unittest.TestCase):
     with self.assertRaises(TypeError):
         (testInstance.test3[0]) = 1
 
+  def testListValueStorage(self):
+    class TestClass(data_dict.DataStore):
+      keys = data_dict.StringProperty(repeated=True)
+      flags = data_dict.BooleanProperty(repeated=True)
+
+    testInstance = TestClass()
+    keys = ['dct_%s' % number for number in range(200)]
+    testInstance.keys = keys[:10]
+    testInstance.keys.extend(keys[10:])
+    self.assertIs(array.array, type(testInstance.keys.items))
+    self.assertEqual(keys, testInstance.keys)
+    self.assertIn('dct_150', testInstance.keys)
+    self.assertNotIn('dct_200', testInstance.keys)
+    self.assertNotIn('dct_0150', testInstance.keys)
+    self.assertNotIn(150, testInstance.keys)
+    self.assertEqual('dct_199', testInstance.keys.pop())
+    self.assertNotIn('dct_199', testInstance.keys)
+    testInstance.keys.remove('dct_0')
+    self.assertEqual(keys[1:199], testInstance.keys)
+
+    # Anything that isn't a key moves the strings to a list.
+    testInstance.keys.append('not a key')
+    self.assertIs(list, type(testInstance.keys.items))
+    self.assertIn('not a key', testInstance.keys)
+    self.assertIn('dct_150', testInstance.keys)
+    self.assertEqual(keys[1:199] + ['not a key'], testInstance.keys)
+    with self.assertRaises(TypeError):
+      testInstance.keys.append(1)
+    with self.assertRaises(TypeError):
+      testInstance.keys.extend(['dct_1', None])
+    with self.assertRaises(TypeError):
+      testInstance.keys.insert(0, 1)
+    self.assertEqual(keys[1:199] + ['not a key'], testInstance.keys)
+
+    testInstance.flags = [True, False, False]
+    testInstance.flags.append(True)
+    testInstance.flags.insert(0, False)
+    del testInstance.flags[2]
+    testInstance.flags[1] = False
+    self.assertIs(data_dict.BitList, type(testInstance.flags.items))
+    self.assertEqual([False, False, False, True], testInstance.flags)
+    self.assertIn(True, testInstance.flags)
+    self.assertEqual(3, testInstance.flags.count(False))
+    self.assertEqual(3, testInstance.flags.index(True))
+    with self.assertRaises(TypeError):
+      testInstance.flags.append(1)
+
+    # The root key has a number of its own so lists of ancestors are arrays too.
+    testInstance.keys = [data_dict.root_key, 'dct_4', 'dct_7']
+    self.assertIs(array.array, type(testInstance.keys.items))
+    self.assertEqual([data_dict.root_key, 'dct_4', 'dct_7'], testInstance.keys)
+    self.assertEqual(data_dict.root_key, testInstance.keys[0])
+    self.assertIn(data_dict.root_key, testInstance.keys)
+    self.assertEqual(0, testInstance.keys.index(data_dict.root_key))
+    self.assertNotIn('dct_-1', testInstance.keys)
+    testInstance.keys.append('dct_-1')
+    self.assertIs(list, type(testInstance.keys.items))
+    self.assertEqual([data_dict.root_key, 'dct_4', 'dct_7', 'dct_-1'], testInstance.keys)
+    testInstance.keys = keys[1:199] + ['not a key']
+    self.assertIn('dct_150', testInstance.keys)
+
+    # Copies keep the set built for 'in' but change separately.
+    copied = data_dict.copyEntity(testInstance).keys
+    self.assertIsNot(None, copied.members)
+    copied.append('dct_500')
+    self.assertIn('dct_500', copied)
+    self.assertNotIn('dct_500', testInstance.keys)
+    self.assertEqual(testInstance.keys + ['b'], list(testInstance.keys) + ['b'])
+    self.assertEqual(['b'] + testInstance.keys, ['b'] + list(testInstance.keys))
+
+    keysCopy, flagsCopy = pickle.loads(pickle.dumps((testInstance.keys, testInstance.flags), pickle.HIGHEST_PROTOCOL))
+    self.assertEqual(testInstance.keys, keysCopy)
+    self.assertEqual([False, False, False, True], flagsCopy)
+    with self.assertRaises(TypeError):
+      flagsCopy.append(None)
+
+  def testListValueOwnRules(self):
+    class TestClass(data_dict.DataStore):
+      counts = data_dict.IntegerProperty(repeated=True)
+      sizes = PositiveProperty(repeated=True)
+
+    # Each list is checked by its own property even though both hold ints.
+    testInstance = TestClass(counts=[-1], sizes=[1])
+    testInstance.counts.append(-2)
+    with self.assertRaises(TypeError):
+      testInstance.sizes.append(-2)
+    with self.assertRaises(TypeError):
+      testInstance.sizes.copy().append(-2)
+    sizesCopy = pickle.loads(pickle.dumps(testInstance.sizes, pickle.HIGHEST_PROTOCOL))
+    with self.assertRaises(TypeError):
+      sizesCopy.append(-2)
+
 
 class DataStoreTestCase(unittest.TestCase):
 
   def setUp(self):
-    data_dict.gKeyCounter = 0
-    data_dict.gContainer.clear()
+    data_dict.clear()
 
     # First, create an instance of the Testbed class.
     self.testbed = testbed.Testbed()
@@ -250,7 +350,7 @@ class DataStoreTestCase(unittest.TestCase):
     instance.put()
     instance2.put()
 
-    self.assertEqual(data_dict.gKeyCounter, 2)
+    self.assertEqual(data_dict.gKeyCounter, data_dict.KEY_BLOCK)
     self.assertEqual(len(data_dict.gContainer), 2)
 
   def testDataStoreCreateWithKey(self):
@@ -388,12 +488,12 @@ class DataStoreTestCase(unittest.TestCase):
 
     instance.put()
 
-    self.assertEqual(data_dict.gKeyCounter, 1)
+    self.assertEqual(data_dict.gKeyCounter, data_dict.KEY_BLOCK)
     self.assertEqual(len(data_dict.gContainer), 1)
 
     instance2.put()
 
-    self.assertEqual(data_dict.gKeyCounter, 2)
+    self.assertEqual(data_dict.gKeyCounter, data_dict.KEY_BLOCK)
     self.assertEqual(len(data_dict.gContainer), 2)
 
     retreived = Test(key=instance.key).get()
@@ -406,6 +506,107 @@ class DataStoreTestCase(unittest.TestCase):
     self.assertEqual(retreived2.testString, "Choons!")
     self.assertEqual(len(retreived2.testStringRepeated), 4)
 
+  def testDataStoreSlots(self):
+    class Test(data_dict.DataStore):
+      testBool = data_dict.BooleanProperty()
+      testStringRepeated = data_dict.StringProperty(repeated=True)
+
+    class TestInner(Test):
+      testString = data_dict.StringProperty(default="default")
+
+    self.assertEqual(('_v_testBool', '_v_testStringRepeated'), Test.__slots__)
+    self.assertEqual(('_v_testString',), TestInner.__slots__)
+
+    instance = TestInner(testBool=True)
+    instance2 = TestInner()
+    instance.testStringRepeated.append("only instance")
+    self.assertEqual(True, instance.testBool)
+    self.assertEqual("default", instance.testString)
+    self.assertEqual(["only instance"], instance.testStringRepeated)
+    self.assertEqual([], instance2.testStringRepeated)
+    self.assertEqual(True, Test.__dict__['_v_testBool'].__get__(instance, TestInner))
+
+    with self.assertRaises(TypeError):
+        instance.testBool = "anyhow"
+
+    # Only descriptors, key and parent were assigned so no per-instance dict was needed.
+    instance.put()
+    self.assertEqual({}, instance.__dict__)
+
+  def testDataStoreValidate(self):
+    class Test(data_dict.DataStore):
+      testEnum = data_dict.EnumProperty(data_dict.ContentType)
+      testEnumRepeated = data_dict.EnumProperty(data_dict.ContentType, repeated=True)
+      testStringRepeated = data_dict.StringProperty(repeated=True)
+
+    instance = Test(testEnum=data_dict.ContentType.CRAG,
+                    testEnumRepeated=[data_dict.ContentType.ROOT, data_dict.ContentType.CLIMB])
+    instance.validate()
+    with self.assertRaises(TypeError):
+      instance.testEnum = 74
+    with self.assertRaises(TypeError):
+      instance.testEnum = []
+    with self.assertRaises(TypeError):
+      instance.testEnumRepeated = [data_dict.ContentType.ROOT, 74]
+
+    # Repeated values check every change.
+    with self.assertRaises(TypeError):
+      instance.testStringRepeated.append(5)
+    self.assertEqual([], instance.testStringRepeated)
+
+    # Values that bypass the descriptor are caught when the whole entity is validated.
+    Test.__dict__['testStringRepeated'].slot.__set__(instance, [5])
+    with self.assertRaises(TypeError):
+      instance.validate()
+    with self.assertRaises(TypeError):
+      data_dict.DataStore.put_multi([instance], validate=True)
+    self.assertEqual(0, len(data_dict.gContainer))
+
+  def testDataStoreMulti(self):
+    existing = data_dict.Container(key="existing", active=False)
+    containers = [data_dict.Container(active=True), existing, data_dict.Container(parent="existing")]
+    keys = data_dict.DataStore.put_multi(containers)
+    self.assertEqual(['dct_1', 'existing', 'dct_2'], keys)
+    self.assertEqual([container.key for container in containers], keys)
+    self.assertEqual(set(['dct_2']), data_dict.gChildren["existing"])
+    self.assertEqual(set(['dct_1']), data_dict.gIndex[('Container', 'active')][True])
+
+    self.assertEqual([containers[2], None, existing], data_dict.DataStore.get_multi(['dct_2', 'missing', 'existing']))
+    self.assertEqual([], data_dict.DataStore.get_multi([]))
+
+    data_dict.DataStore.delete_multi(['dct_1', 'dct_2', 'missing'])
+    self.assertEqual(['existing'], data_dict.gContainer.keys())
+    self.assertEqual({}, data_dict.gChildren)
+
+  def testDataStoreThreads(self):
+    parentKey = data_dict.Container(active=True).put()
+    keys = []
+    def work(number):
+      for i in range(300):
+        key = data_dict.Container(active=(i % 2 == 0), parent=parentKey).put()
+        if i % 3 == 0:
+          container = data_dict.DataStore(key=key).get()
+          container.active = not container.active
+          container.put()
+        if i % 5 == 0:
+          data_dict.DataStore(key=key).delete()
+        else:
+          keys.append(key)
+    threads = [threading.Thread(target=work, args=(number,)) for number in range(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    # No key was handed out twice and the indexes agree with the entities.
+    self.assertEqual(8 * 240, len(set(keys)))
+    self.assertEqual(8 * 240 + 1, len(data_dict.gContainer))
+    self.assertEqual(set(keys), data_dict.gChildren[parentKey])
+    for active in (True, False):
+      self.assertEqual(set(key for key, entity in data_dict.gContainer.items() if entity.active == active),
+                       data_dict.gIndex[('Container', 'active')][active])
+    self.assertEqual(9 * data_dict.KEY_BLOCK, data_dict.gKeyCounter)
+
   def testDataStoreAsMixinMultiInherit(self):
     class TestOuter(data_dict.DataStore):
         testBoolOut = data_dict.BooleanProperty()
@@ -418,11 +619,378 @@ class DataStoreTestCase(unittest.TestCase):
     self.assertIn("testBoolOut", dir(instance))
 
 
+class QueryTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.user = users.User('usermail@gmail.com')
+    self.user2 = users.User('other@gmail.com')
+    self.parentKey = data_dict.Container(active=True, contType=data_dict.ContentType.AREA).put()
+    self.otherKey = data_dict.Container(active=False, contType=data_dict.ContentType.CRAG).put()
+    self.attribKeys = [data_dict.AttribName(parent=self.parentKey, text="name %s" % i, authur=self.user, active=(i == 0)).put()
+                       for i in range(5)]
+    data_dict.AttribName(parent=self.parentKey, text="other", authur=self.user2).put()
+    data_dict.AttribName(parent=self.otherKey, text="elsewhere", authur=self.user).put()
+    data_dict.AttribDescription(parent=self.parentKey, text="description", authur=self.user).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testQueryKind(self):
+    self.assertEqual(2, data_dict.Container.query().count())
+    self.assertEqual(7, data_dict.AttribName.query().count())
+    self.assertEqual(1, data_dict.AttribDescription.query().count())
+    self.assertEqual(10, data_dict.DataStore.query().count())
+
+  def testQueryAncestor(self):
+    self.assertEqual(6, data_dict.AttribName.query(ancestor=self.parentKey).count())
+    self.assertEqual(1, data_dict.AttribName.query(ancestor=self.otherKey).count())
+    self.assertEqual(0, data_dict.AttribName.query(ancestor='missing_key').count())
+
+    # Same as ndb, an entity is its own ancestor.
+    self.assertEqual(1, data_dict.Container.query(ancestor=self.parentKey).count())
+
+  def testQueryFilter(self):
+    query = data_dict.AttribName.query(ancestor=self.parentKey).filter(data_dict.AttribName.authur==self.user)
+    self.assertEqual(5, query.count())
+    self.assertEqual(self.attribKeys, [attrib.key for attrib in query.fetch()])
+
+    query = query.filter(data_dict.AttribName.active==True)
+    self.assertEqual(1, query.count())
+    self.assertEqual(self.attribKeys[0], query.get().key)
+
+    self.assertEqual(1, data_dict.AttribName.query(data_dict.AttribName.authur!=self.user).count())
+    self.assertEqual(2, data_dict.Container.query(data_dict.Container.contType>=data_dict.ContentType.AREA).count())
+    self.assertEqual(1, data_dict.Container.query(data_dict.Container.contType>data_dict.ContentType.AREA).count())
+    self.assertEqual(1, data_dict.Container.query().filter(active=True).count())
+
+    with self.assertRaises(TypeError):
+        data_dict.AttribName.query().filter("authur")
+
+  def testQueryAncestorIndex(self):
+    self.assertEqual(set(self.attribKeys), data_dict.gChildren[self.parentKey] & set(self.attribKeys))
+    self.assertEqual(self.parentKey, data_dict.gParents[self.attribKeys[0]])
+
+    # Grandchildren are found through the index too.
+    grandchildKey = data_dict.AttribName(parent=self.attribKeys[0], text="grandchild").put()
+    self.assertEqual(7, data_dict.AttribName.query(ancestor=self.parentKey).count())
+
+    # Re-parenting moves the entity between index entries.
+    grandchild = data_dict.DataStore(key=grandchildKey).get()
+    grandchild.parent = self.otherKey
+    grandchild.put()
+    self.assertEqual(6, data_dict.AttribName.query(ancestor=self.parentKey).count())
+    self.assertEqual(2, data_dict.AttribName.query(ancestor=self.otherKey).count())
+
+    data_dict.DataStore(key=grandchildKey).delete()
+    self.assertNotIn(grandchildKey, data_dict.gContainer)
+    self.assertNotIn(grandchildKey, data_dict.gParents)
+    self.assertEqual(1, data_dict.AttribName.query(ancestor=self.otherKey).count())
+
+    data_dict.clear()
+    self.assertEqual({}, data_dict.gChildren)
+    self.assertEqual(0, data_dict.AttribName.query(ancestor=self.parentKey).count())
+
+  def testQueryPropertyIndex(self):
+    self.assertEqual(('active', 'contType'), data_dict.Container._indexed)
+    self.assertEqual(('active', 'authur'), data_dict.AttribName._indexed)
+    self.assertEqual((), data_dict.DataStore._indexed)
+
+    self.assertEqual(set([self.parentKey]), data_dict.gIndex[('Container', 'active')][True])
+    self.assertEqual(set([self.otherKey]), data_dict.gIndex[('Container', 'contType')][data_dict.ContentType.CRAG])
+    self.assertEqual(6, len(data_dict.gIndex[('AttribName', 'authur')][self.user]))
+    self.assertEqual(set([self.parentKey, self.otherKey]), data_dict.gKinds['Container'])
+
+    query = data_dict.Container.query(data_dict.Container.active==True, data_dict.Container.contType==data_dict.ContentType.AREA)
+    self.assertEqual([], query.explain()['residual'])
+    self.assertEqual(1, query.explain()['estimatedRows'])
+    self.assertEqual(1, query.count())
+
+    query = data_dict.AttribName.query(ancestor=self.parentKey).filter(data_dict.AttribName.authur==self.user)
+    self.assertEqual([], query.explain()['residual'])
+    self.assertEqual(5, query.count())
+    self.assertEqual(2, query.count(2))
+    self.assertEqual(1, query.count(offset=4))
+
+    # Changes are picked up when the entity is .put() again.
+    other = data_dict.DataStore(key=self.otherKey).get()
+    other.active = True
+    other.put()
+    self.assertEqual(2, data_dict.Container.query(data_dict.Container.active==True).count())
+    self.assertEqual(0, data_dict.Container.query(data_dict.Container.active==False).count())
+    self.assertNotIn(False, data_dict.gIndex[('Container', 'active')])
+
+    data_dict.DataStore(key=self.otherKey).delete()
+    self.assertEqual(1, data_dict.Container.query(data_dict.Container.active==True).count())
+    self.assertEqual(1, data_dict.Container.query().count())
+
+  def testQueryPlan(self):
+    # The smallest index drives the query.
+    query = data_dict.AttribName.query(data_dict.AttribName.authur==self.user, data_dict.AttribName.active==True)
+    plan = query.explain()
+    self.assertEqual(('index', 'active', True), plan['driver'])
+    # Index keys are all of the kind so it isn't probed as well.
+    self.assertEqual([('index', 'authur', self.user)], plan['probes'])
+    self.assertEqual(1, query.count())
+
+    # An ancestor with fewer children than the smallest index is walked.
+    plan = data_dict.AttribName.query(ancestor=self.otherKey).explain()
+    self.assertEqual(('ancestor', self.otherKey), plan['driver'])
+    self.assertIsNone(plan['ancestor'])
+
+    # Otherwise the ancestor is checked against each candidate's parents.
+    query = data_dict.AttribName.query(data_dict.AttribName.active==True, ancestor=self.parentKey)
+    plan = query.explain()
+    self.assertEqual(('index', 'active', True), plan['driver'])
+    self.assertEqual(self.parentKey, plan['ancestor'])
+    self.assertEqual(self.attribKeys[0], query.get().key)
+    self.assertEqual(0, data_dict.AttribName.query(data_dict.AttribName.active==True, ancestor=self.otherKey).count())
+
+    # Filters without an index are checked against each entity.
+    plan = data_dict.AttribName.query(data_dict.AttribName.text=="other").explain()
+    self.assertEqual(('kind', 'AttribName'), plan['driver'])
+    self.assertEqual([('AttribName', 'text', '==', 'other')], plan['residual'])
+
+    self.assertEqual(('scan',), data_dict.DataStore.query().explain()['driver'])
+    self.assertEqual(10, data_dict.DataStore.query().explain()['estimatedRows'])
+
+  def testQueryCountKeysOnly(self):
+    def noRows(*args, **kwargs):
+      raise AssertionError('Entities read.')
+    queries = [data_dict.AttribName.query(data_dict.AttribName.authur==self.user, data_dict.AttribName.active==False),
+               data_dict.AttribName.query(data_dict.AttribName.authur==self.user, ancestor=self.parentKey),
+               data_dict.Container.query(data_dict.Container.active==True)]
+    counts = [query.count() for query in queries]
+    self.assertEqual([4, 5, 1], counts)
+    for query, count in zip(queries, counts):
+      query._rows = noRows
+      self.assertEqual(count, query.count())
+      self.assertEqual(min(count, 2), query.count(2))
+
+  def testQueryMissingAncestor(self):
+    for query in (data_dict.DataStore.query(ancestor='dct_missing'), data_dict.AttribName.query(ancestor='dct_missing')):
+      self.assertEqual([], query.fetch())
+      self.assertEqual(0, query.count())
+
+    # Unlike the ancestor itself, its descendants are still there to be found.
+    data_dict.DataStore(key=self.parentKey).delete()
+    self.assertEqual(7, data_dict.DataStore.query(ancestor=self.parentKey).count())
+    self.assertEqual(7, len(data_dict.DataStore.query(ancestor=self.parentKey).fetch()))
+
+  def testQueryOrder(self):
+    names = ["b", "d", "a", "c", "e"]
+    for key, name in zip(self.attribKeys, names):
+        attrib = data_dict.DataStore(key=key).get()
+        attrib.text = name
+        attrib.put()
+
+    query = data_dict.AttribName.query(data_dict.AttribName.authur==self.user, ancestor=self.parentKey)
+    self.assertEqual(sorted(names), [attrib.text for attrib in query.order(data_dict.AttribName.text).fetch()])
+    self.assertEqual(["a", "b"], [attrib.text for attrib in query.fetch(2)])
+    self.assertEqual(["c", "d"], [attrib.text for attrib in query.fetch(2, offset=2)])
+
+    query = data_dict.AttribName.query(ancestor=self.parentKey).order(-data_dict.AttribName.text)
+    self.assertEqual(["other", "e", "d"], [attrib.text for attrib in query.fetch(3)])
+
+    # created and modified are set on .put()
+    attrib = data_dict.DataStore(key=self.attribKeys[3]).get()
+    created = attrib.created
+    self.assertIsNotNone(created)
+    attrib.put()
+    self.assertEqual(created, attrib.created)
+    self.assertGreaterEqual(attrib.modified, created)
+    latest = data_dict.AttribName.query(ancestor=self.parentKey).order(-data_dict.AttribName.modified).get()
+    self.assertEqual(self.attribKeys[3], latest.key)
+
+    with self.assertRaises(TypeError):
+        query.order("text")
+
+  def testQueryRepeated(self):
+    childKey = data_dict.Container(menuParent=self.parentKey, menuChildren=[]).put()
+    parent = data_dict.DataStore(key=self.parentKey).get()
+    parent.menuChildren = [childKey]
+    parent.put()
+
+    self.assertEqual(self.parentKey, data_dict.Container.query(data_dict.Container.menuChildren==childKey).get().key)
+    self.assertIsNone(data_dict.Container.query(data_dict.Container.menuChildren=='missing_key').get())
+
+  def testQueryLimitOffset(self):
+    query = data_dict.AttribName.query(ancestor=self.parentKey).filter(data_dict.AttribName.authur==self.user)
+    self.assertEqual(self.attribKeys[:2], [attrib.key for attrib in query.fetch(2)])
+    self.assertEqual(self.attribKeys[2:4], [attrib.key for attrib in query.fetch(2, offset=2)])
+    self.assertEqual([], query.fetch(2, offset=10))
+    self.assertEqual(3, query.count(3))
+    self.assertEqual(2, query.count(10, offset=3))
+    self.assertEqual(5, len(list(query)))
+
+  def testQueryLimitStopsEarly(self):
+    matched = []
+    def match(entity, filters=None):
+      matched.append(entity.key)
+      return data_dict.Query.match(query, entity, filters)
+
+    # Without .order() the keys are read in order.
+    query = data_dict.AttribName.query(data_dict.AttribName.authur==self.user)
+    query.match = match
+    self.assertEqual(self.attribKeys[:2], [attrib.key for attrib in query.fetch(2)])
+    self.assertEqual(self.attribKeys[:2], matched)
+
+    # Ordered by an index: True, then False, then unset.
+    del matched[:]
+    query = data_dict.AttribName.query().order(-data_dict.AttribName.active)
+    query.match = match
+    self.assertEqual(self.attribKeys[1:3], [attrib.key for attrib in query.fetch(2, offset=1)])
+    self.assertEqual(self.attribKeys[:3], matched)
+    unset = [attrib.key for attrib in query.fetch(offset=5)]
+    self.assertEqual(2, len(unset))
+    self.assertEqual(unset, [attrib.key for attrib in data_dict.AttribName.query().order(data_dict.AttribName.active).fetch(2)])
+
+
+class TransactionTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.key = data_dict.Container(active=False, contType=data_dict.ContentType.AREA, menuChildren=[]).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def otherThreadPuts(self, **kwargs):
+    """ Overwrite self.key the way another request would, outside any transaction."""
+    data_dict.store(self.key, data_dict.Container(key=self.key, **kwargs))
+
+  def testSnapshot(self):
+    txn = data_dict.Transaction()
+    self.otherThreadPuts(active=True)
+    data_dict.DataStore(key=self.key).delete()
+    newKey = data_dict.Container(active=True).put()
+
+    self.assertEqual(False, txn.get(self.key).active)
+    self.assertIsNot(data_dict.DataStore(key=self.key).get(), txn.get(self.key))
+    self.assertIsNone(txn.get(newKey))
+    self.assertIsNone(data_dict.DataStore(key=self.key).get())
+    txn.close()
+
+    data_dict.collectVersions()
+    self.assertEqual({}, data_dict.gHistory)
+
+  def testCommit(self):
+    def addChild():
+      container = data_dict.DataStore(key=self.key).get()
+      container.menuChildren.append('dct_child')
+      container.put()
+      # Changes aren't visible outside until the transaction commits.
+      self.assertEqual([], data_dict.gContainer[self.key].menuChildren)
+      return 'done'
+    self.assertEqual('done', data_dict.transaction(addChild))
+    self.assertEqual(['dct_child'], data_dict.gContainer[self.key].menuChildren)
+
+  def testConflict(self):
+    txn = data_dict.Transaction()
+    container = txn.get(self.key)
+    container.active = True
+    txn.put(self.key, container)
+    self.otherThreadPuts(active=False, contType=data_dict.ContentType.CRAG)
+    with self.assertRaises(data_dict.TransactionFailedError):
+      txn.commit()
+    self.assertEqual(data_dict.ContentType.CRAG, data_dict.gContainer[self.key].contType)
+
+  def testRetry(self):
+    attempts = []
+    def toggle():
+      container = data_dict.DataStore(key=self.key).get()
+      if not attempts:
+        self.otherThreadPuts(active=False, menuChildren=['dct_other'])
+      attempts.append(container)
+      container.active = not container.active
+      container.put()
+    data_dict.transaction(toggle)
+    self.assertEqual(2, len(attempts))
+    self.assertEqual(True, data_dict.gContainer[self.key].active)
+    self.assertEqual(['dct_other'], data_dict.gContainer[self.key].menuChildren)
+
+    def alwaysConflicts():
+      data_dict.DataStore(key=self.key).get().put()
+      self.otherThreadPuts(active=False)
+    with self.assertRaises(data_dict.TransactionFailedError):
+      data_dict.transaction(alwaysConflicts, retries=1)
+
+  def testQueryCount(self):
+    def countContainers():
+      data_dict.store('dct_new', data_dict.Container(key='dct_new', active=True))
+      # Counts the snapshot, not the index the other write has just added to.
+      return data_dict.Container.query().count()
+    self.assertEqual(1, data_dict.transaction(countContainers))
+    self.assertEqual(2, data_dict.Container.query().count())
+
+  def testRollback(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    size = len(data_dict.gContainer)
+
+    @data_dict.transactional
+    def createThenFail():
+      data_dict.Element(menuParent=root_node.key, contType=data_dict.ContentType.AREA)
+      raise ValueError
+
+    with self.assertRaises(ValueError):
+      createThenFail()
+    self.assertEqual([], data_dict.gContainer[data_dict.root_key].menuChildren)
+    self.assertEqual(size, len(data_dict.gContainer))
+    self.assertIsNone(data_dict.currentTransaction())
+
+  def testListenerFails(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    area_node = data_dict.Element(menuParent=root_node, contType=data_dict.ContentType.AREA)
+    calls = []
+    heard = []
+    commits = []
+
+    def failing(key, entity):
+      calls.append(key)
+      if len(calls) == 2:
+        raise IOError
+    hear = lambda key, entity: heard.append(key)
+    data_dict.addListener(failing)
+    data_dict.addListener(hear)
+    data_dict.addListener(commits.append, commit=True)
+    try:
+      with self.assertRaises(IOError):
+        data_dict.Element(menuParent=area_node, contType=data_dict.ContentType.CRAG)
+    finally:
+      data_dict.removeListener(failing)
+      data_dict.removeListener(hear)
+      data_dict.removeListener(commits.append, commit=True)
+    self.assertEqual((), data_dict.gListeners)
+
+    # The whole transaction was stored and every other listener still heard about all of it.
+    crag = data_dict.Container.query(data_dict.Container.contType==data_dict.ContentType.CRAG).get()
+    self.assertEqual([crag.key], list(data_dict.DataStore(key=area_node.key).get().menuChildren))
+    self.assertEqual(2, data_dict.Element(key=data_dict.root_key).countDescendants())
+    self.assertEqual(calls, heard)
+    # The create, then the count it added to a CountShard of the root once it had committed.
+    self.assertEqual(2, len(commits))
+    self.assertEqual(calls, [key for commit in commits for key, entity in commit])
+    self.assertEqual(type(data_dict.DataStore(key=commits[1][0][0]).get()), data_dict.CountShard)
+
+
 class DataListTestCase(unittest.TestCase):
 
   def setUp(self):
-    data_dict.gKeyCounter = 0
-    data_dict.gContainer.clear()
+    data_dict.clear()
 
     # First, create an instance of the Testbed class.
     self.testbed = testbed.Testbed()
@@ -445,7 +1013,7 @@ class DataListTestCase(unittest.TestCase):
     attribKey = data_dict.gContainer[data_dict.root_key].attributes[0]
     self.assertEqual(data_dict.gContainer[attribKey].text, 'root')
 
-    self.assertEqual(data_dict.gKeyCounter, 1)
+    self.assertEqual(data_dict.gKeyCounter, data_dict.KEY_BLOCK)
     self.assertEqual(len(data_dict.gContainer), 2)
     self.assertIn(data_dict.root_key, data_dict.gContainer)
     self.assertIn(attribKey, data_dict.gContainer)
@@ -581,12 +1149,12 @@ class DataListTestCase(unittest.TestCase):
     root_node = data_dict.Element(contType=data_dict.ContentType.ROOT)
     self.testbed.setup_env(USER_EMAIL=None, USER_ID='0', USER_IS_ADMIN='0', overwrite = True)
     self.assertIsNone(users.get_current_user())
-    self.assertEqual(data_dict.gKeyCounter, 1)
+    self.assertEqual(data_dict.gKeyCounter, data_dict.KEY_BLOCK)
     self.assertEqual(len(data_dict.gContainer), 2)
 
     child_node = data_dict.Element(menuParent=root_node, contType=data_dict.ContentType.AREA)
 
-    self.assertEqual(data_dict.gKeyCounter, 1)
+    self.assertEqual(data_dict.gKeyCounter, data_dict.KEY_BLOCK)
     self.assertEqual(len(data_dict.gContainer), 2)
 
     self.assertIsNone(child_node.key)
@@ -622,6 +1190,11 @@ class DataListTestCase(unittest.TestCase):
     self.assertEqual(len(test_lookup.keys), NUMBER)
     self.assertEqual(len(test_lookup.containers), NUMBER)
 
+    # Results come back in the order asked for.
+    test_lookup = data_dict.Element(key=child_nodes_keys[::-1])
+    self.assertEqual(child_nodes_keys[::-1], test_lookup.keys)
+    self.assertEqual(child_nodes_keys[::-1], [container.key for container in test_lookup.containers])
+
     NUMBER = 3
     child_nodes_keys = child_nodes_keys[:NUMBER]
     test_lookup = data_dict.Element(key=child_nodes_keys)
@@ -720,6 +1293,24 @@ class DataListTestCase(unittest.TestCase):
     self.assertEqual(len(test_lookup.keys), 0)
     self.assertEqual(len(test_lookup.containers), 0)
 
+  def testInitLookupManyLimitedStale(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    child_nodes_keys = [data_dict.Element(menuParent=root_node, contType=data_dict.ContentType.AREA).key for unused in range(3)]
+
+    # Changed in place so the index still has it as inactive.
+    data_dict.gContainer[child_nodes_keys[0]].active = True
+    test_lookup = data_dict.Element(key=child_nodes_keys, active=False)
+    self.assertEqual(set(child_nodes_keys[1:]), set(test_lookup.keys))
+
+    # A transaction reads its snapshot even though the index has moved on.
+    def lookupInTransaction():
+      data_dict.store(child_nodes_keys[1], data_dict.Container(key=child_nodes_keys[1], active=False,
+                                                                 contType=data_dict.ContentType.CRAG))
+      return data_dict.Element(key=child_nodes_keys, contType=data_dict.ContentType.CRAG)
+    self.assertEqual([], data_dict.transaction(lookupInTransaction, retries=0).keys)
+
   def testInitLookupManyLimitedListFail(self):
     self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
     root_node = data_dict.Element(contType=data_dict.ContentType.ROOT)
@@ -746,6 +1337,225 @@ class DataListTestCase(unittest.TestCase):
     self.assertEqual(len(test_lookup.keys), 1)
     self.assertEqual(len(test_lookup.containers), 1)
 
+  def testGetDescendants(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    areas = [data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA) for unused in range(2)]
+    crags = [data_dict.Element(menuParent=area, contType=data_dict.ContentType.CRAG, active=True) for area in areas]
+    climbs = [data_dict.Element(menuParent=crag, contType=data_dict.ContentType.CLIMB, active=number % 2 == 0)
+              for crag in crags for number in range(3)]
+
+    fetches = []
+    getMulti = data_dict.DataStore.get_multi
+    def countingGetMulti(keys):
+      fetches.append(len(keys))
+      return getMulti(keys)
+    data_dict.DataStore.get_multi = staticmethod(countingGetMulti)
+    try:
+      tree = data_dict.Element(key=data_dict.root_key).getDescendants(depth=2)
+      self.assertEqual([], fetches)
+      self.assertEqual([area.key for area in areas], [node.key for node in tree.children])
+      self.assertEqual([crags[1].key], [node.key for node in tree.children[1].children])
+      self.assertEqual([2, 2], fetches)
+      # Climbs are below the depth asked for.
+      self.assertEqual([], tree.children[0].children[0].children)
+      self.assertEqual(5, len(list(tree.walk())))
+      self.assertEqual([2, 2], fetches)
+    finally:
+      data_dict.DataStore.get_multi = staticmethod(getMulti)
+
+    tree = areas[0].getDescendants(depth=5, active=True)
+    self.assertEqual([crags[0].key, climbs[0].key, climbs[2].key], [node.key for node in tree.walk()][1:])
+    self.assertIs(data_dict.Container, type(tree.children[0].children[1].container))
+
+    tree = rootNode.getDescendants(depth=5, contType=[data_dict.ContentType.AREA, data_dict.ContentType.CRAG])
+    self.assertEqual(5, len(list(tree.walk())))
+    tree = rootNode.getDescendants(depth=5, contType=data_dict.ContentType.CRAG)
+    self.assertEqual([], tree.children)
+    self.assertIsNone(data_dict.Element(key='dct_missing').getDescendants())
+
+  def testAncestors(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    areaNode = data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA)
+    otherAreaNode = data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA)
+    cragNode = data_dict.Element(menuParent=areaNode, contType=data_dict.ContentType.CRAG)
+    climbNode = data_dict.Element(menuParent=cragNode, contType=data_dict.ContentType.CLIMB)
+
+    self.assertEqual([], rootNode.container.ancestors)
+    self.assertEqual([data_dict.root_key, areaNode.key, cragNode.key], climbNode.container.ancestors)
+    self.assertEqual([data_dict.root_key, areaNode.key, cragNode.key],
+                     [container.key for container in climbNode.getBreadcrumbs()])
+    self.assertEqual([], rootNode.getBreadcrumbs())
+    self.assertTrue(climbNode.isUnder(areaNode.key))
+    self.assertFalse(climbNode.isUnder(otherAreaNode.key))
+    self.assertFalse(climbNode.isUnder(climbNode.key))
+
+    # Moving a crag moves everything below it.
+    cragNode.move(otherAreaNode)
+    climbNode = data_dict.Element(key=climbNode.key)
+    self.assertEqual([data_dict.root_key, otherAreaNode.key, cragNode.key], climbNode.container.ancestors)
+    self.assertTrue(climbNode.isUnder(otherAreaNode.key))
+    self.assertFalse(climbNode.isUnder(areaNode.key))
+    self.assertEqual(otherAreaNode.key, data_dict.DataStore(key=cragNode.key).get().menuParent)
+    self.assertEqual([], data_dict.DataStore(key=areaNode.key).get().menuChildren)
+    self.assertEqual([cragNode.key], data_dict.DataStore(key=otherAreaNode.key).get().menuChildren)
+
+    # Not under itself or its own descendants.
+    with self.assertRaises(TypeError):
+      cragNode.move(climbNode)
+    with self.assertRaises(TypeError):
+      cragNode.move(cragNode.key)
+    self.assertEqual(otherAreaNode.key, data_dict.DataStore(key=cragNode.key).get().menuParent)
+
+    # Repair lost paths.
+    for key in (otherAreaNode.key, climbNode.key):
+      container = data_dict.DataStore(key=key).get()
+      container.ancestors = []
+      container.put()
+    self.assertEqual(2, data_dict.rebuildAncestors())
+    self.assertEqual([data_dict.root_key, otherAreaNode.key, cragNode.key],
+                     data_dict.DataStore(key=climbNode.key).get().ancestors)
+    self.assertEqual(0, data_dict.rebuildAncestors())
+
+  def testSubtreeCounts(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    areaNode = data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA)
+    otherAreaNode = data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA)
+    cragNode = data_dict.Element(menuParent=areaNode, contType=data_dict.ContentType.CRAG)
+    climbNodes = [data_dict.Element(menuParent=cragNode, contType=data_dict.ContentType.CLIMB) for unused in range(3)]
+
+    rootNode = data_dict.Element(key=data_dict.root_key)
+    self.assertEqual(6, rootNode.countDescendants())
+    self.assertEqual(3, rootNode.countDescendants(data_dict.ContentType.CLIMB))
+    self.assertEqual(3, rootNode.countDescendants([data_dict.ContentType.CRAG, data_dict.ContentType.AREA]))
+    # Areas and crags became active when they got children.
+    self.assertEqual(2, rootNode.countDescendants(active=True))
+    self.assertEqual(1, rootNode.countDescendants(data_dict.ContentType.AREA, active=False))
+    self.assertEqual(0, climbNodes[0].countDescendants())
+
+    climbNodes[0].setActive(True)
+    self.assertEqual(1, data_dict.Element(key=areaNode.key).countDescendants(data_dict.ContentType.CLIMB, True))
+    self.assertEqual(3, data_dict.Element(key=data_dict.root_key).countDescendants(active=True))
+
+    # Moving the crag moves its counts.
+    cragNode.move(otherAreaNode)
+    self.assertEqual(0, data_dict.Element(key=areaNode.key).countDescendants())
+    self.assertEqual(4, data_dict.Element(key=otherAreaNode.key).countDescendants())
+    rootNode = data_dict.Element(key=data_dict.root_key)
+    self.assertEqual(6, rootNode.countDescendants())
+    self.assertEqual(4, rootNode.countDescendants(active=True))
+
+    # Repair lost counts, folding the CountShards into the Containers.
+    expected = data_dict.subtreeCounts(rootNode.container)
+    for key in (data_dict.root_key, cragNode.key):
+      container = data_dict.DataStore(key=key).get()
+      container.subtreeCounts = []
+      container.put()
+    self.assertEqual(2, data_dict.rebuildCounts())
+    self.assertEqual(expected, list(data_dict.DataStore(key=data_dict.root_key).get().subtreeCounts))
+    self.assertEqual([None] * data_dict.COUNT_SHARDS,
+                     data_dict.DataStore.get_multi(data_dict.shardKeys(data_dict.root_key)))
+    self.assertEqual(0, data_dict.rebuildCounts())
+
+  def testCreateLeavesRoot(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    areaNode = data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA)
+    cragNode = data_dict.Element(menuParent=areaNode, contType=data_dict.ContentType.CRAG)
+    root = data_dict.gContainer[data_dict.root_key]
+    area = data_dict.gContainer[areaNode.key]
+
+    climbNode = data_dict.Element(menuParent=cragNode, contType=data_dict.ContentType.CLIMB)
+    climbNode.setActive(True)
+    # Only the climb and the crag were written. The counts above went to CountShards.
+    self.assertIs(root, data_dict.gContainer[data_dict.root_key])
+    self.assertIs(area, data_dict.gContainer[areaNode.key])
+    self.assertEqual(3, data_dict.Element(key=data_dict.root_key).countDescendants())
+    self.assertEqual(1, data_dict.Element(key=areaNode.key).countDescendants(data_dict.ContentType.CLIMB, True))
+    self.assertEqual(0, data_dict.rebuildCounts())
+
+  def testUpdateAttrib(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    areaNode = data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA)
+    first = areaNode.addAttrib(data_dict.AttribName(text="name 0"))
+    for text in ("name 1", "name 2"):
+      areaNode.addAttrib(data_dict.AttribName(text=text))
+
+    attribs = data_dict.AttribName.query(ancestor=areaNode.key).fetch()
+    self.assertEqual([first.key], [attribute.key for attribute in attribs])
+    self.assertEqual("name 2", attribs[0].text)
+    self.assertEqual('usermail@gmail.com', attribs[0].authur.email())
+    self.assertEqual(first.created, attribs[0].created)
+    self.assertEqual(1, data_dict.attribCount(data_dict.DataStore(key=areaNode.key).get(), 'AttribName'))
+
+  def testActiveAttribs(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    areaNode = data_dict.Element(menuParent=rootNode, contType=data_dict.ContentType.AREA)
+    name0 = areaNode.addAttrib(data_dict.AttribName(text="name 0", active=True))
+    description = areaNode.addAttrib(data_dict.AttribDescription(text="description"))
+    self.testbed.setup_env(USER_EMAIL='otheruser@gmail.com', USER_ID='2', USER_IS_ADMIN='0', overwrite = True)
+    name1 = areaNode.addAttrib(data_dict.AttribName(text="name 1"))
+    self.testbed.setup_env(USER_EMAIL='billythefish@gmail.com', USER_ID='3', USER_IS_ADMIN='0', overwrite = True)
+    name2 = areaNode.addAttrib(data_dict.AttribName(text="name 2", active=True))
+
+    container = data_dict.DataStore(key=areaNode.key).get()
+    self.assertEqual(3, data_dict.attribCount(container, 'AttribName'))
+    self.assertEqual(1, data_dict.attribCount(container, 'AttribDescription'))
+    self.assertEqual(0, data_dict.attribCount(container, 'Attrib'))
+    # Adding an active attribute switches off the one that was.
+    self.assertEqual(name2.key, data_dict.activeAttrib(container, 'AttribName'))
+    self.assertIsNone(data_dict.activeAttrib(container, 'AttribDescription'))
+    self.assertFalse(data_dict.DataStore(key=name0.key).get().active)
+
+    areaNode.setAttribActive(name1.key)
+    container = data_dict.DataStore(key=areaNode.key).get()
+    self.assertEqual(name1.key, data_dict.activeAttrib(container, 'AttribName'))
+    self.assertEqual([False, True, False], [data_dict.DataStore(key=attribute.key).get().active
+                                            for attribute in (name0, name1, name2)])
+    areaNode.setAttribActive(description.key)
+    self.assertEqual(description.key,
+                     data_dict.activeAttrib(data_dict.DataStore(key=areaNode.key).get(), 'AttribDescription'))
+    with self.assertRaises(TypeError):
+      areaNode.setAttribActive(rootNode.container.attributes[0])
+
+    # Updating your own attribute without active switches it off.
+    self.testbed.setup_env(USER_EMAIL='otheruser@gmail.com', USER_ID='2', USER_IS_ADMIN='0', overwrite = True)
+    areaNode.addAttrib(data_dict.AttribName(text="name 1 again"))
+    container = data_dict.DataStore(key=areaNode.key).get()
+    self.assertIsNone(data_dict.activeAttrib(container, 'AttribName'))
+    self.assertEqual(3, data_dict.attribCount(container, 'AttribName'))
+
+    # Containers from before the counts were kept.
+    for attribute in (name0, name2):
+      attribute = data_dict.DataStore(key=attribute.key).get()
+      attribute.active = True
+      attribute.put()
+    container.attribKinds = []
+    container.attribCounts = []
+    container.activeKinds = []
+    container.activeAttribs = []
+    container.put()
+    self.assertEqual(1, data_dict.rebuildAttribSummaries())
+    container = data_dict.DataStore(key=areaNode.key).get()
+    self.assertEqual(3, data_dict.attribCount(container, 'AttribName'))
+    self.assertEqual(name0.key, data_dict.activeAttrib(container, 'AttribName'))
+    self.assertFalse(data_dict.DataStore(key=name2.key).get().active)
+    self.assertEqual(0, data_dict.rebuildAttribSummaries())
+
+  def testConsistency(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    element = data_dict.Element(key=rootNode.key, consistency=data_dict.EVENTUAL)
+    self.assertEqual(rootNode.key, element.key)
+    self.assertEqual(data_dict.EVENTUAL, element.consistency)
+    self.assertEqual(data_dict.STRONG, rootNode.consistency)
+    with self.assertRaises(TypeError):
+      data_dict.Element(key=rootNode.key, consistency='sometimes')
+
   def testAddAttribSucess(self):
     self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
     root_node = data_dict.Element(contType=data_dict.ContentType.ROOT)
@@ -0,0 +1,108 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.api import users
+
+import data_dict
+import data_export
+
+
+class DictExportTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+    self.directory = tempfile.mkdtemp()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    self.rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    self.areaNode = data_dict.Element(menuParent=self.rootNode, contType=data_dict.ContentType.AREA)
+    self.cragNode = data_dict.Element(menuParent=self.areaNode, contType=data_dict.ContentType.CRAG)
+    self.climbNodes = [data_dict.Element(menuParent=self.cragNode, contType=data_dict.ContentType.CLIMB)
+                       for unused in range(3)]
+    self.cragNode.addAttrib(data_dict.AttribName(text="crag name"))
+    self.cragNode.addAttrib(data_dict.AttribDescription(text="crag description"))
+    # The rest of the subtree counts of the root and the area.
+    self.shardKeys = [key for key, entity in data_dict.gContainer.items() if type(entity) is data_dict.CountShard]
+    # Not part of the tree so not exported.
+    self.strayKey = data_dict.Container(contType=data_dict.ContentType.AREA).put()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+    self.testbed.deactivate()
+
+  def snapshot(self):
+    return dict((key, (type(entity), getattr(entity, 'parent', None), entity.to_dict()))
+                for key, entity in data_dict.gContainer.items())
+
+  def testWalk(self):
+    keys = [entity.key for entity in data_export.walk(data_export.DictStore(), batchSize=2)]
+    self.assertEqual(9 + len(self.shardKeys), len(keys))
+    self.assertLessEqual(set(self.shardKeys), set(keys))
+    self.assertEqual(data_dict.root_key, keys[0])
+    self.assertLess(keys.index(self.areaNode.key), keys.index(self.cragNode.key))
+    self.assertLess(keys.index(self.cragNode.key), keys.index(self.climbNodes[0].key))
+    self.assertEqual(len(keys), len(set(keys)))
+
+    keys = [entity.key for entity in data_export.walk(data_export.DictStore(), self.cragNode.key)]
+    self.assertEqual([self.cragNode.key] + list(self.cragNode.container.attributes), keys[:3])
+    self.assertEqual(6, len(keys))
+    self.assertEqual([], list(data_export.walk(data_export.DictStore(), 'dct_missing')))
+
+  def testRoundTrip(self):
+    for name in ('tree.jsonl', 'tree.jsonl.gz'):
+      path = os.path.join(self.directory, name)
+      count = 9 + len(self.shardKeys)
+      self.assertEqual(count, data_export.exportTree(path, data_export.DictStore()))
+      exported = self.snapshot()
+      exported.pop(self.strayKey, None)
+
+      data_dict.clear()
+      self.assertEqual(count, data_export.importTree(path, data_export.DictStore(), batchSize=4))
+      self.assertEqual(exported, self.snapshot())
+      self.assertEqual(5, data_dict.Element(key=data_dict.root_key).countDescendants())
+      self.assertEqual(set(self.cragNode.container.attributes), data_dict.gChildren[self.cragNode.key])
+
+      # New keys don't collide with the imported ones.
+      self.assertNotIn(data_dict.DataStore().put(), exported)
+
+  def testCompressed(self):
+    path = os.path.join(self.directory, 'tree.jsonl.gz')
+    data_export.exportTree(path, data_export.DictStore())
+    with gzip.open(path) as exportFile:
+      self.assertEqual(data_export.HEADER, json.loads(exportFile.readline()))
+      record = json.loads(exportFile.readline())
+    self.assertEqual({'kind': 'Container', 'key': data_dict.root_key, 'parent': None},
+                     dict((k, record[k]) for k in ('kind', 'key', 'parent')))
+
+  def testUser(self):
+    store = data_export.DictStore()
+    user = users.User('usermail@gmail.com', _auth_domain='gmail.com', _user_id='1')
+    value = json.loads(data_export.ENCODER.encode(store.encodeValue(user)))
+    copied = store.decodeValue(value)
+    self.assertEqual(user, copied)
+    self.assertEqual('gmail.com', copied.auth_domain())
+    self.assertEqual('1', copied.user_id())
+
+    # Exported before the auth domain was kept.
+    del value['auth_domain']
+    self.assertEqual(user, store.decodeValue(value))
+
+  def testBadFile(self):
+    path = os.path.join(self.directory, 'tree.jsonl')
+    with open(path, 'w') as exportFile:
+      exportFile.write('{"format": "something else"}\n')
+    with self.assertRaises(ValueError):
+      data_export.importTree(path, data_export.DictStore())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,178 @@
+import cPickle as pickle
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.api import users
+
+import data_dict
+import data_journal
+
+
+class JournalTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+    self.directory = tempfile.mkdtemp()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.journal = data_journal.Journal(self.directory, snapshotEvery=None, background=False)
+    self.journal.open()
+
+  def tearDown(self):
+    self.journal.close()
+    shutil.rmtree(self.directory)
+    self.testbed.deactivate()
+
+  def populate(self):
+    parentKey = data_dict.Container(active=True, contType=data_dict.ContentType.AREA, menuChildren=[]).put()
+    childKey = data_dict.Container(active=False, contType=data_dict.ContentType.CRAG, menuParent=parentKey).put()
+    parent = data_dict.DataStore(key=parentKey).get()
+    parent.menuChildren.append(childKey)
+    parent.put()
+    attribKey = data_dict.AttribName(parent=childKey, text="name", authur=users.User('usermail@gmail.com')).put()
+    return parentKey, childKey, attribKey
+
+  def restart(self, **kwargs):
+    """ Simulate the process restarting: forget everything in memory and recover from the files."""
+    self.journal.close()
+    data_dict.clear()
+    self.journal = data_journal.Journal(self.directory, **kwargs)
+    self.journal.open()
+
+  def assertRecovered(self, parentKey, childKey, attribKey):
+    self.assertEqual(data_dict.KEY_BLOCK, data_dict.gKeyCounter)
+    self.assertEqual(3, len(data_dict.gContainer))
+    self.assertEqual([childKey], data_dict.DataStore(key=parentKey).get().menuChildren)
+    self.assertEqual(parentKey, data_dict.DataStore(key=childKey).get().menuParent)
+    self.assertEqual("name", data_dict.DataStore(key=attribKey).get().text)
+    self.assertEqual(1, data_dict.AttribName.query(ancestor=childKey).count())
+    self.assertEqual(1, data_dict.Container.query(data_dict.Container.active==True).count())
+
+  def testRecoverFromLog(self):
+    keys = self.populate()
+    self.restart()
+    self.assertRecovered(*keys)
+
+    # Keys carry on after the last block reserved.
+    self.assertEqual('dct_%s' % (data_dict.KEY_BLOCK + 1), data_dict.DataStore().put())
+
+  def testRecoverFromSnapshot(self):
+    keys = self.populate()
+    self.journal.snapshot()
+    self.assertEqual(['log.00000002', 'snapshot.00000002'], sorted(os.listdir(self.directory)))
+    deletedKey = data_dict.DataStore().put()
+    data_dict.DataStore(key=deletedKey).delete()
+
+    self.restart()
+    self.assertNotIn(deletedKey, data_dict.gContainer)
+    self.assertRecovered(*keys)
+
+  def testRecoverClear(self):
+    self.populate()
+    data_dict.clear()
+    key = data_dict.DataStore().put()
+    self.restart()
+    self.assertEqual([key], data_dict.gContainer.keys())
+
+  def testRecoverTornRecord(self):
+    keys = self.populate()
+    data_dict.DataStore().put()
+    self.journal.close()
+
+    # Cut the last record short, as if the process died while writing it.
+    path = os.path.join(self.directory, 'log.00000001')
+    size = os.path.getsize(path)
+    with open(path, 'r+b') as logFile:
+        logFile.truncate(size - 3)
+
+    self.restart()
+    self.assertRecovered(*keys)
+    self.assertLess(os.path.getsize(path), size - 3)
+
+  def testRecoverTornTransaction(self):
+    keys = self.populate()
+    size = os.path.getsize(os.path.join(self.directory, 'log.00000001'))
+    def removeChild():
+      parent = data_dict.DataStore(key=keys[0]).get()
+      parent.menuChildren.remove(keys[1])
+      parent.put()
+      data_dict.DataStore(key=keys[1]).delete()
+    data_dict.transaction(removeChild)
+    self.journal.close()
+
+    # Both writes are in one record so a torn transaction is lost as a whole.
+    path = os.path.join(self.directory, 'log.00000001')
+    with open(path, 'r+b') as logFile:
+        logFile.truncate(os.path.getsize(path) - 3)
+
+    self.restart()
+    self.assertRecovered(*keys)
+    self.assertEqual(size, os.path.getsize(path))
+
+  def testRecoverAbandonsKeyBlocks(self):
+    data_dict.allocateKey()    # Reserves a block from 1.
+    self.journal._apply((data_journal.COMMIT, [], 5000))
+    self.assertGreater(data_dict.allocateKey(), 5000)
+
+  def testSnapshotWhileWriting(self):
+    keys = self.populate()
+    snapshotEntities = data_dict.snapshotEntities
+    written = []
+    def writeThenCopy(version):
+      # Another thread writes while the snapshot is taken. It would deadlock if gWriteLock were still held.
+      thread = threading.Thread(target=lambda: written.append(data_dict.DataStore().put()))
+      thread.start()
+      thread.join()
+      return snapshotEntities(version)
+    data_dict.snapshotEntities = writeThenCopy
+    try:
+      self.journal.snapshot()
+    finally:
+      data_dict.snapshotEntities = snapshotEntities
+
+    with open(os.path.join(self.directory, 'snapshot.00000002'), 'rb') as snapshotFile:
+      version, keyCounter, kinds, index = pickle.load(snapshotFile)
+    self.assertEqual(sorted(keys), sorted(key for dumped in kinds for key in dumped[1]))
+    self.restart()
+    self.assertIn(written[0], data_dict.gContainer)
+    self.assertEqual(4, len(data_dict.gContainer))
+
+  def testSnapshotLeavesDefaults(self):
+    # Entities are dumped without setting the defaults of values they haven't got.
+    container = data_dict.Container.__new__(data_dict.Container)
+    container.key = 'dct_1'
+    data_dict.store('dct_1', container)
+    self.journal.snapshot()
+    with self.assertRaises(AttributeError):
+      data_dict.Container.__dict__['menuParent'].slot.__get__(container, data_dict.Container)
+    self.restart()
+    self.assertIsNone(data_dict.DataStore(key='dct_1').get().menuParent)
+
+  def testBackgroundSnapshot(self):
+    self.restart(snapshotEvery=4)
+    keys = self.populate()    # Writes 4 records so starts a snapshot.
+    self.journal.wait()
+    self.assertIn('snapshot.00000003', os.listdir(self.directory))
+    self.assertNotIn('log.00000002', os.listdir(self.directory))
+
+    self.restart()
+    self.assertRecovered(*keys)
+
+    # Writes while a snapshot is written are kept in the next log.
+    self.journal.snapshot()
+    data_dict.DataStore().put()
+    self.journal.wait()
+    self.assertEqual(['log.00000005', 'snapshot.00000005'], sorted(os.listdir(self.directory)))
+    self.restart()
+    self.assertEqual(4, len(data_dict.gContainer))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,137 @@
+import binascii
+import os
+import shutil
+import tempfile
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.api import users
+
+import data_dict
+import data_mmap
+import data_session
+
+# writeSnapshot() of a Container and an AttribName by version 2, the first with data_codec bodies.
+VERSION_2 = binascii.unhexlify(
+    '52544d4d0200000002000000020000000000000000000000b40000000000000009000000436f6e7461696e65720a000000417474726962'
+    '4e616d6500050000006463745f31ffffffff0102000000010000000001010000000200000000000000ffffffffffffffff01050000006463'
+    '745f33050000006463745f310240126463e72c0500593517e11a5e060012000000757365726d61696c40676d61696c2e636f6d02000000'
+    '3432040000006e616d65ffffffff3b000000000000006800000000000000')
+
+
+class MappedContainerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'tree.mmap')
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.parentKey = data_dict.Container(active=True, contType=data_dict.ContentType.AREA).put()
+    self.childKey = data_dict.Container(active=False, contType=data_dict.ContentType.CRAG, menuParent=self.parentKey).put()
+    parent = data_dict.DataStore(key=self.parentKey).get()
+    parent.menuChildren.append(self.childKey)
+    parent.put()
+    self.attribKey = data_dict.AttribName(parent=self.childKey, text="name", authur=users.User('usermail@gmail.com')).put()
+    self.created = data_dict.DataStore(key=self.attribKey).get().created
+    self.plainKey = data_dict.DataStore(note="ad hoc").put()
+
+    data_mmap.writeSnapshot(self.path)
+    data_dict.clear()
+    self.container = data_mmap.attach(self.path)
+
+  def tearDown(self):
+    data_mmap.detach()
+    shutil.rmtree(self.directory)
+    self.testbed.deactivate()
+
+  def testRead(self):
+    self.assertIs(self.container, data_dict.gContainer)
+    self.assertEqual(data_dict.KEY_BLOCK, data_dict.gKeyCounter)
+    self.assertEqual(4, len(data_dict.gContainer))
+
+    parent = data_dict.DataStore(key=self.parentKey).get()
+    self.assertIs(data_dict.Container, type(parent))
+    self.assertEqual(True, parent.active)
+    self.assertEqual(data_dict.ContentType.AREA, parent.contType)
+    self.assertEqual(None, parent.menuParent)
+    self.assertEqual([self.childKey], parent.menuChildren)
+
+    attrib = data_dict.DataStore(key=self.attribKey).get()
+    self.assertEqual(self.childKey, attrib.parent)
+    self.assertEqual("name", attrib.text)
+    self.assertEqual('usermail@gmail.com', attrib.authur.email())
+    self.assertEqual(self.created, attrib.created)
+    self.assertEqual(None, attrib.active)
+
+    self.assertEqual("ad hoc", data_dict.DataStore(key=self.plainKey).get().note)
+    self.assertEqual(None, data_dict.DataStore(key='dct_missing').get())
+
+  def testSameEntity(self):
+    parent = data_dict.DataStore(key=self.parentKey).get()
+    self.assertIs(parent, data_dict.DataStore(key=self.parentKey).get())
+    self.assertIs(parent, dict(data_dict.gContainer.iteritems())[self.parentKey])
+
+    # So a session sees the entity it read is still the stored one and doesn't read it again.
+    with data_session.session() as session:
+      self.assertIs(parent, data_dict.DataStore(key=self.parentKey).get())
+      data_dict.DataStore(key=self.parentKey).get()
+      self.assertEqual(1, session.fetched)
+      self.assertEqual(1, session.hits)
+
+  def testIndexes(self):
+    self.assertEqual(1, data_dict.AttribName.query(ancestor=self.childKey).count())
+    self.assertEqual([self.parentKey], [container.key for container in
+                                        data_dict.Container.query(data_dict.Container.active==True)])
+
+  def testOverlay(self):
+    child = data_dict.DataStore(key=self.childKey).get()
+    child.active = True
+    child.put()
+    newKey = data_dict.DataStore().put()
+    self.assertEqual('dct_%s' % (data_dict.KEY_BLOCK + 1), newKey)
+    data_dict.DataStore(key=self.plainKey).delete()
+
+    self.assertEqual(True, data_dict.DataStore(key=self.childKey).get().active)
+    self.assertNotIn(self.plainKey, data_dict.gContainer)
+    self.assertEqual(set([self.parentKey, self.childKey, self.attribKey, newKey]), set(data_dict.gContainer))
+    self.assertEqual(4, len(data_dict.gContainer))
+    self.assertEqual(2, data_dict.Container.query(data_dict.Container.active==True).count())
+
+    # The file is untouched so another worker still sees the original.
+    other = data_mmap.MappedContainer(self.path)
+    self.assertEqual(False, other[self.childKey].active)
+    self.assertIn(self.plainKey, other)
+    self.assertNotIn(newKey, other)
+    other.close()
+
+  def testOlderVersion(self):
+    path = os.path.join(self.directory, 'version2.mmap')
+    with open(path, 'wb') as snapshotFile:
+      snapshotFile.write(VERSION_2)
+    other = data_mmap.MappedContainer(path)
+    self.assertEqual(['dct_1', 'dct_3'], list(other))
+    self.assertEqual(['dct_2'], other['dct_1'].menuChildren)
+    self.assertEqual([], other['dct_1'].ancestors)
+    self.assertEqual('usermail@gmail.com', other['dct_3'].authur.email())
+    self.assertEqual('42', other['dct_3'].authur.user_id())
+    other.close()
+
+    with open(path, 'wb') as snapshotFile:
+      snapshotFile.write(VERSION_2[:4] + chr(1) + VERSION_2[5:])
+    with self.assertRaises(ValueError):
+      data_mmap.MappedContainer(path)
+
+  def testClear(self):
+    data_dict.clear()
+    self.assertEqual(0, len(data_dict.gContainer))
+    self.assertEqual([], list(data_dict.gContainer))
+    key = data_dict.DataStore().put()
+    self.assertEqual([key], list(data_dict.gContainer))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,10 +1,13 @@
+import time
 import unittest
 from google.appengine.ext import ndb
 from google.appengine.ext import testbed
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.api import users
 
+import data_cache
 import data_ndb
+import data_session
 
 class ElementTestCase(unittest.TestCase):
 
@@ -445,6 +448,19 @@ class ElementTestCase(unittest.TestCase):
     self.assertIn(attribute, child_node.attribs[0])
     self.assertIn(attribute_2, child_node.attribs[0])    
 
+  def testAddAttribUpdateKeepsAuthur(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    child_node = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    first = child_node.addAttrib(data_ndb.AttribName(text="name 0"))
+    for text in ("name 1", "name 2"):
+      child_node.addAttrib(data_ndb.AttribName(text=text))
+
+    attribs = data_ndb.AttribName.query(ancestor=child_node.key).fetch()
+    self.assertEqual([first.key], [attribute.key for attribute in attribs])
+    self.assertEqual("name 2", attribs[0].text)
+    self.assertEqual('usermail@gmail.com', attribs[0].authur.email())
+
   def testGetAtribTypes(self):
     self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
     root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
@@ -562,6 +578,97 @@ class ElementTestCase(unittest.TestCase):
     self.assertNotIn(attribute_5, flatList)
     self.assertIn(None, flatList)
 
+  def testAsync(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    area_node = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    crag_node = data_ndb.Element(menuParent=area_node, contType=data_ndb.Type.CRAG)
+    attribute_0 = area_node.addAttrib(data_ndb.AttribName(text="area", active=True))
+    attribute_1 = crag_node.addAttrib(data_ndb.AttribName(text="crag", active=True))
+    crag_node.addAttrib(data_ndb.AttribDescription(text="crag description"))
+
+    elements = data_ndb.lookupElements_async([area_node.key, crag_node.key, root_node.key],
+                                             contType=[data_ndb.Type.AREA, data_ndb.Type.CRAG]).get_result()
+    self.assertEqual([area_node.key, crag_node.key, None], [element.key for element in elements])
+    self.assertIsNone(elements[2].container)
+
+    futures = [element.getAttribShallowAll_async() for element in elements[:2]]
+    self.assertEqual([[attribute_0]], futures[0].get_result())
+    self.assertEqual([[], [attribute_1]], sorted(futures[1].get_result()))
+    self.assertEqual([[attribute_0]], elements[0].attribs)
+
+    with self.assertRaises(TypeError):
+      data_ndb.Element(fetch=False).lookup_async(None).get_result()
+
+  def testActiveAttribs(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    child_node = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    attribute_0 = child_node.addAttrib(data_ndb.AttribName(text="test name", active=True))
+    self.testbed.setup_env(USER_EMAIL='otheruser@gmail.com', USER_ID='2', USER_IS_ADMIN='0', overwrite = True)
+    attribute_1 = child_node.addAttrib(data_ndb.AttribName(text="test name 2", active=True))
+
+    container = child_node.key.get()
+    self.assertEqual(2, data_ndb.attribCount(container, 'AttribName'))
+    self.assertEqual(attribute_1.key, data_ndb.activeAttrib(container, 'AttribName'))
+    self.assertEqual(False, attribute_0.key.get().active)
+
+    child_node.setAttribActive(attribute_0.key)
+    container = child_node.key.get()
+    self.assertEqual([attribute_0.key], container.activeAttribs)
+    self.assertEqual(False, attribute_1.key.get().active)
+
+    # Containers from before the counts were kept are read by querying, and can be repaired.
+    container.attribKinds = []
+    container.attribCounts = []
+    container.activeAttribs = []
+    container.put()
+    child_node = data_ndb.Element(key=child_node.key)
+    self.assertEqual("test name", child_node.getAttribShallow(data_ndb.AttribName()).text)
+    self.assertEqual(1, data_ndb.rebuildAttribSummaries())
+    container = child_node.key.get()
+    self.assertEqual(['AttribName'], container.attribKinds)
+    self.assertEqual([attribute_0.key], container.activeAttribs)
+
+  def testConsistency(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    child_nodes = [data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA) for unused in range(3)]
+    child_nodes[0].addAttrib(data_ndb.AttribName(text="test name", active=True))
+
+    element = data_ndb.Element(key=child_nodes[0].key, consistency=data_ndb.EVENTUAL)
+    self.assertEqual(child_nodes[0].key, element.key)
+    self.assertEqual("test name", element.getAttribShallow(data_ndb.AttribName()).text)
+    element.attribs = None
+    self.assertEqual("test name", element.getAttribShallow(data_ndb.AttribName(),
+                                                           consistency=data_ndb.STRONG).text)
+
+    keys = [child_node.key for child_node in child_nodes]
+    element = data_ndb.Element(key=keys, consistency=data_ndb.EVENTUAL)
+    self.assertEqual(set(keys), set(element.keys))
+
+    with self.assertRaises(TypeError):
+      data_ndb.Element(key=root_node.key, consistency='sometimes')
+    with self.assertRaises(TypeError):
+      element.getAtribTypes(consistency='sometimes')
+
+    # Every read path of an EVENTUAL Element goes through the cache, and none of a STRONG one's do.
+    cache = data_cache.enable()
+    try:
+      for consistency, misses in ((data_ndb.STRONG, 0), (data_ndb.EVENTUAL, 1)):
+        element = data_ndb.Element(key=root_node.key, consistency=consistency)
+        self.assertEqual(misses, cache.stats.misses)
+        self.assertEqual(3, len(element.getDescendants().children))
+        element = data_ndb.lookupElements_async([child_nodes[0].key], consistency=consistency).get_result()[0]
+        element.getAttribShallowAll()
+        self.assertEqual("test name", element.attribs[0][0].text)
+      self.assertEqual(5, cache.stats.misses)
+    finally:
+      data_cache.disable()
+
   def testGetMenuChildren(self):
     self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
     root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
@@ -578,6 +685,160 @@ class ElementTestCase(unittest.TestCase):
     self.assertIn(child_node_3.key.id(), children)
     self.assertEqual(3, len(children))
 
+  def testGetDescendants(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    area_node = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    crag_node = data_ndb.Element(menuParent=area_node, contType=data_ndb.Type.CRAG, active=True)
+    climb_node_1 = data_ndb.Element(menuParent=crag_node, contType=data_ndb.Type.CLIMB, active=True)
+    climb_node_2 = data_ndb.Element(menuParent=crag_node, contType=data_ndb.Type.CLIMB)
+
+    tree = root_node.getDescendants(depth=3)
+    self.assertEqual([area_node.key], [node.key for node in tree.children])
+    self.assertEqual([root_node.key, area_node.key, crag_node.key, climb_node_1.key, climb_node_2.key],
+                     [node.key for node in tree.walk()])
+    self.assertEqual(2, len(list(root_node.getDescendants(depth=1).walk())))
+
+    tree = area_node.getDescendants(depth=2, active=True)
+    self.assertEqual([area_node.key, crag_node.key, climb_node_1.key], [node.key for node in tree.walk()])
+
+  def testAncestors(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    area_node_1 = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    area_node_2 = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    crag_node = data_ndb.Element(menuParent=area_node_1, contType=data_ndb.Type.CRAG)
+    climb_node = data_ndb.Element(menuParent=crag_node, contType=data_ndb.Type.CLIMB)
+
+    self.assertEqual([root_node.key, area_node_1.key, crag_node.key],
+                     [container.key for container in climb_node.getBreadcrumbs()])
+    self.assertTrue(climb_node.isUnder(area_node_1.key))
+    self.assertFalse(climb_node.isUnder(area_node_2.key))
+
+    crag_node.move(area_node_2)
+    climb_node = data_ndb.Element(key=climb_node.key)
+    self.assertEqual([root_node.key, area_node_2.key, crag_node.key], climb_node.container.ancestors)
+    self.assertEqual([], area_node_1.key.get().menuChildren)
+    self.assertEqual([crag_node.key], area_node_2.key.get().menuChildren)
+
+    with self.assertRaises(TypeError):
+      crag_node.move(climb_node)
+
+  def testSubtreeCounts(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    area_node_1 = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    area_node_2 = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    crag_node = data_ndb.Element(menuParent=area_node_1, contType=data_ndb.Type.CRAG)
+    climb_node = data_ndb.Element(menuParent=crag_node, contType=data_ndb.Type.CLIMB)
+
+    root_node = data_ndb.Element(key=root_node.key)
+    self.assertEqual(4, root_node.countDescendants())
+    self.assertEqual(1, root_node.countDescendants(data_ndb.Type.CLIMB))
+    self.assertEqual(0, root_node.countDescendants(active=True))
+
+    climb_node.setActive(True)
+    self.assertEqual(1, data_ndb.Element(key=area_node_1.key).countDescendants(active=True))
+
+    crag_node.move(area_node_2)
+    self.assertEqual(0, data_ndb.Element(key=area_node_1.key).countDescendants())
+    self.assertEqual(2, data_ndb.Element(key=area_node_2.key).countDescendants())
+
+    # Creating a climb only writes it and the crag. The counts above went to CountShards.
+    data_ndb.Element(menuParent=crag_node, contType=data_ndb.Type.CLIMB)
+    self.assertEqual(5, data_ndb.Element(key=root_node.key).countDescendants())
+
+    container = root_node.key.get()
+    expected = data_ndb.subtreeCounts(container)
+    container.subtreeCounts = []
+    container.put()
+    self.assertEqual(1, data_ndb.rebuildCounts())
+    self.assertEqual(expected, root_node.key.get().subtreeCounts)
+    self.assertEqual([None] * data_ndb.COUNT_SHARDS, ndb.get_multi(data_ndb.shardKeys(root_node.key)))
+    self.assertEqual(0, data_ndb.rebuildCounts())
+
+  def testCache(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    cache = data_cache.enable(shared=data_cache.MemcacheTier())
+    eventual = lambda key: data_ndb.Element(key=key, consistency=data_ndb.EVENTUAL)
+    try:
+      self.assertEqual([], eventual(root_node.key).container.menuChildren)
+      self.assertEqual([], eventual(root_node.key).container.menuChildren)
+      self.assertEqual(1, cache.stats.localHits)
+      self.assertEqual(1, cache.stats.misses)
+
+      # Strongly consistent reads don't use the cache.
+      self.assertEqual([], data_ndb.Element(key=root_node.key).container.menuChildren)
+      self.assertEqual(1, cache.stats.localHits)
+      self.assertEqual(1, cache.stats.misses)
+
+      # Writing the root drops it from the cache.
+      child_node = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+      self.assertEqual([child_node.key], eventual(root_node.key).container.menuChildren)
+      self.assertEqual(2, cache.stats.misses)
+
+      child_node.addAttrib(data_ndb.AttribName(text="name"))
+      self.assertEqual(1, len(eventual(child_node.key).container.attributes))
+
+      # Entities from the cache are copies.
+      eventual(root_node.key).container.menuChildren.append(root_node.key)
+      self.assertEqual([child_node.key], eventual(root_node.key).container.menuChildren)
+
+      element = eventual([root_node.key, child_node.key])
+      self.assertEqual(set([root_node.key, child_node.key]), set(element.keys))
+    finally:
+      data_cache.disable()
+
+  def testLookupLatency(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    keys = [data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA).key for unused in range(10)]
+    ndb.get_context().set_cache_policy(False)
+
+    def lookups():
+      # lookupSingle() then lookupMultiple(), as eventually consistent reads as only they use the cache.
+      start = time.time()
+      for unused in range(20):
+        self.assertEqual(keys[0], data_ndb.Element(key=keys[0], consistency=data_ndb.EVENTUAL).key)
+        self.assertEqual(10, len(data_ndb.Element(key=keys, consistency=data_ndb.EVENTUAL).keys))
+      return time.time() - start
+    uncached = lookups()
+
+    cache = data_cache.enable(shared=data_cache.MemcacheTier())
+    try:
+      cached = lookups()
+      self.assertEqual(10, cache.stats.misses)
+      self.assertEqual(20 * 11 - 10, cache.stats.localHits)
+    finally:
+      data_cache.disable()
+    self.assertLess(cached * 2, uncached)
+
+  def testSession(self):
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='0', overwrite = True)
+    area_node = data_ndb.Element(menuParent=root_node, contType=data_ndb.Type.AREA)
+    crag_node = data_ndb.Element(menuParent=area_node, contType=data_ndb.Type.CRAG)
+    with data_session.session() as session:
+      container = data_ndb.Element(key=area_node.key).container
+      self.assertIs(container, data_ndb.Element(key=area_node.key).container)
+      crag_node.getBreadcrumbs()
+      self.assertEqual(2, session.fetched)
+
+      # A write in the session is seen by it.
+      self.assertEqual([], data_ndb.Element(key=crag_node.key).container.menuChildren)
+      self.assertEqual(3, session.fetched)
+      climb_node = data_ndb.Element(menuParent=crag_node, contType=data_ndb.Type.CLIMB)
+      self.assertEqual([climb_node.key], data_ndb.Element(key=crag_node.key).container.menuChildren)
+      self.assertEqual(4, session.fetched)
+    self.assertIsNone(data_session.current())
+
   def testGetMenuParent(self):
     self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
     root_node = data_ndb.Element(contType=data_ndb.Type.ROOT)
@@ -0,0 +1,92 @@
+import unittest
+from google.appengine.ext import testbed
+
+import data_dict
+import data_session
+
+
+class SessionTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+    self.testbed.setup_env(USER_EMAIL='usermail@gmail.com', USER_ID='1', USER_IS_ADMIN='1', overwrite = True)
+    self.rootNode = data_dict.Element(contType=data_dict.ContentType.ROOT)
+    self.areaNode = data_dict.Element(menuParent=self.rootNode, contType=data_dict.ContentType.AREA)
+    self.cragNode = data_dict.Element(menuParent=self.areaNode, contType=data_dict.ContentType.CRAG)
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def testGetMulti(self):
+    fetched = []
+
+    def fetch(keys):
+      fetched.append(keys)
+      return [key.upper() if key != 'missing' else None for key in keys]
+    with data_session.session() as session:
+      self.assertIs(session, data_session.current())
+      self.assertEqual(['A', None, 'A'], session.get_multi(['a', 'missing', 'a'], fetch))
+      self.assertEqual(['B', 'A', None], session.get_multi(['b', 'a', 'missing'], fetch))
+      self.assertEqual([['a', 'missing'], ['b']], fetched)
+      self.assertEqual(3, session.fetched)
+      self.assertEqual(3, session.hits)
+
+      session.forget(['a'])
+      session.get_multi(['a'], fetch)
+      self.assertEqual(['a'], fetched[-1])
+
+      # Joins the outer session.
+      with data_session.session() as inner:
+        self.assertIs(session, inner)
+      self.assertIs(session, data_session.current())
+    self.assertIsNone(data_session.current())
+
+  def testElement(self):
+    with data_session.session() as session:
+      area = data_dict.Element(key=self.areaNode.key).container
+      self.assertIs(area, data_dict.Element(key=self.areaNode.key).container)
+      data_dict.Element(key=[self.areaNode.key, self.cragNode.key])
+      self.cragNode.getBreadcrumbs()
+      self.assertEqual(3, session.fetched)
+      self.assertEqual((), data_dict.gListeners)
+
+      # Writes made in the session, in a transaction or not, are seen by it.
+      climbNode = data_dict.Element(menuParent=self.cragNode, contType=data_dict.ContentType.CLIMB)
+      self.assertEqual([climbNode.key], data_dict.Element(key=self.cragNode.key).container.menuChildren)
+      self.areaNode.addAttrib(data_dict.AttribName(text="area"))
+      self.assertEqual(1, len(data_dict.Element(key=self.areaNode.key).container.attributes))
+
+      # So are writes from other requests.
+      replacement = data_dict.Container(key=self.cragNode.key, contType=data_dict.ContentType.CRAG, menuChildren=[])
+      data_dict.store(self.cragNode.key, replacement)
+      self.assertIs(replacement, data_dict.Element(key=self.cragNode.key).container)
+
+      data_dict.clear()
+      self.assertIsNone(data_dict.Element(key=self.areaNode.key).container)
+
+  def testPutLater(self):
+    with data_session.session() as session:
+      container = data_dict.Container(key=data_dict.DataStore.allocate_key(), contType=data_dict.ContentType.AREA)
+      session.putLater([container], data_dict.DataStore.put_multi)
+      self.assertIs(container, data_dict.DataStore(key=container.key).get())
+      self.assertIsNone(data_dict.gContainer.get(container.key))
+    self.assertIs(container, data_dict.gContainer.get(container.key))
+
+    # Not written if the request fails.
+    with self.assertRaises(ValueError):
+      with data_session.session() as session:
+        other = data_dict.Container(key=data_dict.DataStore.allocate_key(), contType=data_dict.ContentType.AREA)
+        session.putLater([other], data_dict.DataStore.put_multi)
+        raise ValueError
+    self.assertIsNone(data_dict.gContainer.get(other.key))
+    self.assertIsNone(data_session.current())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from google.appengine.ext import testbed
+
+import data_dict
+import data_trace
+
+
+class TracerTestCase(unittest.TestCase):
+
+  def setUp(self):
+    data_dict.clear()
+    self.directory = tempfile.mkdtemp()
+
+    # First, create an instance of the Testbed class.
+    self.testbed = testbed.Testbed()
+    # Then activate the testbed, which prepares the service stubs for use.
+    self.testbed.activate()
+
+  def tearDown(self):
+    data_trace.disable()
+    shutil.rmtree(self.directory)
+    self.testbed.deactivate()
+
+  def testDisabled(self):
+    tracer = data_trace.enable()
+    data_trace.disable()
+    self.assertIs(None, data_trace.gTracer)
+    data_dict.Container.query(data_dict.Container.active==True).fetch()
+    self.assertEqual([], tracer.records())
+
+  def testQuerySpans(self):
+    tracer = data_trace.enable()
+    data_dict.Container(active=True).put()
+    self.assertEqual(1, len(data_dict.Container.query().filter(data_dict.Container.active==True).fetch(5)))
+
+    records = tracer.records()
+    self.assertEqual(['DataStore.query', 'AllProperties.Uninitiated', 'Query.filter', 'Query.fetch'],
+                     [record.operation for record in records])
+    self.assertEqual('Container', records[0].fields['kind'])
+    self.assertEqual({'owner': 'Container', 'label': 'active'}, records[1].fields)
+    self.assertEqual({'kind': 'Container', 'limit': 5, 'offset': 0}, records[3].fields)
+    for record in records:
+      self.assertGreaterEqual(record.duration, 0)
+
+  def testError(self):
+    tracer = data_trace.enable()
+    with self.assertRaises(TypeError):
+      data_dict.Container.query().filter("not a filter")
+    self.assertEqual('TypeError', tracer.records()[-1].fields['error'])
+
+  def testSampling(self):
+    tracer = data_trace.enable(sampleRate=0)
+    data_dict.Container.query().count()
+    self.assertEqual([], tracer.records())
+
+  def testCapacity(self):
+    tracer = data_trace.enable(capacity=2)
+    for number in range(5):
+      tracer.event('test', number=number)
+    self.assertEqual([3, 4], [record.fields['number'] for record in tracer.records()])
+
+  def testFile(self):
+    path = os.path.join(self.directory, 'trace.jsonl')
+    data_trace.enable(path=path)
+    with data_trace.gTracer.begin('test', key='dct_1', value=object()):
+      pass
+    data_trace.disable()
+
+    with open(path) as traceFile:
+      lines = [json.loads(line) for line in traceFile]
+    self.assertEqual(1, len(lines))
+    self.assertEqual('test', lines[0]['operation'])
+    self.assertEqual('dct_1', lines[0]['key'])
+    self.assertIn('object', lines[0]['fields']['value'])
+
+
+if __name__ == '__main__':
+    unittest.main()